@@ -43,6 +43,13 @@ def authtkt_factory(**settings):
         secret=settings['kotti.secret2'], callback=list_groups_callback)
 
 
+def groups_authtkt_factory(**settings):
+    from kotti.security import GroupsAuthTktAuthenticationPolicy
+    return GroupsAuthTktAuthenticationPolicy(
+        secret=settings['kotti.secret2'],
+        groups_ttl=int(settings['kotti.authtkt_groups_ttl']))
+
+
 def acl_factory(**settings):
     return ACLAuthorizationPolicy()
 
@@ -62,6 +69,8 @@ conf_defaults = {
     'kotti.includes': '',  # BBB
     'kotti.base_includes': ' '.join([
         'kotti kotti.events',
+        'kotti.security_index',
+        'kotti.password_hashing',
         'kotti.views',
         'kotti.views.cache',
         'kotti.views.view',
@@ -86,6 +95,7 @@ conf_defaults = {
         'kotti.resources.Image',
         ]),
     'kotti.search_content': 'kotti.views.util.default_search_content',
+    'kotti.search_facets': '',
     'kotti.authn_policy_factory': 'kotti.authtkt_factory',
     'kotti.authz_policy_factory': 'kotti.acl_factory',
     'kotti.session_factory': 'kotti.beaker_session_factory',
@@ -99,6 +109,19 @@ conf_defaults = {
     'kotti.datetime_format': 'medium',
     'kotti.time_format': 'medium',
     'kotti.max_file_size': '10',
+    'kotti.principal_cache_ttl': '60',
+    'kotti.principal_cache_size': '1000',
+    'kotti.bcrypt_threads': '0',
+    'kotti.bcrypt_target_ms': '',
+    'kotti.after_commit_threads': '2',
+    'kotti.after_commit_queue': '100',
+    'kotti.authtkt_groups_ttl': '60',
+    'kotti.sql_stats_headers': 'False',
+    'kotti.sql_stats_slowest': '5',
+    'kotti.phase_timing_sinks': 'kotti.instrumentation.log_phases',
+    'kotti.metrics_port': '',
+    'kotti.profile_signal': '',
+    'kotti.profile_seconds': '10',
     'kotti.fanstatic.edit_needed': 'kotti.fanstatic.edit_needed',
     'kotti.fanstatic.view_needed': 'kotti.fanstatic.view_needed',
     'kotti.static.edit_needed': '',  # BBB
@@ -118,6 +141,7 @@ conf_dotted = set([
     'kotti.populators',
     'kotti.available_types',
     'kotti.search_content',
+    'kotti.search_facets',
     'kotti.authn_policy_factory',
     'kotti.authz_policy_factory',
     'kotti.session_factory',
@@ -126,6 +150,7 @@ conf_dotted = set([
     'kotti.fanstatic.edit_needed',
     'kotti.fanstatic.view_needed',
     'kotti.url_normalizer',
+    'kotti.phase_timing_sinks',
     ])
 
 
@@ -0,0 +1,35 @@
+"""Add the 'allowed_principals' index.
+
+The index is built by running ``kotti-reindex-security <config_uri>``
+after the migration.
+
+Revision ID: 03ec2e30858f
+Revises: 57fecf5dbd62
+Create Date: 2026-10-19 10:12:31.412087
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '03ec2e30858f'
+down_revision = '57fecf5dbd62'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'allowed_principals',
+        sa.Column('node_id', sa.Integer(), primary_key=True),
+        sa.Column('principal_name', sa.Unicode(100), primary_key=True),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('allowed', sa.Boolean(), nullable=False),
+        )
+    op.create_index(
+        'ix_allowed_principals_principal_name',
+        'allowed_principals', ['principal_name'])
+
+
+def downgrade():
+    op.drop_index('ix_allowed_principals_principal_name')
+    op.drop_table('allowed_principals')
@@ -0,0 +1,45 @@
+"""Add an index for prefix searches on tag titles.
+
+Revision ID: 3f1e7a9c2d4b
+Revises: 5a8c2e4d1b7f
+Create Date: 2026-10-19 16:21:05.830417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1e7a9c2d4b'
+down_revision = '5a8c2e4d1b7f'
+
+from alembic import op
+import sqlalchemy as sa
+
+NAME = 'ix_tags_lower_title'
+
+INDEX_QUERIES = {
+    'postgresql': 'SELECT 1 FROM pg_indexes WHERE indexname = :name',
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'index' "
+              "AND name = :name",
+    }
+
+
+def _supported():
+    return op.get_bind().dialect.name in INDEX_QUERIES
+
+
+def _index_exists(name):
+    bind = op.get_bind()
+    query = sa.text(INDEX_QUERIES[bind.dialect.name])
+    return bind.execute(query, name=name).first() is not None
+
+
+def upgrade():
+    if not _supported():
+        return
+    if not _index_exists(NAME):
+        op.execute('CREATE INDEX {0} ON tags (lower(title))'.format(NAME))
+
+
+def downgrade():
+    if not _supported():
+        return
+    op.execute('DROP INDEX {0}'.format(NAME))
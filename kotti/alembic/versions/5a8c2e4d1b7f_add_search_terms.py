@@ -0,0 +1,33 @@
+"""Add the 'search_terms' table of the full-text search index.
+
+The index is only maintained when ``kotti.search`` is included.  Run
+``kotti-reindex-search`` to build it.
+
+Revision ID: 5a8c2e4d1b7f
+Revises: f732ba2ed3e9
+Create Date: 2026-10-19 14:02:47.215384
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a8c2e4d1b7f'
+down_revision = 'f732ba2ed3e9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'search_terms',
+        sa.Column('term', sa.Unicode(100), primary_key=True),
+        sa.Column('node_id', sa.Integer(), primary_key=True),
+        sa.Column('weight', sa.Integer(), nullable=False),
+        )
+    op.create_index(
+        'ix_search_terms_node_id', 'search_terms', ['node_id'])
+
+
+def downgrade():
+    op.drop_index('ix_search_terms_node_id')
+    op.drop_table('search_terms')
@@ -0,0 +1,27 @@
+"""Add 'Tag.usage_count'.
+
+Revision ID: 8b3d5f0e6a21
+Revises: 3f1e7a9c2d4b
+Create Date: 2026-10-19 17:48:12.204836
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8b3d5f0e6a21'
+down_revision = '3f1e7a9c2d4b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('tags', sa.Column(
+        'usage_count', sa.Integer(), nullable=False, server_default='0'))
+    op.create_index('ix_tags_usage_count', 'tags', ['usage_count'])
+    op.execute('UPDATE tags SET usage_count = (SELECT count(*) '
+               'FROM tags_to_contents WHERE tag_id = tags.id)')
+
+
+def downgrade():
+    op.drop_index('ix_tags_usage_count')
+    op.drop_column('tags', 'usage_count')
@@ -0,0 +1,108 @@
+"""Move the principals' groups into the 'principal_groups' table.
+
+Revision ID: ab81b8ffa390
+Revises: 03ec2e30858f
+Create Date: 2026-10-19 12:40:05.183920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'ab81b8ffa390'
+down_revision = '03ec2e30858f'
+
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _principals_table(metadata):
+    # The 'principals' table as of this revision, without 'groups':
+    return sa.Table(
+        'principals', metadata,
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('name', sa.Unicode(100), unique=True),
+        sa.Column('password', sa.Unicode(100)),
+        sa.Column('active', sa.Boolean()),
+        sa.Column('confirm_token', sa.Unicode(100)),
+        sa.Column('title', sa.Unicode(100), nullable=False),
+        sa.Column('email', sa.Unicode(100), unique=True),
+        sa.Column('creation_date', sa.DateTime(), nullable=False),
+        sa.Column('last_login_date', sa.DateTime()),
+        )
+
+
+def _drop_groups_column(bind):
+    if bind.dialect.name != 'sqlite':
+        op.drop_column('principals', 'groups')
+        return
+
+    # SQLite can't drop columns, so we copy the table instead:
+    principals = _principals_table(sa.MetaData())
+    columns = ', '.join(c.name for c in principals.columns)
+    op.rename_table('principals', 'principals_old')
+    principals.create(bind)
+    bind.execute('INSERT INTO principals ({0}) SELECT {0} '
+                 'FROM principals_old'.format(columns))
+    op.drop_table('principals_old')
+
+
+def upgrade():
+    bind = op.get_bind()
+    memberships = []
+    for name, groups in bind.execute('SELECT name, groups FROM principals'):
+        for position, group_name in enumerate(json.loads(groups or '[]')):
+            memberships.append(dict(
+                principal_name=name, group_name=group_name,
+                position=position))
+
+    _drop_groups_column(bind)
+
+    op.create_table(
+        'principal_groups',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('principal_name', sa.Unicode(100),
+                  sa.ForeignKey('principals.name', onupdate='CASCADE',
+                                ondelete='CASCADE'),
+                  nullable=False),
+        sa.Column('group_name', sa.Unicode(100), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        )
+    op.create_index(
+        'ix_principal_groups_principal_name',
+        'principal_groups', ['principal_name'])
+    op.create_index(
+        'ix_principal_groups_group_name',
+        'principal_groups', ['group_name'])
+    if memberships:
+        table = sa.sql.table(
+            'principal_groups',
+            sa.sql.column('principal_name', sa.Unicode(100)),
+            sa.sql.column('group_name', sa.Unicode(100)),
+            sa.sql.column('position', sa.Integer()),
+            )
+        bind.execute(table.insert(), memberships)
+
+
+def downgrade():
+    bind = op.get_bind()
+    groups = {}
+    for name, group_name in bind.execute(
+            'SELECT principal_name, group_name FROM principal_groups '
+            'ORDER BY principal_name, position'):
+        groups.setdefault(name, []).append(group_name)
+
+    op.add_column('principals', sa.Column('groups', sa.Text()))
+    principals = sa.sql.table(
+        'principals',
+        sa.sql.column('name', sa.Unicode(100)),
+        sa.sql.column('groups', sa.Text()),
+        )
+    for (name,) in bind.execute('SELECT name FROM principals'):
+        bind.execute(principals.update().where(
+            principals.c.name == name).values(
+            groups=json.dumps(groups.get(name, []))))
+
+    op.drop_index('ix_principal_groups_group_name')
+    op.drop_index('ix_principal_groups_principal_name')
+    op.drop_table('principal_groups')
@@ -0,0 +1,76 @@
+"""Add lower-cased copies of principals' names and titles.
+
+Prefix searches now use these columns instead of indexes on
+``lower(...)``, which doesn't change the case of non-ASCII characters
+on SQLite.  The indexes compare by code points (``COLLATE "C"`` on
+PostgreSQL), so that ranges of them are prefix matches.
+
+Revision ID: c4e2a9f7b1d3
+Revises: 8b3d5f0e6a21
+Create Date: 2026-10-20 09:12:40.318207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e2a9f7b1d3'
+down_revision = '8b3d5f0e6a21'
+
+from alembic import op
+import sqlalchemy as sa
+
+OLD_COLUMNS = ('name', 'title', 'email')
+NEW_COLUMNS = ('name_lower', 'title_lower', 'email')
+
+
+def _create_index(column):
+    name = 'ix_principals_{0}'.format(column)
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE INDEX {0} ON principals ({1} COLLATE "C")'.format(
+            name, column))
+    elif dialect == 'sqlite':
+        op.execute('CREATE INDEX {0} ON principals ({1})'.format(
+            name, column))
+
+
+def _supported():
+    return op.get_bind().dialect.name in ('postgresql', 'sqlite')
+
+
+def upgrade():
+    bind = op.get_bind()
+    op.add_column('principals', sa.Column('name_lower', sa.Unicode(100)))
+    op.add_column('principals', sa.Column('title_lower', sa.Unicode(100)))
+    principals = sa.sql.table(
+        'principals',
+        sa.sql.column('id', sa.Integer()),
+        sa.sql.column('name', sa.Unicode(100)),
+        sa.sql.column('title', sa.Unicode(100)),
+        sa.sql.column('name_lower', sa.Unicode(100)),
+        sa.sql.column('title_lower', sa.Unicode(100)),
+        )
+    rows = bind.execute(sa.select(
+        [principals.c.id, principals.c.name, principals.c.title])).fetchall()
+    for id, name, title in rows:
+        bind.execute(principals.update().where(
+            principals.c.id == id).values(
+            name_lower=name.lower() if name is not None else None,
+            title_lower=title.lower()))
+
+    if not _supported():
+        return
+    for column in OLD_COLUMNS:
+        op.execute('DROP INDEX ix_principals_lower_{0}'.format(column))
+    for column in NEW_COLUMNS:
+        _create_index(column)
+
+
+def downgrade():
+    if _supported():
+        for column in NEW_COLUMNS:
+            op.execute('DROP INDEX ix_principals_{0}'.format(column))
+        for column in OLD_COLUMNS:
+            op.execute('CREATE INDEX ix_principals_lower_{0} '
+                       'ON principals (lower({0}))'.format(column))
+    op.drop_column('principals', 'title_lower')
+    op.drop_column('principals', 'name_lower')
@@ -0,0 +1,53 @@
+"""Add a lower-cased copy of tags' titles.
+
+``Tag.search_prefix`` now uses this column instead of the index on
+``lower(title)``, which doesn't change the case of non-ASCII
+characters on SQLite.
+
+Revision ID: d7b1f3a8e5c2
+Revises: c4e2a9f7b1d3
+Create Date: 2026-10-20 10:05:22.671934
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7b1f3a8e5c2'
+down_revision = 'c4e2a9f7b1d3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _supported():
+    return op.get_bind().dialect.name in ('postgresql', 'sqlite')
+
+
+def upgrade():
+    bind = op.get_bind()
+    op.add_column('tags', sa.Column('title_lower', sa.Unicode(100)))
+    tags = sa.sql.table(
+        'tags',
+        sa.sql.column('id', sa.Integer()),
+        sa.sql.column('title', sa.Unicode(100)),
+        sa.sql.column('title_lower', sa.Unicode(100)),
+        )
+    rows = bind.execute(sa.select([tags.c.id, tags.c.title])).fetchall()
+    for id, title in rows:
+        bind.execute(tags.update().where(tags.c.id == id).values(
+            title_lower=title.lower()))
+
+    if not _supported():
+        return
+    op.execute('DROP INDEX ix_tags_lower_title')
+    if bind.dialect.name == 'postgresql':
+        op.execute('CREATE INDEX ix_tags_title_lower '
+                   'ON tags (title_lower COLLATE "C")')
+    else:
+        op.execute('CREATE INDEX ix_tags_title_lower ON tags (title_lower)')
+
+
+def downgrade():
+    if _supported():
+        op.execute('DROP INDEX ix_tags_title_lower')
+        op.execute('CREATE INDEX ix_tags_lower_title ON tags (lower(title))')
+    op.drop_column('tags', 'title_lower')
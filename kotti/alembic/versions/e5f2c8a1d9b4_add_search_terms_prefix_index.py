@@ -0,0 +1,32 @@
+"""Add an index for prefix searches of the full-text search index.
+
+Searches compare terms by code points (``COLLATE "C"``) on
+PostgreSQL, which the primary key index can't be used for unless the
+database's collation is ``C``.
+
+Revision ID: e5f2c8a1d9b4
+Revises: d7b1f3a8e5c2
+Create Date: 2026-10-20 11:31:08.504216
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5f2c8a1d9b4'
+down_revision = 'd7b1f3a8e5c2'
+
+from alembic import op
+
+
+def _supported():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def upgrade():
+    if _supported():
+        op.execute('CREATE INDEX ix_search_terms_term '
+                   'ON search_terms (term COLLATE "C")')
+
+
+def downgrade():
+    if _supported():
+        op.execute('DROP INDEX ix_search_terms_term')
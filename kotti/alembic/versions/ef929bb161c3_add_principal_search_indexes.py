@@ -0,0 +1,36 @@
+"""Add indexes for prefix searches on principals.
+
+Revision ID: ef929bb161c3
+Revises: ab81b8ffa390
+Create Date: 2026-10-19 14:02:47.551203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'ef929bb161c3'
+down_revision = 'ab81b8ffa390'
+
+from alembic import op
+
+COLUMNS = ('name', 'title', 'email')
+
+DIALECTS = ('postgresql', 'sqlite')
+
+
+def _supported():
+    return op.get_bind().dialect.name in DIALECTS
+
+
+def upgrade():
+    if not _supported():
+        return
+    for column in COLUMNS:
+        op.execute('CREATE INDEX ix_principals_lower_{0} '
+                   'ON principals (lower({0}))'.format(column))
+
+
+def downgrade():
+    if not _supported():
+        return
+    for column in COLUMNS:
+        op.execute('DROP INDEX ix_principals_lower_{0}'.format(column))
@@ -0,0 +1,32 @@
+"""Add the 'memberships_generation' table.
+
+``kotti.groups_authtkt_factory`` compares the number in it with the
+one signed into auth tickets, so that changes to memberships made by
+any process invalidate the groups in tickets.
+
+Revision ID: f1a6d3c9e2b7
+Revises: e5f2c8a1d9b4
+Create Date: 2026-10-20 14:48:19.027655
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1a6d3c9e2b7'
+down_revision = 'e5f2c8a1d9b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'memberships_generation',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('generation', sa.Integer(), nullable=False),
+        )
+    op.execute(
+        'INSERT INTO memberships_generation (id, generation) VALUES (1, 0)')
+
+
+def downgrade():
+    op.drop_table('memberships_generation')
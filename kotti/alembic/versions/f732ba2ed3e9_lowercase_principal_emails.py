@@ -0,0 +1,46 @@
+"""Store principals' email addresses in lower case.
+
+Revision ID: f732ba2ed3e9
+Revises: ef929bb161c3
+Create Date: 2026-10-19 15:21:09.730114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f732ba2ed3e9'
+down_revision = 'ef929bb161c3'
+
+from warnings import warn
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    bind = op.get_bind()
+    principals = sa.sql.table(
+        'principals',
+        sa.sql.column('id', sa.Integer()),
+        sa.sql.column('email', sa.Unicode(100)),
+        )
+    rows = bind.execute(sa.select(
+        [principals.c.id, principals.c.email],
+        principals.c.email != None)).fetchall()
+
+    taken = set(email for id, email in rows if email == email.lower())
+    for id, email in rows:
+        normalized = email.strip().lower()
+        if normalized == email:
+            continue
+        if normalized in taken:
+            # We can't have two principals with the same address:
+            warn(u"Not changing email {0!r} of principal with id {1}: "
+                 u"{2!r} is already taken.".format(email, id, normalized))
+            continue
+        taken.add(normalized)
+        bind.execute(principals.update().where(
+            principals.c.id == id).values(email=normalized))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,10 @@
+"""Benchmarks for Kotti.
+
+:mod:`kotti.benchmarks.site` builds synthetic sites of configurable
+size.  :mod:`kotti.benchmarks.suite` times core operations against
+such a site and writes machine-readable results that can be compared
+between releases::
+
+  bin/kotti-benchmarks --output=0.8.json
+  bin/kotti-benchmarks --compare=0.8.json
+"""
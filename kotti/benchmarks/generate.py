@@ -0,0 +1,451 @@
+"""Generate large synthetic sites for load testing.
+
+Unlike :func:`kotti.benchmarks.site.build_site`, which goes through
+the ORM, :func:`generate_site` writes rows with batched inserts of
+SQLAlchemy core statements.  No object events are fired, so nothing
+that's usually done by event handlers happens unless it's done here:
+the generator sets owners, dates and workflow states itself.  Like
+:func:`kotti.events.set_owner`, it gives owners the ``role:owner``
+local role unless they inherit it already, and it writes the rows of
+the allowed principals index (see :mod:`kotti.security_index`) along
+with the nodes.
+
+The shape of the generated site follows a few simple distributions:
+the number of children of a document is exponentially distributed
+around ``fanout``, tags are assigned with a Zipf-like popularity and
+a share of the content is public while the rest is in the workflow's
+initial state.
+
+The ``kotti-generate-site`` command generates a site in the database
+of an existing installation.
+"""
+
+from bisect import bisect
+from collections import deque
+from datetime import datetime
+from datetime import timedelta
+from random import Random
+
+from sqlalchemy import func
+from sqlalchemy.sql import select
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from kotti import DBSession
+from kotti.benchmarks.site import _png
+from kotti.events import recount_tags
+from kotti.resources import AllowedPrincipal
+from kotti.resources import Content
+from kotti.resources import Document
+from kotti.resources import File
+from kotti.resources import Image
+from kotti.resources import LocalGroup
+from kotti.resources import Node
+from kotti.resources import Tag
+from kotti.resources import TagsToContents
+from kotti.resources import get_root
+from kotti.security import Principal
+from kotti.security import PrincipalGroup
+from kotti.security import get_principals
+from kotti.security_index import _acl_entries
+from kotti.security_index import _decide
+from kotti.util import command
+from kotti.workflow import get_workflow
+from kotti.workflow import state_acl
+
+#: Generated files are at most this big
+MAX_FILE_SIZE = 10 * 1024 * 1024
+
+LOREM = (u'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed '
+         u'do eiusmod tempor incididunt ut labore et dolore magna aliqua. ')
+
+
+class GeneratorSpec(object):
+    """What :func:`generate_site` generates.
+
+      >>> spec = GeneratorSpec(nodes=100, files=20)
+      >>> spec.nodes, spec.files, spec.images
+      (100, 20, 5)
+    """
+
+    defaults = (
+        ('nodes', 10000),  # content objects to add
+        ('fanout', 10),  # average number of children of a document
+        ('files', 10),  # percentage of files
+        ('images', 5),  # percentage of images
+        ('public', 70),  # percentage of public content
+        ('users', 100),
+        ('groups', 10),
+        ('tags', 200),  # distinct tags; each content has up to 3
+        ('local_roles', 100),  # local role assignments
+        ('batch_size', 1000),  # nodes per insert and transaction
+        ('seed', 0),
+        )
+
+    def __init__(self, **kwargs):
+        for name, default in self.defaults:
+            setattr(self, name, int(kwargs.pop(name, default)))
+        if kwargs:
+            raise TypeError("Unknown arguments: %s" % ', '.join(kwargs))
+
+
+class _Location(object):
+    """Stands in for a generated node when computing its index rows."""
+
+    def __init__(self, acl, parent):
+        if acl is not None:
+            self.__acl__ = acl
+        self.__parent__ = parent
+
+
+class _Generator(object):
+    def __init__(self, root, spec, password):
+        self.root_id = root.id
+        self.spec = spec
+        self.password = password
+        self.random = Random(spec.seed)
+        self.now = datetime.now()
+        self.stats = dict((name, 0) for name in (
+            'documents', 'files', 'images', 'users', 'groups', 'tags',
+            'local_roles'))
+
+        self.wf = get_workflow(Document())
+        if self.wf is not None:
+            states = [self.wf.initial_state]
+            if u'public' in self.wf._state_data:
+                states.append(u'public')
+            self.acls = dict(
+                (state, state_acl(self.wf, state)) for state in states)
+        else:
+            self.acls = {None: None}
+        self._decided = {}
+        self._derived = {}
+
+    def _next_id(self, column):
+        return (DBSession.execute(
+            select([func.max(column)])).scalar() or 0) + 1
+
+    def _insert(self, model, rows):
+        if rows:
+            DBSession.execute(model.__table__.insert(), rows)
+
+    def _date(self):
+        return self.now - timedelta(
+            seconds=self.random.randint(0, 3 * 365 * 24 * 3600))
+
+    def generate_principals(self):
+        """Insert users and groups.  All users share one password
+        hash, so that only one hash needs to be computed.
+        """
+        existing = set(r[0] for r in DBSession.query(Principal.name))
+        hashed = get_principals().hash_password(self.password)
+
+        groups = [u'group:generated-%d' % index
+                  for index in range(self.spec.groups)]
+        users = [u'generated-%d' % index for index in range(self.spec.users)]
+        # All rows of an insert need to have the same keys:
+        principal_rows, membership_rows = [], []
+        for name in groups:
+            if name not in existing:
+                self.stats['groups'] += 1
+                title = u'Generated group %s' % name[6:]
+                principal_rows.append(dict(
+                    name=name, title=title, email=None, password=None,
+                    active=True, creation_date=self.now,
+                    name_lower=name.lower(), title_lower=title.lower()))
+        for name in users:
+            if name in existing:
+                continue
+            self.stats['users'] += 1
+            title = u'Generated user %s' % name
+            principal_rows.append(dict(
+                name=name, title=title, email=u'%s@example.com' % name,
+                password=hashed, active=True, creation_date=self.now,
+                name_lower=name.lower(), title_lower=title.lower()))
+            if groups:
+                membership_rows.append(dict(
+                    principal_name=name,
+                    group_name=self.random.choice(groups), position=0))
+        self._insert(Principal, principal_rows)
+        self._insert(PrincipalGroup, membership_rows)
+        self.users, self.groups = users, groups
+
+    def generate_tags(self):
+        existing = dict((title, id) for id, title in DBSession.query(
+            Tag.id, Tag.title))
+        next_id = self._next_id(Tag.id)
+        rows = []
+        self.tag_ids = []
+        for index in range(self.spec.tags):
+            title = u'generated-tag-%d' % index
+            if title not in existing:
+                existing[title] = next_id
+                rows.append(dict(
+                    id=next_id, title=title, title_lower=title.lower()))
+                next_id += 1
+            self.tag_ids.append(existing[title])
+        self._insert(Tag, rows)
+        self.stats['tags'] = len(rows)
+        # Popular tags are used a lot more than others:
+        self.tag_weights = []
+        total = 0.0
+        for rank in range(len(self.tag_ids)):
+            total += 1.0 / (rank + 1)
+            self.tag_weights.append(total)
+
+    def _choose_tags(self):
+        if not self.tag_ids:
+            return []
+        tags = []
+        for i in range(self.random.randint(0, 3)):
+            index = bisect(self.tag_weights,
+                           self.random.random() * self.tag_weights[-1])
+            tag_id = self.tag_ids[min(index, len(self.tag_ids) - 1)]
+            if tag_id not in tags:
+                tags.append(tag_id)
+        return tags
+
+    def _index_rows(self, node_id, state, local_groups):
+        key = (state, id(local_groups))
+        cached = self._decided.get(key)
+        if cached is None:
+            # Keeping 'local_groups' in the cache keeps its id unique:
+            cached = self._decided[key] = (
+                local_groups, _decide(self._entries[state], local_groups))
+        return [dict(node_id=node_id, principal_name=unicode(name),
+                     position=position, allowed=allowed)
+                for name, (position, allowed) in cached[1].items()]
+
+    def _with_group(self, local_groups, principal, group):
+        """Return ``local_groups`` with ``group`` added for
+        ``principal``.  The same dict is returned for the same
+        arguments, so that :meth:`_index_rows` can cache by its id.
+        """
+        key = (id(local_groups), principal, group)
+        derived = self._derived.get(key)
+        if derived is None:
+            if group in local_groups.get(principal, ()):
+                groups = local_groups
+            else:
+                groups = dict((name, set(groups))
+                              for name, groups in local_groups.items())
+                groups.setdefault(principal, set()).add(group)
+            # Keeping 'local_groups' in the cache keeps its id unique:
+            derived = self._derived[key] = (local_groups, groups)
+        return derived[1]
+
+    def _parents(self, root_local_groups):
+        """Yield ``(parent id, position, local groups of the lineage)``
+        for each node to generate.  Documents are appended to
+        :attr:`folders` as they're generated, and get their children
+        in the order in which they were generated, which gives us a
+        tree of about the same depth as one with a constant fanout.
+        """
+        root_id = self.root_id
+        root_position = (DBSession.query(func.max(Node.position)).filter(
+            Node.parent_id == root_id).scalar() or 0) + 1
+        while True:
+            if not self.folders:
+                self.folders.append((root_id, root_local_groups))
+            parent_id, local_groups = self.folders.popleft()
+            if parent_id == root_id:
+                for position in range(root_position,
+                                      root_position + self.spec.fanout):
+                    yield parent_id, position, local_groups
+                root_position += self.spec.fanout
+            else:
+                children = int(self.random.expovariate(
+                    1.0 / self.spec.fanout))
+                for position in range(children):
+                    yield parent_id, position, local_groups
+
+    def _choose_type(self):
+        point = self.random.random() * 100
+        if point < self.spec.images:
+            return 'image'
+        elif point < self.spec.images + self.spec.files:
+            return 'file'
+        return 'document'
+
+    def _choose_state(self):
+        if self.wf is None:
+            return None
+        if (u'public' in self.acls and
+                self.random.random() * 100 < self.spec.public):
+            return u'public'
+        return self.wf.initial_state
+
+    def generate_nodes(self):
+        spec = self.spec
+        root_local_groups = {}
+        for name, group in DBSession.query(
+                LocalGroup.principal_name, LocalGroup.group_name).filter(
+                LocalGroup.node_id == self.root_id):
+            root_local_groups.setdefault(name, set()).add(group)
+        root = DBSession.query(Node).get(self.root_id)
+        self._entries = dict(
+            (state, _acl_entries(_Location(acl, root)))
+            for state, acl in self.acls.items())
+
+        self.folders = deque()
+        parents = self._parents(root_local_groups)
+        principals = self.users + self.groups
+        documents = spec.nodes * (100 - spec.files - spec.images) / 100.0
+        next_id = self._next_id(Node.id)
+        models = (Node, Content, Document, File, Image, TagsToContents,
+                  LocalGroup, AllowedPrincipal)
+        generated = 0
+
+        while generated < spec.nodes:
+            batch = dict((model, []) for model in models)
+            for i in range(min(spec.batch_size, spec.nodes - generated)):
+                parent_id, position, local_groups = parents.next()
+                node_id = next_id
+                next_id += 1
+                generated += 1
+                type = self._choose_type()
+                state = self._choose_state()
+                self.stats[type + 's'] += 1
+
+                created = self._date()
+                owner = self.random.choice(self.users) if self.users else None
+                if owner is not None:
+                    owned = self._with_group(
+                        local_groups, owner, u'role:owner')
+                    if owned is not local_groups:
+                        batch[LocalGroup].append(dict(
+                            node_id=node_id, principal_name=owner,
+                            group_name=u'role:owner'))
+                        local_groups = owned
+                batch[Node].append(dict(
+                    id=node_id, type=type, parent_id=parent_id,
+                    position=position, _acl=self.acls[state],
+                    name=u'%s-%d' % (type, node_id),
+                    title=u'%s %d' % (type.capitalize(), node_id),
+                    annotations={}))
+                batch[Content].append(dict(
+                    id=node_id, description=LOREM[:self.random.randint(
+                        20, len(LOREM))],
+                    language=u'en', owner=owner, state=state,
+                    creation_date=created, modification_date=created,
+                    in_navigation=True))
+                for tag_position, tag_id in enumerate(self._choose_tags()):
+                    batch[TagsToContents].append(dict(
+                        tag_id=tag_id, content_id=node_id,
+                        position=tag_position))
+
+                if type == 'document':
+                    batch[Document].append(dict(
+                        id=node_id, mime_type='text/html',
+                        body=u'<p>%s</p>' % (
+                            LOREM * int(self.random.expovariate(0.1) + 1))))
+                    if (self.stats['local_roles'] < spec.local_roles and
+                            principals and
+                            self.random.random() * documents <
+                            spec.local_roles):
+                        self.stats['local_roles'] += 1
+                        principal = self.random.choice(principals)
+                        role = self.random.choice(
+                            [u'role:viewer', u'role:editor'])
+                        batch[LocalGroup].append(dict(
+                            node_id=node_id, principal_name=principal,
+                            group_name=role))
+                        local_groups = self._with_group(
+                            local_groups, principal, role)
+                    self.folders.append((node_id, local_groups))
+                elif type == 'file':
+                    data = 'x' * min(int(self.random.lognormvariate(9, 1.5)),
+                                     MAX_FILE_SIZE)
+                    batch[File].append(dict(
+                        id=node_id, data=data, size=len(data),
+                        filename=u'file-%d.txt' % node_id,
+                        mimetype=u'text/plain'))
+                else:
+                    data = self.random.choice(self.images)
+                    batch[File].append(dict(
+                        id=node_id, data=data, size=len(data),
+                        filename=u'image-%d.png' % node_id,
+                        mimetype=u'image/png'))
+                    batch[Image].append(dict(id=node_id))
+
+                batch[AllowedPrincipal].extend(
+                    self._index_rows(node_id, state, local_groups))
+
+            for model in models:
+                self._insert(model, batch[model])
+            self.commit()
+
+    def commit(self):
+        mark_changed(DBSession())
+        transaction.commit()
+
+    def reset_sequences(self):
+        """Explicit ids don't advance PostgreSQL's sequences."""
+        bind = DBSession.get_bind(Node)
+        if bind.dialect.name != 'postgresql':
+            return
+        for table in (Node.__table__, Tag.__table__):
+            DBSession.execute(
+                "SELECT setval('%s_id_seq', (SELECT MAX(id) FROM %s))" % (
+                    table.name, table.name))
+        self.commit()
+
+    def generate(self):
+        self.images = [_png(self.random, 640, 480) for i in range(5)]
+        self.generate_principals()
+        self.generate_tags()
+        self.commit()
+        self.generate_nodes()
+        # The tag assignments were inserted behind the ORM's back:
+        recount_tags()
+        self.commit()
+        self.reset_sequences()
+        return self.stats
+
+
+def generate_site(root, spec=None, password=u'secret'):
+    """Add the content, users, groups, tags and local roles described
+    by ``spec`` to the site at ``root``.  Rows are written with
+    batched inserts and committed once per batch.  All generated users
+    have the same ``password``.  Return a dict with the number of
+    items generated by kind.
+    """
+    return _Generator(root, spec or GeneratorSpec(), password).generate()
+
+
+def generate_site_command():
+    __doc__ = """Add a large synthetic site to a Kotti database.
+
+    Content is added below the site's root, along with users, groups,
+    tags and local roles.  Object events are not fired, and rows are
+    committed in batches.
+
+    Usage:
+      kotti-generate-site <config_uri> [options]
+
+    Options:
+      --nodes=<n>          Number of content objects [default: 10000]
+      --fanout=<n>         Average number of children [default: 10]
+      --files=<pct>        Percentage of files [default: 10]
+      --images=<pct>       Percentage of images [default: 5]
+      --public=<pct>       Percentage of public content [default: 70]
+      --users=<n>          Number of users [default: 100]
+      --groups=<n>         Number of groups [default: 10]
+      --tags=<n>           Number of distinct tags [default: 200]
+      --local-roles=<n>    Number of local role assignments [default: 100]
+      --batch-size=<n>     Content objects per transaction [default: 1000]
+      --seed=<n>           Seed of the random generator [default: 0]
+      --password=<pw>      Password of the users [default: secret]
+      -h --help            Show this screen.
+    """
+
+    def generate(args):
+        spec = GeneratorSpec(**dict(
+            (name, args['--' + name.replace('_', '-')])
+            for name, default in GeneratorSpec.defaults))
+        stats = generate_site(
+            get_root(), spec, args['--password'].decode('utf-8'))
+        print ', '.join('%d %s' % (stats[name], name.replace('_', ' '))
+                        for name in sorted(stats))
+
+    return command(generate, __doc__)
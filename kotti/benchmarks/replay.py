@@ -0,0 +1,408 @@
+"""Replay a mix of requests against a Kotti site, in-process.
+
+A *mix* is a list of requests.  Each request is a dict with the keys
+``route`` (the name that the request is reported under), ``method``,
+``path``, ``params`` and ``user`` (``None`` for anonymous requests).
+Mixes are stored as files with one JSON object per line, so they can
+be recorded once and replayed after every change.  :func:`generate_mix`
+generates a mix from the content of a site, e.g. one that was made with
+``kotti-generate-site``.
+
+:func:`replay` sends the requests of a mix to the WSGI application
+directly, from a number of threads or processes, and returns the
+latency of each request.  :func:`summarize_replay` computes throughput
+and latency percentiles per route from that.
+"""
+
+from bisect import bisect
+from datetime import datetime
+import json
+from logging import getLogger
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import random
+import sys
+import time
+from urllib import urlencode
+try:  # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # pyflakes
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
+
+from docopt import docopt
+from pyramid.paster import bootstrap
+from pyramid.request import Request
+from pyramid.security import remember
+from pyramid.traversal import resource_path
+import transaction
+
+from kotti import DBSession
+from kotti import get_version
+from kotti.benchmarks.suite import _percentile
+from kotti.resources import Content
+from kotti.resources import Tag
+from kotti.security import Principal
+
+logger = getLogger(__name__)
+
+#: Routes of a generated mix and their relative weights
+MIX = OrderedDict([
+    ('view', 50),
+    ('view-authenticated', 15),
+    ('edit', 5),
+    ('edit-save', 5),
+    ('search', 15),
+    ('image-scale', 10),
+    ])
+
+#: Don't request more than this many different resources per route
+SAMPLE_SIZE = 100
+
+# The application and credentials used by the workers:
+_state = {}
+
+
+def _entry(route, path, method='GET', params=None, user=None):
+    return {
+        'route': route,
+        'method': method,
+        'path': path,
+        'params': params or {},
+        'user': user,
+        }
+
+
+class _MixGenerator(object):
+    def __init__(self, root, editor, seed):
+        self.root = root
+        self.editor = editor
+        self.random = random.Random(seed)
+
+        rows = DBSession.query(Content.id, Content.type, Content.state).all()
+        public = [row for row in rows if row.state in (None, u'public')]
+        self.viewable = self._sample(
+            [row.id for row in public or rows])
+        self.documents = self._sample(
+            [row.id for row in rows if row.type == 'document'])
+        self.images = self._sample(
+            [row.id for row in public or rows if row.type == 'image'])
+        self.users = [name for (name,) in DBSession.query(
+            Principal.name).filter(~Principal.name.startswith(u'group:'))
+            .order_by(Principal.name).limit(SAMPLE_SIZE)]
+        self.words = sorted(set(
+            word for (title,) in DBSession.query(Content.title).filter(
+                Content.id.in_(self.viewable))
+            for word in title.split()))
+        self.words.extend(
+            title for (title,) in DBSession.query(Tag.title).order_by(
+                Tag.id).limit(SAMPLE_SIZE))
+
+    def _sample(self, ids):
+        ids.sort()
+        return self.random.sample(ids, min(len(ids), SAMPLE_SIZE))
+
+    def _node(self, ids):
+        return DBSession.query(Content).get(self.random.choice(ids))
+
+    def _path(self, node, view=None):
+        path = resource_path(node)
+        if view is not None:
+            path = path.rstrip('/') + '/' + view
+        return path
+
+    def routes(self):
+        """Return the routes of :data:`MIX` that this site has the
+        content for.
+        """
+        available = {
+            'view': self.viewable,
+            'view-authenticated': self.viewable and self.users,
+            'edit': self.documents,
+            'edit-save': self.documents,
+            'search': self.words,
+            'image-scale': self.images,
+            }
+        return [route for route in MIX if available[route]]
+
+    def view(self):
+        return _entry('view', self._path(self._node(self.viewable)))
+
+    def view_authenticated(self):
+        return _entry('view-authenticated',
+                      self._path(self._node(self.viewable)),
+                      user=self.random.choice(self.users))
+
+    def edit(self):
+        return _entry('edit', self._path(self._node(self.documents), '@@edit'),
+                      user=self.editor)
+
+    def edit_save(self):
+        # Save the document as it is, so that replaying the mix doesn't
+        # change the site:
+        document = self._node(self.documents)
+        params = {
+            'title': document.title,
+            'description': document.description or u'',
+            'body': document.body or u'',
+            'tags': u','.join(document.tags),
+            'save': u'save',
+            }
+        return _entry('edit-save', self._path(document, '@@edit'), 'POST',
+                      params, self.editor)
+
+    def search(self):
+        return _entry('search', '/@@search-results', 'POST',
+                      {'search-term': self.random.choice(self.words)})
+
+    def image_scale(self):
+        return _entry('image-scale',
+                      self._path(self._node(self.images), 'image/span2'))
+
+    def generate(self, number):
+        routes = self.routes()
+        weights = []
+        total = 0
+        for route in routes:
+            total += MIX[route]
+            weights.append(total)
+        mix = []
+        for index in range(number):
+            route = routes[bisect(weights, self.random.random() * total)]
+            mix.append(getattr(self, route.replace('-', '_'))())
+        return mix
+
+
+def generate_mix(root, number=1000, editor=u'admin', seed=0):
+    """Return a mix of ``number`` requests for the content below
+    ``root``, in the proportions of :data:`MIX`.  Editing requests are
+    made as ``editor``, other authenticated requests as the first
+    :data:`SAMPLE_SIZE` users.
+    """
+    return _MixGenerator(root, editor, seed).generate(number)
+
+
+def load_mix(f):
+    """Return the mix in the file ``f``."""
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def dump_mix(mix, f):
+    """Write ``mix`` to the file ``f``."""
+    for entry in mix:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def authenticate(registry, users):
+    """Return a dict that maps ``users`` to tuples ``(cookie, token)``,
+    where ``cookie`` is the ``Cookie`` header that authenticates the
+    user with the authentication policy of ``registry`` and carries a
+    session, and ``token`` is the CSRF token in that session.  Users
+    don't need to log in (and don't need passwords) this way.
+    """
+    credentials = {}
+    for user in users:
+        request = Request.blank('/')
+        request.registry = registry
+        token = request.session.get_csrf_token()
+        request._process_response_callbacks(request.response)
+        cookies = [request.response.headers['Set-Cookie'],
+                   remember(request, user)[0][1]]
+        credentials[user] = (
+            '; '.join(cookie.split(';')[0] for cookie in cookies), token)
+    return credentials
+
+
+def make_request(entry, credentials):
+    """Return a request for the mix entry ``entry``, authenticated
+    with ``credentials`` (see :func:`authenticate`).
+    """
+    params = dict((key.encode('utf-8'), value.encode('utf-8'))
+                  for key, value in entry['params'].items())
+    path = entry['path'].encode('utf-8')
+    if entry['method'] == 'POST':
+        if entry['user'] is not None:
+            params['csrf_token'] = credentials[entry['user']][1]
+        request = Request.blank(path, POST=params)
+    else:
+        if params:
+            path += '?' + urlencode(params)
+        request = Request.blank(path)
+        request.method = entry['method'].encode('utf-8')
+    if entry['user'] is not None:
+        request.environ['HTTP_COOKIE'] = credentials[entry['user']][0]
+    return request
+
+
+def _replay_one(entry):
+    request = make_request(entry, _state['credentials'])
+    started = time.time()
+    try:
+        response = request.get_response(_state['app'])
+        response.body  # read the whole response
+        status = response.status_int
+    except Exception:
+        logger.exception("Error replaying %s %s" % (
+            entry['method'], entry['path']))
+        status = None
+    return entry['route'], status, time.time() - started
+
+
+def _init_process():
+    # Don't share the parent's database connections:
+    DBSession.remove()
+    DBSession.bind.dispose()
+
+
+def replay(app, mix, credentials, concurrency=1, processes=False):
+    """Send the requests of ``mix`` to ``app`` from ``concurrency``
+    threads (or processes, if ``processes`` is true).  With a
+    concurrency of ``1``, the requests are sent from the calling
+    thread.  ``credentials``
+    are the ones returned by :func:`authenticate` for the users in
+    ``mix``.
+
+    Return a tuple ``(results, seconds)``, where ``results`` is a list
+    of ``(route, status, seconds)`` tuples, one per request, and
+    ``seconds`` is the time it took to replay the whole mix.  The
+    status is ``None`` if the application raised an exception.
+    """
+    _state.update(app=app, credentials=credentials)
+    pool = None
+    if processes:
+        pool = Pool(concurrency, initializer=_init_process)
+    elif concurrency > 1:
+        pool = ThreadPool(concurrency)
+    try:
+        started = time.time()
+        if pool is None:
+            results = map(_replay_one, mix)
+        else:
+            results = pool.map(_replay_one, mix, chunksize=1)
+        seconds = time.time() - started
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _state.clear()
+    return results, seconds
+
+
+def _summarize(timings, errors, seconds):
+    timings = [timing * 1000 for timing in timings]
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'throughput': len(timings) / seconds if seconds else 0.0,
+        'p50': _percentile(timings, 50),
+        'p95': _percentile(timings, 95),
+        'p99': _percentile(timings, 99),
+        'max': max(timings),
+        }
+
+
+def summarize_replay(results, seconds):
+    """Return a dict that maps routes (and ``'all'``) to their number
+    of requests, number of errors (exceptions and responses with a
+    status of 500 or more), throughput in requests per second and
+    latency percentiles in milliseconds.
+
+      >>> results = [('view', 200, 0.01), ('view', 200, 0.03),
+      ...            ('search', 500, 0.1)]
+      >>> summary = summarize_replay(results, 0.5)
+      >>> summary['view']['requests'], summary['view']['throughput']
+      (2, 4.0)
+      >>> summary['all']['errors'], summary['all']['p50']
+      (1, 30.0)
+    """
+    by_route = OrderedDict()
+    for route, status, timing in results:
+        by_route.setdefault(route, []).append((status, timing))
+    by_route['all'] = [(status, timing) for route, status, timing in results]
+
+    summary = OrderedDict()
+    for route, entries in by_route.items():
+        errors = len([status for status, timing in entries
+                      if status is None or status >= 500])
+        summary[route] = _summarize(
+            [timing for status, timing in entries], errors, seconds)
+    return summary
+
+
+def format_summary(summary):
+    lines = ['%-20s %8s %6s %8s %9s %9s %9s' % (
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for route, result in summary.items():
+        lines.append('%-20s %8d %6d %8.1f %9.2f %9.2f %9.2f' % (
+            route, result['requests'], result['errors'],
+            result['throughput'], result['p50'], result['p95'],
+            result['p99']))
+    return '\n'.join(lines)
+
+
+def kotti_bench_command():
+    __doc__ = """Replay a mix of requests against a Kotti site in-process.
+
+    Usage:
+      kotti-bench [options] <config_uri>
+
+    Unless --mix is given, the mix is generated from the content of the
+    site.  Editing requests save documents without changing them.
+
+    Options:
+      --mix=<file>         Replay the requests in this file
+      --record=<file>      Write the generated mix to this file
+      --requests=<n>       Number of requests to generate [default: 1000]
+      --editor=<name>      User to make editing requests as [default: admin]
+      --seed=<n>           Seed for generating the mix [default: 0]
+      --concurrency=<n>    Number of threads [default: 1]
+      --processes          Use processes instead of threads
+      --warmup=<n>         Requests to make before measuring [default: 10]
+      --output=<file>      Write the results to this JSON file
+      -h --help            Show this screen.
+    """
+    args = docopt(__doc__)
+    env = bootstrap(args['<config_uri>'])
+    try:
+        if args['--mix']:
+            with open(args['--mix']) as f:
+                mix = load_mix(f)
+        else:
+            mix = generate_mix(
+                env['root'], int(args['--requests']),
+                args['--editor'].decode('utf-8'), int(args['--seed']))
+            if args['--record']:
+                with open(args['--record'], 'w') as f:
+                    dump_mix(mix, f)
+        users = set(entry['user'] for entry in mix) - set([None])
+        credentials = authenticate(env['registry'], users)
+        transaction.abort()
+    finally:
+        env['closer']()
+
+    if not mix:
+        print 'There are no requests to replay.'
+        return 1
+
+    replay(env['app'], mix[:int(args['--warmup'])], credentials)
+    results, seconds = replay(
+        env['app'], mix, credentials, int(args['--concurrency']),
+        args['--processes'])
+    summary = summarize_replay(results, seconds)
+    print format_summary(summary)
+
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump({
+                'kotti': get_version(),
+                'created': datetime.now().isoformat(),
+                'concurrency': int(args['--concurrency']),
+                'processes': args['--processes'],
+                'seconds': seconds,
+                'results': summary,
+                }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(kotti_bench_command())
@@ -0,0 +1,164 @@
+"""Build synthetic sites for benchmarking.
+
+A site is described by a :class:`SiteSpec` and built into an existing
+root with :func:`build_site`.  Given the same spec, the same site is
+built every time.
+"""
+
+from random import Random
+from StringIO import StringIO
+
+from PIL import Image as PILImage
+
+from kotti import DBSession
+from kotti.resources import Document
+from kotti.resources import File
+from kotti.resources import Image
+from kotti.security import get_principals
+from kotti.security import set_groups
+
+
+class SiteSpec(object):
+    """The size of a synthetic site.
+
+      >>> spec = SiteSpec(depth=2, fanout=3)
+      >>> spec.documents
+      12
+      >>> spec.as_dict()['users']
+      20
+    """
+
+    defaults = (
+        ('depth', 3),  # levels of documents below the root
+        ('fanout', 5),  # children of each document
+        ('users', 20),
+        ('groups', 5),
+        ('local_roles', 20),  # local role assignments
+        ('tags', 10),  # distinct tags; each document has up to 3
+        ('files', 10),
+        ('images', 5),
+        ('seed', 0),
+        )
+
+    def __init__(self, **kwargs):
+        for name, default in self.defaults:
+            setattr(self, name, int(kwargs.pop(name, default)))
+        if kwargs:
+            raise TypeError("Unknown arguments: %s" % ', '.join(kwargs))
+
+    @property
+    def documents(self):
+        return sum(self.fanout ** level
+                   for level in range(1, self.depth + 1))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name, default in self.defaults)
+
+
+class Site(object):
+    """What :func:`build_site` created."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        #: Paths of all documents, parents before their children
+        self.documents = []
+        #: Paths of the documents on the lowest level
+        self.leaves = []
+        self.files = []
+        self.images = []
+        self.users = []
+        self.groups = []
+
+
+def _png(random, width=1024, height=768):
+    color = tuple(random.randint(0, 255) for i in range(3))
+    out = StringIO()
+    PILImage.new('RGB', (width, height), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+def _path(node):
+    names = []
+    while node.parent is not None:
+        names.append(node.name)
+        node = node.parent
+    return u'/' + u'/'.join(reversed(names))
+
+
+def build_site(root, spec=None):
+    """Fill ``root`` with the documents, files, images, users, groups,
+    local roles and tags described by ``spec`` and return a
+    :class:`Site`.  Users are created without a password.
+    """
+    spec = spec or SiteSpec()
+    random = Random(spec.seed)
+    site = Site(spec)
+    tags = [u'tag-%d' % i for i in range(spec.tags)]
+
+    level = [root]
+    nodes = []
+    for depth in range(1, spec.depth + 1):
+        next_level = []
+        for parent in level:
+            for index in range(spec.fanout):
+                name = u'doc-%d-%d' % (depth, index)
+                doc = parent[name] = Document(
+                    title=u'Document %d on level %d' % (index, depth),
+                    description=u'A document for benchmarking',
+                    body=u'<p>%s</p>' % (u'Lorem ipsum dolor sit amet. ' * 20),
+                    )
+                if tags:
+                    doc.tags = random.sample(tags, min(3, len(tags)))
+                    # Tags are looked up in the database only, so new
+                    # ones have to be flushed before they're reused:
+                    DBSession.flush()
+                next_level.append(doc)
+        nodes.extend(next_level)
+        level = next_level
+
+    folders = [root] + nodes
+    files, images = [], []
+    for index in range(spec.files):
+        parent = random.choice(folders)
+        files.append(File(
+            data='x' * random.randint(1000, 100000),
+            filename=u'file-%d.txt' % index, mimetype=u'text/plain',
+            title=u'File %d' % index))
+        parent[u'file-%d' % index] = files[-1]
+    for index in range(spec.images):
+        parent = random.choice(folders)
+        images.append(Image(
+            data=_png(random), filename=u'image-%d.png' % index,
+            mimetype=u'image/png', title=u'Image %d' % index))
+        parent[u'image-%d' % index] = images[-1]
+    DBSession.flush()
+
+    principals = get_principals()
+    for index in range(spec.groups):
+        name = u'group:group-%d' % index
+        principals[name] = dict(name=name, title=u'Group %d' % index)
+        site.groups.append(name)
+    for index in range(spec.users):
+        name = u'user-%d' % index
+        groups = []
+        if site.groups:
+            groups.append(random.choice(site.groups))
+        principals[name] = dict(
+            name=name, title=u'User %d' % index,
+            email=u'user-%d@example.com' % index, groups=groups)
+        site.users.append(name)
+
+    principal_names = site.users + site.groups
+    for index in range(spec.local_roles):
+        if not principal_names or not nodes:
+            break
+        set_groups(random.choice(principal_names), random.choice(nodes),
+                   [random.choice([u'role:viewer', u'role:editor'])])
+    DBSession.flush()
+
+    site.documents = [_path(node) for node in nodes]
+    site.leaves = [_path(node) for node in level if node is not root]
+    site.files = [_path(node) for node in files]
+    site.images = [_path(node) for node in images]
+    return site
@@ -0,0 +1,374 @@
+"""Time Kotti's core operations against a synthetic site.
+
+Each benchmark is a function that's registered with the
+:func:`benchmark` decorator.  It receives a :class:`BenchmarkContext`,
+does any preparation that shouldn't be timed, and returns a callable
+that does the work that is timed, or ``None`` if the site has
+nothing to benchmark (e.g. no images).  Each iteration runs in its own
+transaction that's aborted afterwards, so every iteration starts with
+the same database and an empty session, like a request would.
+
+Results are written as JSON.  :func:`compare` compares two sets of
+results and reports regressions.
+"""
+
+from datetime import datetime
+import json
+import platform
+import sys
+import time
+try:  # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # pyflakes
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
+
+from docopt import docopt
+from pyramid import testing
+from pyramid.authentication import RemoteUserAuthenticationPolicy
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.request import Request
+from pyramid.session import UnencryptedCookieSessionFactoryConfig
+from pyramid.traversal import find_resource
+from sqlalchemy import create_engine
+import transaction
+
+from kotti import DBSession
+from kotti import _resolve_dotted
+from kotti import conf_defaults
+from kotti import get_version
+from kotti.benchmarks.site import SiteSpec
+from kotti.benchmarks.site import build_site
+from kotti.resources import get_root
+from kotti.resources import initialize_sql
+from kotti.security import has_permission
+from kotti.security import list_groups_callback
+
+#: Maps names of benchmarks to functions
+BENCHMARKS = OrderedDict()
+
+#: Version of the format of results
+FORMAT_VERSION = 1
+
+
+def benchmark(name):
+    """Register the decorated function as the benchmark ``name``."""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class BenchmarkContext(object):
+    def __init__(self, config, site, iteration):
+        self.config = config
+        self.site = site
+        self.iteration = iteration
+        self.root = get_root()
+        self.user = site.users[iteration % len(site.users)] if (
+            site.users) else None
+        self.request = self.make_request()
+
+    def make_request(self):
+        """Return a request authenticated as :attr:`user` and make it
+        the current request.
+        """
+        environ = {}
+        if self.user is not None:
+            environ['REMOTE_USER'] = self.user.encode('utf-8')
+        request = Request.blank('/', environ)
+        request.registry = self.config.registry
+        # Like after traversal; without a context the authentication
+        # callback would look up the root, which fails in the middle
+        # of a copy:
+        request.context = self.root
+        self.config.manager.get()['request'] = request
+        return request
+
+    def choose(self, paths):
+        """Return the resource at one of ``paths``, choosing a
+        different one for each iteration.
+        """
+        return find_resource(
+            self.root, paths[self.iteration % len(paths)].encode('utf-8'))
+
+
+@benchmark('traversal')
+def bench_traversal(ctx):
+    path = ctx.site.leaves[ctx.iteration % len(ctx.site.leaves)]
+    return lambda: find_resource(ctx.root, path.encode('utf-8'))
+
+
+@benchmark('has_permission')
+def bench_has_permission(ctx):
+    context = ctx.choose(ctx.site.leaves)
+    return lambda: has_permission('view', context, ctx.request)
+
+
+@benchmark('event_dispatch')
+def bench_event_dispatch(ctx):
+    from kotti.events import ObjectEvent
+    from kotti.events import notify
+    # No listeners are registered for the base class, so this measures
+    # the dispatch itself:
+    event = ObjectEvent(ctx.choose(ctx.site.leaves), ctx.request)
+
+    def dispatch():
+        for i in range(1000):
+            notify(event)
+    return dispatch
+
+
+@benchmark('nodes_tree')
+def bench_nodes_tree(ctx):
+    from kotti.views.util import nodes_tree
+    return lambda: nodes_tree(ctx.request, context=ctx.root).tolist()
+
+
+@benchmark('default_search_content')
+def bench_search(ctx):
+    from kotti.views.util import default_search_content
+    return lambda: default_search_content(u'level', ctx.request)
+
+
+@benchmark('contents')
+def bench_contents(ctx):
+    from kotti.views.edit.actions import contents
+    context = ctx.choose(ctx.site.documents[:ctx.site.spec.fanout])
+    return lambda: list(contents(context, ctx.request)['children'])
+
+
+@benchmark('copy_paste')
+def bench_copy_paste(ctx):
+    from kotti.views.edit.actions import NodeActions
+    source = ctx.choose(ctx.site.documents[:ctx.site.spec.fanout])
+    target = ctx.root
+    ctx.request.session['kotti.paste'] = ([source.id], 'copy')
+
+    def copy_paste():
+        NodeActions(target, ctx.request).paste_nodes()
+        DBSession.flush()
+    return copy_paste
+
+
+@benchmark('delete')
+def bench_delete(ctx):
+    node = ctx.choose(ctx.site.documents[:ctx.site.spec.fanout])
+
+    def delete():
+        del node.parent[node.name]
+        DBSession.flush()
+    return delete
+
+
+@benchmark('image_scaling')
+def bench_image_scaling(ctx):
+    from kotti.views.image import ImageView
+    if not ctx.site.images:
+        return None
+    image = ctx.choose(ctx.site.images)
+    return lambda: ImageView(image, ctx.request).image(subpath=['span2'])
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def summarize(timings):
+    """Return a dict of statistics about ``timings`` (in seconds).
+
+      >>> s = summarize([0.3, 0.1, 0.2])
+      >>> s['min'], s['median'], s['max'], s['number']
+      (0.1, 0.2, 0.3, 3)
+    """
+    return {
+        'number': len(timings),
+        'min': min(timings),
+        'median': _percentile(timings, 50),
+        'mean': sum(timings) / len(timings),
+        'max': max(timings),
+        }
+
+
+def _configure(db_url):
+    settings = conf_defaults.copy()
+    settings.update({
+        'kotti.secret': 'benchmarks',
+        'kotti.secret2': 'benchmarks',
+        'sqlalchemy.url': db_url,
+        })
+    _resolve_dotted(settings)
+    config = testing.setUp(settings=settings)
+    config.include('kotti.events')
+    config.include('kotti.security_index')
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    config.set_authentication_policy(
+        RemoteUserAuthenticationPolicy(callback=list_groups_callback))
+    config.set_session_factory(
+        UnencryptedCookieSessionFactoryConfig('benchmarks'))
+    config.commit()
+    initialize_sql(create_engine(db_url), drop_all=True)
+    return config
+
+
+def _teardown():
+    from kotti import events
+    from kotti import security
+
+    transaction.abort()
+    events.clear()
+    security.reset()
+    testing.tearDown()
+
+
+def run(spec=None, names=None, number=10, db_url='sqlite://'):
+    """Build a site after ``spec`` in the database at ``db_url`` (which
+    is emptied first!) and run the benchmarks ``names`` (default: all)
+    ``number`` times each.  Return the results as a dict.
+    """
+    spec = spec or SiteSpec()
+    names = names or list(BENCHMARKS)
+    config = _configure(db_url)
+    try:
+        started = time.time()
+        site = build_site(get_root(), spec)
+        transaction.commit()
+        build_seconds = time.time() - started
+
+        results = OrderedDict()
+        for name in names:
+            func = BENCHMARKS[name]
+            timings = []
+            for iteration in range(number):
+                transaction.begin()
+                try:
+                    timed = func(BenchmarkContext(config, site, iteration))
+                    if timed is None:
+                        break
+                    started = time.time()
+                    timed()
+                    timings.append(time.time() - started)
+                finally:
+                    transaction.abort()
+            if timings:
+                results[name] = summarize(timings)
+    finally:
+        _teardown()
+
+    return {
+        'format': FORMAT_VERSION,
+        'kotti': get_version(),
+        'python': platform.python_version(),
+        'database': db_url.split(':', 1)[0],
+        'created': datetime.now().isoformat(),
+        'spec': spec.as_dict(),
+        'build_seconds': build_seconds,
+        'results': results,
+        }
+
+
+def compare(old, new, threshold=0.1):
+    """Compare the median timings of two results.  Return a list of
+    ``(name, old median, new median, ratio, regressed)`` tuples, where
+    ``regressed`` is true if the new median is more than ``threshold``
+    slower than the old one.
+
+      >>> old = {'results': {'a': {'median': 1.0}, 'b': {'median': 1.0}}}
+      >>> new = {'results': {'a': {'median': 1.5}, 'b': {'median': 0.5}}}
+      >>> compare(old, new)
+      [('a', 1.0, 1.5, 1.5, True), ('b', 1.0, 0.5, 0.5, False)]
+    """
+    rows = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        old_median = old['results'][name]['median']
+        new_median = result['median']
+        ratio = new_median / old_median if old_median else float('inf')
+        rows.append((name, old_median, new_median, ratio,
+                     ratio > 1 + threshold))
+    return sorted(rows)
+
+
+def format_results(results):
+    lines = ['%-24s %10s %10s %10s' % ('benchmark', 'min ms', 'median ms',
+                                       'max ms')]
+    for name, result in results['results'].items():
+        lines.append('%-24s %10.2f %10.2f %10.2f' % (
+            name, result['min'] * 1000, result['median'] * 1000,
+            result['max'] * 1000))
+    return '\n'.join(lines)
+
+
+def format_comparison(rows):
+    lines = ['%-24s %10s %10s %8s' % ('benchmark', 'old ms', 'new ms',
+                                      'change')]
+    for name, old_median, new_median, ratio, regressed in rows:
+        lines.append('%-24s %10.2f %10.2f %+7.0f%%%s' % (
+            name, old_median * 1000, new_median * 1000, (ratio - 1) * 100,
+            ' REGRESSION' if regressed else ''))
+    return '\n'.join(lines)
+
+
+def kotti_benchmarks_command():
+    __doc__ = """Run Kotti's benchmarks against a synthetic site.
+
+    Usage:
+      kotti-benchmarks [options] [<benchmark>...]
+      kotti-benchmarks --list
+
+    The site is built in the database at --db, which is emptied first.
+
+    Options:
+      --db=<url>           Database URL [default: sqlite://]
+      --depth=<n>          Levels of documents [default: 3]
+      --fanout=<n>         Children per document [default: 5]
+      --users=<n>          Number of users [default: 20]
+      --groups=<n>         Number of groups [default: 5]
+      --local-roles=<n>    Number of local role assignments [default: 20]
+      --tags=<n>           Number of distinct tags [default: 10]
+      --files=<n>          Number of files [default: 10]
+      --images=<n>         Number of images [default: 5]
+      --number=<n>         Iterations per benchmark [default: 10]
+      --output=<file>      Write the results to this JSON file
+      --compare=<file>     Compare with the results in this JSON file
+      --threshold=<pct>    Slowdown that counts as a regression [default: 10]
+      --list               List the available benchmarks
+      -h --help            Show this screen.
+    """
+    args = docopt(__doc__)
+    if args['--list']:
+        print '\n'.join(BENCHMARKS)
+        return 0
+
+    unknown = set(args['<benchmark>']) - set(BENCHMARKS)
+    if unknown:
+        print 'Unknown benchmarks: %s' % ', '.join(sorted(unknown))
+        return 2
+
+    spec = SiteSpec(**dict(
+        (name, args['--' + name.replace('_', '-')])
+        for name, default in SiteSpec.defaults if name != 'seed'))
+    results = run(spec, args['<benchmark>'], int(args['--number']),
+                  args['--db'])
+    print format_results(results)
+
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            old = json.load(f)
+        rows = compare(old, results, float(args['--threshold']) / 100)
+        print
+        print format_comparison(rows)
+        if [row for row in rows if row[4]]:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(kotti_benchmarks_command())
@@ -20,6 +20,45 @@ Events of type ``ObjectEvent`` have ``object`` and ``request``
 attributes.  ``event.request`` may be ``None`` when no request is
 available.
 
+Object events are emitted for every single row that's inserted,
+updated or deleted.  Listeners that work on many objects at once can
+subscribe to *ObjectsInserted* and *ObjectsUpdated* instead, which are
+emitted once per flush with all objects that are about to be inserted
+or updated::
+
+  def documents_inserted_handler(event):
+      for document in event.of_type(Document):
+          print document, event.request
+  kotti.events.listeners[ObjectsInserted].append(
+      documents_inserted_handler)
+
+``event.objects`` maps the classes of the objects to lists of the
+objects of that class.
+
+Listeners that don't need to run inside the transaction, like ones
+that send mails or purge caches, can subscribe to be called after the
+transaction has been committed successfully instead::
+
+  kotti.events.after_commit_objectevent_listeners[
+      (ObjectInsert, Document)].append(document_insert_handler)
+
+``after_commit_listeners`` and ``after_commit_objectevent_listeners``
+work like ``listeners`` and ``objectevent_listeners``.  The events of
+a transaction are handed to a pool of ``kotti.after_commit_threads``
+worker threads once it's committed, so that the request doesn't wait
+for them.  At most ``kotti.after_commit_queue`` transactions wait
+for a worker; committing blocks when the queue is full.  The listeners
+of one transaction run in a new transaction of their own, in which
+``event.object`` is loaded again, unless it was deleted.  Delivery is
+best-effort: events that are still queued when the process exits
+normally are processed before it does, but those of a process that's
+killed are lost.  Set ``kotti.after_commit_threads`` to ``0`` to call
+the listeners in the committing thread instead.
+``event.request`` is the request that emitted the event, which has
+ended by then.  The registry of the application is the current
+registry, so ``get_settings()`` works as usual, but
+``get_current_request()`` returns ``None``.
+
 Notifying listeners of an event is as simple as calling the
 ``listeners_notify`` function::
 
@@ -37,7 +76,17 @@ Inheritance Diagram
 """
 
 from collections import defaultdict
+import atexit
+from copy import copy
 from datetime import datetime
+from logging import getLogger
+import os
+from Queue import Queue
+from threading import Lock
+from threading import Thread
+from threading import current_thread
+import time
+from weakref import WeakKeyDictionary
 try:  # pragma: no cover
     from collections import OrderedDict
     OrderedDict  # pyflakes
@@ -45,11 +94,23 @@ except ImportError:  # pragma: no cover
     from ordereddict import OrderedDict
 
 import sqlalchemy.event
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import mapper
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.exc import UnmappedInstanceError
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import select
+from pyramid.threadlocal import get_current_registry
 from pyramid.threadlocal import get_current_request
+from pyramid.threadlocal import manager
 from pyramid.security import authenticated_userid
+import transaction
+from zope.sqlalchemy import mark_changed
 
 from kotti import DBSession
+from kotti import get_settings
+from kotti.metrics import event_dispatch
 from kotti.resources import Node
 from kotti.resources import Content
 from kotti.resources import Tag
@@ -59,7 +120,14 @@ from kotti.security import list_groups
 from kotti.security import list_groups_raw
 from kotti.security import set_groups
 from kotti.security import Principal
-from kotti.security import get_principals
+from kotti.security import delete_memberships
+from kotti.util import command
+
+#: Number of tags that are updated or checked for orphans with one
+#: statement
+TAGS_BATCH_SIZE = 500
+
+logger = getLogger(__name__)
 
 
 class ObjectEvent(object):
@@ -92,11 +160,97 @@ class UserDeleted(ObjectEvent):
     pass
 
 
+class MembershipsDeleted(ObjectEvent):
+    """This event is emitted when all members of the group ``object``
+    are removed from it at once, without loading the memberships.
+    ``names`` is the set of names of the former members.
+    """
+    def __init__(self, object, names, request=None):
+        super(MembershipsDeleted, self).__init__(object, request)
+        self.names = names
+
+
+class ObjectsEvent(object):
+    """Base class of the events that are emitted once per flush for
+    many objects.  ``objects`` maps classes to the lists of objects of
+    exactly that class.
+    """
+    def __init__(self, objects, request=None):
+        self.objects = objects
+        self.request = request
+
+    def of_type(self, cls):
+        """Return the list of objects that are instances of ``cls``."""
+        result = []
+        for object_class, objects in self.objects.items():
+            if issubclass(object_class, cls):
+                result.extend(objects)
+        return result
+
+
+class ObjectsInserted(ObjectsEvent):
+    """This event is emitted before a flush that inserts objects into
+    the DB."""
+
+
+class ObjectsUpdated(ObjectsEvent):
+    """This event is emitted before a flush that updates objects in the
+    DB."""
+
+
 class DispatcherDict(defaultdict, OrderedDict):
+    """Maps keys to lists of handlers.  Which keys match an event
+    depends only on the types involved, so the matching keys are
+    cached per combination of types.  The cache is invalidated when
+    keys are added or removed; appending to the list of handlers of an
+    existing key needs no invalidation, because handlers are looked up
+    when the event is dispatched.
+    """
     def __init__(self, *args, **kwargs):
+        self._keys_cache = {}
         defaultdict.__init__(self, list)
         OrderedDict.__init__(self, *args, **kwargs)
 
+    def __setitem__(self, key, value):
+        super(DispatcherDict, self).__setitem__(key, value)
+        self._keys_cache = {}
+
+    def __delitem__(self, key):
+        super(DispatcherDict, self).__delitem__(key)
+        self._keys_cache = {}
+
+    def clear(self):
+        super(DispatcherDict, self).clear()
+        self._keys_cache = {}
+
+    def popitem(self, *args, **kwargs):
+        item = super(DispatcherDict, self).popitem(*args, **kwargs)
+        self._keys_cache = {}
+        return item
+
+    def _matches(self, key, types):
+        """Return whether the handlers of ``key`` are to be called for
+        events that involve ``types``.  ``key`` is a type or a tuple
+        with a type for each of ``types``; ``None`` matches any type.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        return all(key_type is None or issubclass(type_, key_type)
+                   for key_type, type_ in zip(key, types))
+
+    def _handlers(self, types):
+        # Another thread may invalidate the cache while we compute the
+        # keys; we then store them in the old cache, which is dropped.
+        cache = self._keys_cache
+        keys = cache.get(types)
+        if keys is None:
+            keys = cache[types] = [
+                key for key in self.keys() if self._matches(key, types)]
+        for key in keys:
+            # Don't create keys that were removed in the meantime:
+            for handler in dict.get(self, key, ()):
+                yield handler
+
 
 class Dispatcher(DispatcherDict):
     """Dispatches based on event type.
@@ -129,12 +283,18 @@ class Dispatcher(DispatcherDict):
       [1]
     """
     def __call__(self, event):
-        results = []
-        for event_type, handlers in self.items():
-            if isinstance(event, event_type):
-                for handler in handlers:
-                    results.append(handler(event))
-        return results
+        return [handler(event)
+                for handler in self._handlers((event.__class__,))]
+
+    def handles(self, event):
+        """Return whether dispatching ``event`` would call any
+        handlers, including those of nested dispatchers.
+        """
+        for handler in self._handlers((event.__class__,)):
+            if not isinstance(handler, DispatcherDict) or handler.handles(
+                    event):
+                return True
+        return False
 
 
 class ObjectEventDispatcher(DispatcherDict):
@@ -164,23 +324,187 @@ class ObjectEventDispatcher(DispatcherDict):
       ['base', 'sub', 'all']
     """
     def __call__(self, event):
-        results = []
-        for (evtype, objtype), handlers in self.items():
-            if (isinstance(event, evtype) and
-                    (objtype is None or isinstance(event.object, objtype))):
-                for handler in handlers:
-                    results.append(handler(event))
+        handlers = self._handlers((event.__class__, event.object.__class__))
+        if not event_dispatch.enabled:
+            return [handler(event) for handler in handlers]
+        started = time.time()
+        results = [handler(event) for handler in handlers]
+        event_dispatch.observe(
+            time.time() - started, event=event.__class__.__name__)
         return results
 
+    def handles(self, event):
+        """Return whether dispatching ``event`` would call any
+        handlers.
+        """
+        for handler in self._handlers(
+                (event.__class__, event.object.__class__)):
+            return True
+        return False
+
 
 def clear():
     listeners.clear()
     objectevent_listeners.clear()
+    after_commit_listeners.clear()
+    after_commit_objectevent_listeners.clear()
     listeners[ObjectEvent].append(objectevent_listeners)
+    listeners[object].append(_defer_after_commit)
+    after_commit_listeners[ObjectEvent].append(
+        after_commit_objectevent_listeners)
 
 listeners = Dispatcher()
 notify = listeners.__call__
 objectevent_listeners = ObjectEventDispatcher()
+after_commit_listeners = Dispatcher()
+after_commit_objectevent_listeners = ObjectEventDispatcher()
+
+
+def _defer_after_commit(event):
+    if not after_commit_listeners.handles(event):
+        return
+    txn = transaction.get()
+    for hook, args, kws in txn.getAfterCommitHooks():
+        if hook is _after_commit:
+            args[0].append(event)
+            return
+    txn.addAfterCommitHook(
+        _after_commit, ([event], get_current_registry()))
+
+
+def _current(obj):
+    # Objects are detached and expired after the commit, so we load
+    # them again in the current session:
+    try:
+        object_mapper(obj)
+    except UnmappedInstanceError:
+        return obj
+    key = instance_state(obj).key
+    if key is None:
+        return obj
+    current = DBSession.query(key[0]).get(key[1])
+    return obj if current is None else current
+
+
+def _reloaded(event):
+    if isinstance(event, ObjectEvent):
+        event = copy(event)
+        event.object = _current(event.object)
+    elif isinstance(event, ObjectsEvent):
+        event = copy(event)
+        event.objects = OrderedDict(
+            (cls, [_current(obj) for obj in objects])
+            for cls, objects in event.objects.items())
+    return event
+
+
+def run_after_commit_listeners(events, registry=None):
+    """Call the after-commit listeners of ``events`` in a new
+    transaction.  Errors are logged, and abort the transaction.
+
+    ``registry`` is made the current registry while the listeners are
+    called, so that they can use ``get_settings()`` and the like from
+    worker threads.  There's no current request.
+    """
+    if registry is None:
+        registry = get_current_registry()
+    manager.push({'registry': registry, 'request': None})
+    try:
+        with transaction.manager:
+            for event in events:
+                after_commit_listeners(_reloaded(event))
+    except Exception:
+        logger.exception('Error in after-commit listener')
+    finally:
+        manager.pop()
+
+
+class _WorkerPool(object):
+    def __init__(self, threads, size):
+        self.queue = Queue(size)
+        self.threads = []
+        for i in range(threads):
+            thread = Thread(target=self._work,
+                            name='kotti-after-commit-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                run_after_commit_listeners(*item)
+            finally:
+                self.queue.task_done()
+
+    def put(self, events, registry):
+        if current_thread() in self.threads:
+            # Waiting for a worker in a worker could wait forever:
+            run_after_commit_listeners(events, registry)
+        else:
+            self.queue.put((events, registry))
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+
+def _get_pool():
+    """Return the pool of worker threads, or ``None`` if after-commit
+    listeners are to be called in the thread that committed.
+
+    The pool is created lazily, and created anew in processes that
+    were forked off after it had been created.
+    """
+    global _pool, _pool_pid
+    settings = get_settings()
+    threads = int(settings.get('kotti.after_commit_threads') or 0)
+    if threads <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = _WorkerPool(threads, int(
+                settings.get('kotti.after_commit_queue') or 0))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def shutdown():
+    """Wait for the worker threads to process the events that are
+    queued, and stop them.  This is called when the interpreter exits.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.stop()
+        _pool = _pool_pid = None
+
+
+# The worker threads are daemon threads, which would otherwise be
+# killed with the events in the queue:
+atexit.register(shutdown)
+
+
+def _after_commit(status, events, registry):
+    if not status:
+        return
+    pool = _get_pool()
+    if pool is None:
+        run_after_commit_listeners(events, registry)
+    else:
+        pool.put(events, registry)
+
+
 clear()
 
 
@@ -202,6 +526,24 @@ def _after_delete(mapper, conection, target):
     notify(ObjectAfterDelete(target, get_current_request()))
 
 
+def _by_type(objects):
+    grouped = OrderedDict()
+    for obj in objects:
+        grouped.setdefault(obj.__class__, []).append(obj)
+    return grouped
+
+
+def _before_flush(session, flush_context, instances):
+    request = get_current_request()
+    new = sorted(session.new, key=lambda obj: instance_state(obj).insert_order)
+    if new:
+        notify(ObjectsInserted(_by_type(new), request))
+    dirty = [obj for obj in session.dirty
+             if session.is_modified(obj, include_collections=False)]
+    if dirty:
+        notify(ObjectsUpdated(_by_type(dirty), request))
+
+
 def set_owner(event):
     obj, request = event.object, event.request
     if request is not None and isinstance(obj, Node) and obj.owner is None:
@@ -216,19 +558,188 @@ def set_owner(event):
                 set_groups(userid, obj, groups)
 
 
+def set_owners(event):
+    """Like :func:`set_owner`, but for all content that's inserted with
+    one flush.  Nodes don't get the owner role if they inherit it from
+    their parent, which is looked up once per parent.
+    """
+    if event.request is None:
+        return
+    nodes = [obj for obj in event.of_type(Content) if obj.owner is None]
+    if not nodes:
+        return
+    userid = authenticated_userid(event.request)
+    if userid is None:
+        return
+    userid = unicode(userid)
+
+    # Nodes compare equal by id, which new nodes don't have yet, so
+    # we keep track of them by identity:
+    owned = set(id(node) for node in nodes)
+    inherited = {}
+    for node in nodes:
+        node.owner = userid
+        parent = node.parent
+        if id(parent) in owned:
+            # The parent gets or inherits the role in this flush:
+            continue
+        if parent is not None and id(parent) not in inherited:
+            inherited[id(parent)] = u'role:owner' in list_groups(
+                userid, parent)
+        if not inherited.get(id(parent)):
+            DBSession.add(LocalGroup(node, userid, u'role:owner'))
+
+
 def set_creation_date(event):
     obj = event.object
     if obj.creation_date is None:
         obj.creation_date = obj.modification_date = datetime.now()
 
 
+def set_creation_dates(event):
+    now = datetime.now()
+    for obj in event.of_type(Content):
+        if obj.creation_date is None:
+            obj.creation_date = obj.modification_date = now
+
+
 def set_modification_date(event):
     event.object.modification_date = datetime.now()
 
 
+def set_modification_dates(event):
+    now = datetime.now()
+    for obj in event.of_type(Content):
+        obj.modification_date = now
+
+
+class _PendingTagChanges(object):
+    def __init__(self):
+        self.inserted = set()
+        self.deleted = set()
+        self.orphan_candidates = set()
+
+
+_pending_tags = WeakKeyDictionary()
+
+
+def _pending_tags_for(obj):
+    session = DBSession.object_session(obj) or DBSession()
+    pending = _pending_tags.get(session)
+    if pending is None:
+        pending = _pending_tags[session] = _PendingTagChanges()
+    return pending
+
+
+def count_tag_assignment(event):
+    """Remember an inserted tag assignment, so that the
+    :attr:`~kotti.resources.Tag.usage_count` of its tag is increased
+    at the end of the flush.
+    """
+    assignment = event.object
+    session = DBSession.object_session(assignment) or DBSession()
+    key = object_mapper(assignment).identity_key_from_instance(assignment)
+    if session.identity_map.get(key) not in (None, assignment):
+        # SQLAlchemy turns the deletion of an assignment and the
+        # insertion of one with the same key into an update, and we
+        # won't see the deletion:
+        return
+    _pending_tags_for(assignment).inserted.add(assignment)
+
+
+def uncount_tag_assignment(event):
+    """Remember the tag of a deleted tag assignment, so that its
+    :attr:`~kotti.resources.Tag.usage_count` is decreased at the end of
+    the flush.
+    """
+    _pending_tags_for(event.object).deleted.add(event.object)
+
+
 def delete_orphaned_tags(event):
-    DBSession.query(Tag).filter(~Tag.content_tags.any()).delete(
-        synchronize_session=False)
+    """Remember the tag of a deleted tag assignment.  Once the flush is
+    done, the tags that were remembered and are no longer assigned to
+    any content are deleted, with one statement per flush.
+    """
+    assignment = event.object
+    _pending_tags_for(assignment).orphan_candidates.add(assignment.tag_id)
+
+
+def _batches(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), TAGS_BATCH_SIZE):
+        yield ids[start:start + TAGS_BATCH_SIZE]
+
+
+def _update_usage_counts(session, deltas):
+    tags = Tag.__table__
+    by_delta = defaultdict(list)
+    for tag_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(tag_id)
+    for delta, tag_ids in sorted(by_delta.items()):
+        for batch in _batches(tag_ids):
+            session.execute(tags.update().where(tags.c.id.in_(batch)).values(
+                usage_count=tags.c.usage_count + delta))
+    # Loaded tags get the new count from the database when accessed:
+    for tag_id in deltas:
+        tag = session.identity_map.get(identity_key(Tag, tag_id))
+        if tag is not None:
+            session.expire(tag, ['usage_count'])
+
+
+def _delete_orphans(session, tag_ids=None):
+    tags = Tag.__table__
+    assignments = TagsToContents.__table__
+    orphaned = ~sqlalchemy.exists().where(assignments.c.tag_id == tags.c.id)
+    if tag_ids is None:
+        return session.execute(tags.delete().where(orphaned)).rowcount
+    count = 0
+    for batch in _batches(tag_ids):
+        count += session.execute(tags.delete().where(
+            tags.c.id.in_(batch)).where(orphaned)).rowcount
+    return count
+
+
+def _after_flush_postexec(session, flush_context):
+    # This runs after new tags became persistent, so that their counts
+    # can be expired.
+    pending = _pending_tags.pop(session, None)
+    if pending is None:
+        return
+
+    deltas = {}
+    for assignment in pending.inserted:
+        deltas[assignment.tag_id] = deltas.get(assignment.tag_id, 0) + 1
+    for assignment in pending.deleted:
+        deltas[assignment.tag_id] = deltas.get(assignment.tag_id, 0) - 1
+    _update_usage_counts(session, deltas)
+    if pending.orphan_candidates:
+        _delete_orphans(session, pending.orphan_candidates)
+
+
+def delete_all_orphaned_tags():
+    """Delete all tags that aren't assigned to any content and return
+    their number.  Tags are deleted as soon as they become orphans
+    anyway; this is for cleaning up after changes that bypassed the
+    ORM, like bulk deletes with SQL.
+    """
+    session = DBSession()
+    count = _delete_orphans(session)
+    mark_changed(session)
+    return count
+
+
+def recount_tags():
+    """Recompute the :attr:`~kotti.resources.Tag.usage_count` of all
+    tags, e.g. after changes to tag assignments that bypassed the ORM.
+    """
+    tags = Tag.__table__
+    assignments = TagsToContents.__table__
+    session = DBSession()
+    session.execute(tags.update().values(usage_count=select(
+        [sqlalchemy.func.count(assignments.c.content_id)],
+        assignments.c.tag_id == tags.c.id).as_scalar()))
+    mark_changed(session)
 
 
 def cleanup_user_groups(event):
@@ -237,10 +748,9 @@ def cleanup_user_groups(event):
     name = event.object.name
 
     if name.startswith("group:"):
-        principals = get_principals()
-        users_groups = [p for p in principals if name in principals[p].groups]
-        for user_or_group in users_groups:
-            principals[user_or_group].groups.remove(name)
+        names = delete_memberships(name)
+        if names:
+            notify(MembershipsDeleted(event.object, names, event.request))
 
     DBSession.query(LocalGroup).filter(
         LocalGroup.principal_name == name).delete()
@@ -254,6 +764,24 @@ def reset_content_owner(event):
         content.owner = None
 
 
+def delete_orphaned_tags_command():
+    __doc__ = """Delete all tags that aren't assigned to any content and
+    recount the usage of the remaining ones.
+
+    Usage:
+      kotti-delete-orphaned-tags <config_uri>
+
+    Options:
+      -h --help          Show this screen.
+    """
+
+    def delete(args):
+        print 'Deleted %d orphaned tags.' % delete_all_orphaned_tags()
+        recount_tags()
+        transaction.commit()
+    return command(delete, __doc__)
+
+
 _WIRED_SQLALCHMEY = False
 
 
@@ -267,22 +795,25 @@ def wire_sqlalchemy():  # pragma: no cover
     sqlalchemy.event.listen(mapper, 'before_update', _before_update)
     sqlalchemy.event.listen(mapper, 'before_delete', _before_delete)
     sqlalchemy.event.listen(mapper, 'after_delete', _after_delete)
+    sqlalchemy.event.listen(Session, 'before_flush', _before_flush)
+    sqlalchemy.event.listen(
+        Session, 'after_flush_postexec', _after_flush_postexec)
 
 
 def includeme(config):
-    from kotti.workflow import initialize_workflow
+    from kotti.workflow import initialize_workflows
 
     wire_sqlalchemy()
+    listeners[ObjectsInserted].append(set_owners)
+    listeners[ObjectsInserted].append(set_creation_dates)
+    listeners[ObjectsUpdated].append(set_modification_dates)
+    listeners[ObjectsInserted].append(initialize_workflows)
     objectevent_listeners[
-        (ObjectInsert, Content)].append(set_owner)
+        (ObjectInsert, TagsToContents)].append(count_tag_assignment)
     objectevent_listeners[
-        (ObjectInsert, Content)].append(set_creation_date)
-    objectevent_listeners[
-        (ObjectUpdate, Content)].append(set_modification_date)
+        (ObjectAfterDelete, TagsToContents)].append(uncount_tag_assignment)
     objectevent_listeners[
         (ObjectAfterDelete, TagsToContents)].append(delete_orphaned_tags)
-    objectevent_listeners[
-        (ObjectInsert, Content)].append(initialize_workflow)
     objectevent_listeners[
         (UserDeleted, Principal)].append(cleanup_user_groups)
     objectevent_listeners[
@@ -0,0 +1,414 @@
+"""Per-request statistics about the SQL statements that Kotti issues.
+
+Include ``kotti.instrumentation`` (e.g. through ``pyramid.includes``)
+to have the number of queries, the total time spent in the database
+and the slowest statements recorded for every request.  They're made
+available in three ways:
+
+  - as a :class:`QueryStats` object in the WSGI environ under the
+    ``kotti.sql_stats`` key,
+
+  - as a log line of the form ``sql_stats method=GET path=/
+    queries=12 time_ms=8.1`` that's sent to the ``kotti.sql`` logger
+    on the ``INFO`` level (the slowest statements are logged on the
+    ``DEBUG`` level),
+
+  - and if ``kotti.sql_stats_headers`` is true, as the
+    ``X-Kotti-Queries`` and ``X-Kotti-Query-Time`` response headers.
+
+``kotti.sql_stats_slowest`` sets the number of slowest statements
+that are kept (default: ``5``).
+
+Statements are recorded with listeners on SQLAlchemy's ``Engine``
+class, so queries that are issued outside of a request aren't
+counted.  Use :func:`collect` to record statements elsewhere, e.g. in
+tests or scripts.
+
+Include ``kotti.instrumentation.includeme_phase_timing`` to have the
+time that each request spends in these phases measured:
+
+  - ``traversal``: from the start of the request until the context
+    is found (``ContextFound``),
+
+  - ``authorization``: in the authentication and authorization
+    policies, i.e. in ACL checks and in looking up groups,
+
+  - ``view``: in the view callable, until rendering starts
+    (``BeforeRender``),
+
+  - ``render``: in the renderer, until the response is created
+    (``NewResponse``),
+
+  - ``slots``: in rendering the views in slots (which happens while
+    rendering the main template).
+
+Phases are measured exclusively: time spent in ``authorization`` is
+not counted towards ``view``.  Use :func:`phase` or
+``api.timing(name)`` in templates' code to measure phases of your
+own.  The timings are passed to each of the *sinks* listed in
+``kotti.phase_timing_sinks``.  A sink is a callable that's called
+with ``(request, phases, total)``, where ``phases`` is a list of
+``(name, seconds)`` tuples.  Kotti comes with :func:`log_phases`
+(the default) and :data:`ring_buffer`.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from heapq import heappush
+from heapq import heappushpop
+from logging import getLogger
+from threading import local
+import time
+
+import sqlalchemy.event
+from paste.deploy.converters import asbool
+from pyramid.events import BeforeRender
+from pyramid.events import ContextFound
+from pyramid.events import NewResponse
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.interfaces import IAuthorizationPolicy
+from pyramid.util import DottedNameResolver
+from sqlalchemy.engine import Engine
+
+ENVIRON_KEY = 'kotti.sql_stats'
+PHASES_ENVIRON_KEY = 'kotti.phase_timings'
+
+logger = getLogger('kotti.sql')
+timing_logger = getLogger('kotti.timing')
+
+_current = local()
+
+
+class QueryStats(object):
+    """Statistics about the statements that were executed while
+    handling a request.
+    """
+
+    def __init__(self, keep_slowest=5, parent=None):
+        #: Number of statements executed
+        self.count = 0
+        #: Total time spent executing statements, in seconds
+        self.duration = 0.0
+        self.keep_slowest = keep_slowest
+        self.parent = parent
+        self._slowest = []
+
+    def add(self, statement, duration):
+        if self.parent is not None:
+            self.parent.add(statement, duration)
+        self.count += 1
+        self.duration += duration
+        if self.keep_slowest <= 0:
+            return
+        entry = (duration, self.count, statement)
+        if len(self._slowest) < self.keep_slowest:
+            heappush(self._slowest, entry)
+        else:
+            heappushpop(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        """A list of ``(duration, statement)`` tuples for the slowest
+        statements, slowest first.
+        """
+        return [(duration, statement) for duration, count, statement
+                in sorted(self._slowest, reverse=True)]
+
+    def __repr__(self):  # pragma: no cover
+        return '<QueryStats count=%d time_ms=%.1f>' % (
+            self.count, self.duration * 1000)
+
+
+def current_stats():
+    """Return the :class:`QueryStats` that statements in this thread
+    are currently recorded in, or ``None``.
+    """
+    return getattr(_current, 'stats', None)
+
+
+@contextmanager
+def collect(keep_slowest=5):
+    """Record all statements that this thread executes in the
+    ``with`` block into a new :class:`QueryStats`::
+
+      with collect() as stats:
+          root[u'about'].children
+      assert stats.count == 1
+
+    Statements are also recorded in the stats of enclosing ``collect``
+    blocks.
+    """
+    wire_sqlalchemy()
+    previous = current_stats()
+    _current.stats = stats = QueryStats(keep_slowest, parent=previous)
+    try:
+        yield stats
+    finally:
+        _current.stats = previous
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('kotti_query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current_stats()
+    starts = conn.info.get('kotti_query_start')
+    if stats is not None and starts:
+        stats.add(statement, time.time() - starts.pop())
+
+
+_WIRED_SQLALCHEMY = False
+
+
+def wire_sqlalchemy():
+    global _WIRED_SQLALCHEMY
+    if _WIRED_SQLALCHEMY:
+        return
+    else:
+        _WIRED_SQLALCHEMY = True
+    sqlalchemy.event.listen(
+        Engine, 'before_cursor_execute', _before_cursor_execute)
+    sqlalchemy.event.listen(
+        Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def sql_stats_tween_factory(handler, registry):
+    settings = registry.settings
+    add_headers = asbool(settings.get('kotti.sql_stats_headers', False))
+    keep_slowest = int(settings.get('kotti.sql_stats_slowest') or 5)
+
+    def sql_stats_tween(request):
+        with collect(keep_slowest) as stats:
+            request.environ[ENVIRON_KEY] = stats
+            response = handler(request)
+
+        if add_headers:
+            response.headers['X-Kotti-Queries'] = str(stats.count)
+            response.headers['X-Kotti-Query-Time'] = '%.1f' % (
+                stats.duration * 1000)
+        logger.info(
+            'sql_stats method=%s path=%s queries=%d time_ms=%.1f',
+            request.method, request.path, stats.count,
+            stats.duration * 1000)
+        for duration, statement in stats.slowest:
+            logger.debug('sql_stats_slow time_ms=%.1f statement=%r',
+                         duration * 1000, statement)
+        return response
+
+    return sql_stats_tween
+
+
+def includeme(config):
+    wire_sqlalchemy()
+    config.add_tween('kotti.instrumentation.sql_stats_tween_factory')
+
+
+class PhaseTimer(object):
+    """Measures the time that a request spends in each phase.
+
+    Phases can be nested; a phase's time doesn't include the time
+    spent in the phases nested inside of it.
+    """
+
+    def __init__(self, request, phase='traversal'):
+        self.request = request
+        self.started = self._since = time.time()
+        self.finished = None
+        self.durations = {}
+        self.order = []
+        self._stack = [phase]
+
+    def _account(self):
+        now = time.time()
+        name = self._stack[-1]
+        if name not in self.durations:
+            self.durations[name] = 0.0
+            self.order.append(name)
+        self.durations[name] += now - self._since
+        self._since = now
+
+    def switch(self, name):
+        """End the current top-level phase and start the ``name``
+        phase.
+        """
+        if self.finished is None:
+            self._account()
+            self._stack[0] = name
+
+    def enter(self, name):
+        if self.finished is None:
+            self._account()
+            self._stack.append(name)
+
+    def exit(self):
+        if self.finished is None and len(self._stack) > 1:
+            self._account()
+            self._stack.pop()
+
+    def finish(self):
+        if self.finished is None:
+            self._account()
+            self.finished = self._since
+
+    @property
+    def phases(self):
+        """A list of ``(name, seconds)`` tuples in the order in which
+        the phases started.
+        """
+        return [(name, self.durations[name]) for name in self.order]
+
+    @property
+    def total(self):
+        return (self.finished or time.time()) - self.started
+
+
+def current_timer():
+    """Return the :class:`PhaseTimer` of the request that this thread
+    currently handles, or ``None``.
+    """
+    return getattr(_current, 'timer', None)
+
+
+@contextmanager
+def phase(name):
+    """Count the time spent in the ``with`` block towards the ``name``
+    phase of the current request.  Does nothing if phase timing is
+    not enabled.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.exit()
+
+
+class TimedPolicy(object):
+    """Wraps an authentication or authorization policy and counts the
+    time spent in its ``methods`` towards the ``authorization``
+    phase.
+    """
+
+    def __init__(self, policy, methods):
+        self.policy = policy
+        self.methods = methods
+
+    def __getattr__(self, name):
+        attr = getattr(self.policy, name)
+        if name not in self.methods:
+            return attr
+
+        def timed(*args, **kwargs):
+            with phase('authorization'):
+                return attr(*args, **kwargs)
+        return timed
+
+
+_TIMED_POLICY_METHODS = (
+    (IAuthenticationPolicy, ('authenticated_userid', 'effective_principals')),
+    (IAuthorizationPolicy, ('permits', 'principals_allowed_by_permission')),
+    )
+
+
+def log_phases(request, phases, total):
+    """A sink that logs a line of the form ``phase_timing method=GET
+    path=/ total_ms=25.3 traversal_ms=1.2 view_ms=8.0 ...`` to the
+    ``kotti.timing`` logger.
+    """
+    timing_logger.info(
+        'phase_timing method=%s path=%s total_ms=%.1f %s',
+        request.method, request.path, total * 1000,
+        ' '.join('%s_ms=%.1f' % (name, duration * 1000)
+                 for name, duration in phases))
+
+
+class RingBuffer(object):
+    """A sink that keeps the timings of the last ``size`` requests in
+    memory.
+    """
+
+    def __init__(self, size=100):
+        self.entries = deque(maxlen=size)
+
+    def __call__(self, request, phases, total):
+        self.entries.append({
+            'method': request.method,
+            'path': request.path,
+            'total': total,
+            'phases': phases,
+            })
+
+    def clear(self):
+        self.entries.clear()
+
+
+#: A :class:`RingBuffer` sink for the last 100 requests.  Use
+#: ``kotti.instrumentation.ring_buffer`` in ``kotti.phase_timing_sinks``.
+ring_buffer = RingBuffer()
+
+
+def _timer_for(request):
+    timer = current_timer()
+    if timer is not None and timer.request is request:
+        return timer
+
+
+def _context_found(event):
+    timer = _timer_for(event.request)
+    if timer is not None:
+        timer.switch('view')
+
+
+def _before_render(event):
+    timer = _timer_for(event.get('request'))
+    if timer is not None:
+        timer.switch('render')
+
+
+def _new_response(event):
+    timer = _timer_for(event.request)
+    if timer is not None:
+        timer.finish()
+
+
+def phase_timing_tween_factory(handler, registry):
+    settings = registry.settings
+    sinks = settings.get('kotti.phase_timing_sinks', [log_phases])
+    if isinstance(sinks, basestring):
+        sinks = [DottedNameResolver(None).resolve(name)
+                 for name in sinks.split()]
+
+    # The policies are final once the application is configured,
+    # which is when tween factories are called:
+    for iface, methods in _TIMED_POLICY_METHODS:
+        policy = registry.queryUtility(iface)
+        if policy is not None and not isinstance(policy, TimedPolicy):
+            registry.registerUtility(TimedPolicy(policy, methods), iface)
+
+    def phase_timing_tween(request):
+        previous = current_timer()
+        _current.timer = timer = PhaseTimer(request)
+        request.environ[PHASES_ENVIRON_KEY] = timer
+        try:
+            return handler(request)
+        finally:
+            timer.finish()
+            _current.timer = previous
+            for sink in sinks:
+                sink(request, timer.phases, timer.total)
+
+    return phase_timing_tween
+
+
+def includeme_phase_timing(config):
+    config.add_subscriber(_context_found, ContextFound)
+    config.add_subscriber(_before_render, BeforeRender)
+    config.add_subscriber(_new_response, NewResponse)
+    config.add_tween('kotti.instrumentation.phase_timing_tween_factory')
@@ -0,0 +1,311 @@
+"""A small, in-process registry of metrics that can be exported in
+the `Prometheus text format`_.
+
+Kotti records these metrics:
+
+  - ``kotti_request_duration_seconds``: a histogram of request
+    latency per view name,
+
+  - ``kotti_db_queries_total`` and ``kotti_db_query_seconds_total``:
+    the number of SQL queries executed in requests and the time
+    spent in them,
+
+  - ``kotti_cache_requests_total``: lookups in the ``request_cache``
+    and ``lru_cache`` caches of :mod:`kotti.util` by result (``hit``
+    or ``miss``),
+
+  - ``kotti_image_scales_total``: images scaled, by scale,
+
+  - ``kotti_blob_bytes_served_total``: bytes of file and image data
+    served,
+
+  - ``kotti_event_dispatch_seconds``: a histogram of the time spent
+    in object event listeners, per event type.
+
+Metrics are only recorded when ``kotti.metrics`` is included through
+``pyramid.includes``; until then, recording them does nothing.  This
+also registers the ``@@metrics`` view that returns all metrics in the
+Prometheus text format.  The view requires the ``admin`` permission.
+If ``kotti.metrics_port`` is set, the view is instead served without
+authentication, but only to requests that come in on that port.  This
+allows you to expose it on a port that's only reachable by your
+monitoring.
+
+Use :func:`counter` and :func:`histogram` to add metrics of your own.
+
+.. _Prometheus text format: http://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+from threading import Lock
+import time
+
+from pyramid.response import Response
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n').encode('utf-8'))
+        for name, value in pairs)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=(), enabled=True):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        #: Values are only recorded if this is true
+        self.enabled = enabled
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("Expected labels %r for metric %r, got %r" % (
+                self.labelnames, self.name, sorted(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type),
+            ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up::
+
+      >>> hits = Counter('hits_total', 'Number of hits', ['page'])
+      >>> hits.inc(page='/')
+      >>> hits.inc(2, page='/')
+      >>> hits.get(page='/')
+      3
+      >>> print '\\n'.join(hits.render())
+      # HELP hits_total Number of hits
+      # TYPE hits_total counter
+      hits_total{page="/"} 3.0
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_sample(self, key, value):
+        return ['%s%s %s' % (
+            self.name, _format_labels(self.labelnames, key),
+            _format_value(value))]
+
+
+class Histogram(Metric):
+    """Counts observed values in buckets::
+
+      >>> latency = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+      >>> latency.observe(0.05)
+      >>> latency.observe(0.5)
+      >>> print '\\n'.join(latency.render())
+      # HELP latency_seconds Latency
+      # TYPE latency_seconds histogram
+      latency_seconds_bucket{le="0.1"} 1.0
+      latency_seconds_bucket{le="1.0"} 2.0
+      latency_seconds_bucket{le="+Inf"} 2.0
+      latency_seconds_sum 0.55
+      latency_seconds_count 2.0
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 enabled=True):
+        super(Histogram, self).__init__(name, help, labelnames, enabled)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts = entry[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            entry[1] += value
+
+    def get(self, **labels):
+        """Return a tuple ``(count, sum)``."""
+        entry = self._values.get(self._key(labels))
+        if entry is None:
+            return 0, 0.0
+        return entry[0][-1], entry[1]
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            lines.append('%s_bucket%s %s' % (
+                self.name,
+                _format_labels(self.labelnames, key,
+                               [('le', _format_value(bound))]),
+                _format_value(count)))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('%s_sum%s %s' % (
+            self.name, labels, _format_value(total)))
+        lines.append('%s_count%s %s' % (
+            self.name, labels, _format_value(counts[-1])))
+        return lines
+
+
+class Registry(object):
+    """Holds metrics by name.  The metrics of a registry that isn't
+    ``enabled`` don't record anything.
+    """
+
+    def __init__(self, enabled=True):
+        self.metrics = {}
+        self.enabled = enabled
+        self._lock = Lock()
+
+    def enable(self, enabled=True):
+        """Start (or with ``enabled=False``, stop) recording the
+        values of all metrics.
+        """
+        with self._lock:
+            self.enabled = enabled
+            for metric in self.metrics.values():
+                metric.enabled = enabled
+
+    def get_or_create(self, factory, name, *args, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = factory(
+                    name, *args, enabled=self.enabled, **kwargs)
+            elif not isinstance(metric, factory):
+                raise ValueError("Metric %r is a %s" % (
+                    name, metric.__class__.__name__))
+            return metric
+
+    def clear(self):
+        """Reset the values of all metrics.  Only useful for tests."""
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+#: The registry that Kotti's metrics live in.  It's enabled by
+#: :func:`includeme`.
+registry = Registry(enabled=False)
+
+
+def counter(name, help, labelnames=()):
+    """Return the :class:`Counter` called ``name``; create it if it
+    doesn't exist.
+    """
+    return registry.get_or_create(Counter, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Return the :class:`Histogram` called ``name``; create it if it
+    doesn't exist.
+    """
+    return registry.get_or_create(
+        Histogram, name, help, labelnames, buckets=buckets)
+
+
+request_duration = histogram(
+    'kotti_request_duration_seconds', 'Request latency by view name',
+    ['view'])
+db_queries = counter(
+    'kotti_db_queries_total', 'SQL queries executed in requests')
+db_query_seconds = counter(
+    'kotti_db_query_seconds_total', 'Time spent in SQL queries in requests')
+cache_requests = counter(
+    'kotti_cache_requests_total', 'Cache lookups by cache and result',
+    ['cache', 'result'])
+image_scales = counter(
+    'kotti_image_scales_total', 'Images scaled by scale', ['scale'])
+blob_bytes_served = counter(
+    'kotti_blob_bytes_served_total', 'Bytes of blob data served', ['type'])
+event_dispatch = histogram(
+    'kotti_event_dispatch_seconds', 'Time spent in object event listeners',
+    ['event'])
+
+
+def metrics_tween_factory(handler, app_registry):
+    from kotti.instrumentation import collect
+
+    def metrics_tween(request):
+        started = time.time()
+        # Requests that raise an exception are recorded as 'error':
+        view = 'error'
+        with collect(keep_slowest=0) as stats:
+            try:
+                response = handler(request)
+                if response.status_int == 404:
+                    view = 'notfound'
+                else:
+                    view = request.view_name or 'default'
+                return response
+            finally:
+                request_duration.observe(time.time() - started, view=view)
+                db_queries.inc(stats.count)
+                db_query_seconds.inc(stats.duration)
+
+    return metrics_tween
+
+
+def metrics_view(context, request):
+    return Response(registry.render(), content_type=CONTENT_TYPE,
+                    charset='utf-8')
+
+
+def includeme(config):
+    settings = config.get_settings()
+    port = settings.get('kotti.metrics_port', '').strip()
+    if port:
+        config.add_view(
+            metrics_view, name='metrics',
+            custom_predicates=(
+                lambda context, request: str(request.server_port) == port,))
+    else:
+        config.add_view(metrics_view, name='metrics', permission='admin')
+    config.add_tween('kotti.metrics.metrics_tween_factory')
+    registry.enable()
@@ -0,0 +1,125 @@
+"""Password hashing with bcrypt.
+
+Hashing a password with bcrypt takes a long time on purpose.  By
+default this happens in the thread that handles the request, which
+means that a burst of logins or a bulk import of users can keep all of
+the server's threads busy.  Set ``kotti.bcrypt_threads`` to a positive
+number to have hashing done in a pool of that many worker threads
+instead.  No more than that many passwords are then hashed
+concurrently; further requests wait for a worker to become available.
+bcrypt releases the GIL while hashing, so the workers do use multiple
+CPUs.  They're threads rather than processes because forking a server
+process that already runs threads isn't safe.
+
+The cost factor (``log_rounds``) that is used for new hashes may be
+calibrated at startup: set ``kotti.bcrypt_target_ms`` to the number of
+milliseconds that hashing a password should take on your hardware.
+Existing hashes with a lower cost factor are upgraded when their users
+log in.
+
+Include ``kotti.password_hashing`` (it's part of
+``kotti.base_includes`` by default) to have the calibration done.
+"""
+
+import math
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+import bcrypt
+
+from kotti import get_settings
+
+#: The lowest cost factor that calibration will ever choose
+MIN_LOG_ROUNDS = 10
+
+#: The highest cost factor that calibration will ever choose
+MAX_LOG_ROUNDS = 16
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+
+def _hashpw(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+
+def _get_pool():
+    """Return the pool of worker threads, or ``None`` if hashing is
+    to be done inline.
+
+    The pool is created lazily, and created anew in processes that
+    were forked off after it had been created.
+    """
+    global _pool, _pool_pid
+    threads = int(get_settings().get('kotti.bcrypt_threads') or 0)
+    if threads <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(processes=threads)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def shutdown():
+    """Terminate the pool of worker threads, if there is one."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = _pool_pid = None
+
+
+def hashpw(password, salt):
+    """Like ``bcrypt.hashpw``, but uses the pool of worker threads if
+    one is configured.  ``password`` and ``salt`` are byte strings.
+    """
+    pool = _get_pool()
+    if pool is None:
+        return _hashpw(password, salt)
+    return pool.apply(_hashpw, (password, salt))
+
+
+def log_rounds_of(hashed):
+    """Return the cost factor of the bcrypt hash ``hashed``, or
+    ``None`` if it's not a bcrypt hash.
+
+      >>> log_rounds_of(u'$2a$10$' + u'x' * 53)
+      10
+      >>> log_rounds_of(u'secret') is None
+      True
+    """
+    parts = (hashed or u'').split(u'$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def calibrate_log_rounds(target_ms, minimum=MIN_LOG_ROUNDS,
+                         maximum=MAX_LOG_ROUNDS, _measure_rounds=8):
+    """Return the cost factor for which hashing a password takes
+    closest to, but no longer than ``target_ms`` milliseconds.
+
+    Each additional round doubles the time that hashing takes, so we
+    only need to measure once with a cheap cost factor.  The result is
+    kept within ``minimum`` and ``maximum``.
+    """
+    salt = bcrypt.gensalt(_measure_rounds)
+    started = time.time()
+    _hashpw('calibration', salt)
+    elapsed_ms = max((time.time() - started) * 1000, 0.001)
+    log_rounds = _measure_rounds + int(
+        math.floor(math.log(target_ms / elapsed_ms, 2)))
+    return max(minimum, min(maximum, log_rounds))
+
+
+def includeme(config):
+    from kotti.security import Principals
+
+    target_ms = config.get_settings().get('kotti.bcrypt_target_ms')
+    if target_ms:
+        Principals.log_rounds = calibrate_log_rounds(float(target_ms))
@@ -0,0 +1,249 @@
+"""A low overhead sampling profiler for live processes.
+
+The :class:`Sampler` takes snapshots of the stacks of all threads in
+the process at regular intervals (using ``sys._current_frames``).
+Nothing is traced in between, so the threads that are sampled run at
+full speed.  The result can be formatted as *collapsed stacks*, which
+is what `flamegraph.pl`_ and similar tools read, or as a file that
+can be loaded with :mod:`pstats`.
+
+Frames of functions that are known to be interesting for Kotti are
+annotated with the phase they belong to, e.g. ``[traversal]``,
+``[authorization]``, ``[slots]`` or ``[template]``.
+
+Include ``kotti.profiler`` through ``pyramid.includes`` to get the
+admin-only ``@@profile`` view (see :mod:`kotti.views.profile`).  If
+``kotti.profile_signal`` is set to a signal name (e.g. ``SIGUSR2``),
+sending that signal to the process will profile it for
+``kotti.profile_seconds`` seconds and write the collapsed stacks to a
+file in the temporary directory.
+
+.. _flamegraph.pl: https://github.com/brendangregg/FlameGraph
+"""
+
+from logging import getLogger
+import marshal
+import os
+import re
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+logger = getLogger(__name__)
+
+#: Don't allow profiling for longer than this many seconds
+MAX_SECONDS = 60
+
+#: ``(module name, function name, annotation)``.  ``None`` matches
+#: any function.
+ANNOTATIONS = [
+    ('pyramid.traversal', None, 'traversal'),
+    ('kotti.resources', '__getitem__', 'traversal'),
+    ('kotti.security', 'has_permission', 'authorization'),
+    ('kotti.security', 'list_groups_callback', 'authorization'),
+    ('pyramid.security', 'has_permission', 'authorization'),
+    ('kotti.views.util', '__getattr__', 'slots'),
+    ('kotti.views.slots', '_render_view_on_slot_event', 'slots'),
+    ]
+
+
+#: Chameleon compiles templates into modules that have no ``__name__``
+#: and that are named after the template and a SHA-1 digest
+_compiled_template = re.compile(r'^(?:(.*)_)?[0-9a-f]{40}\.py$')
+
+
+def template_name(module, filename):
+    """Return the name of the template that ``filename`` was compiled
+    from, or ``None`` if it's not a compiled template::
+
+      >>> template_name('', '/tmp/master_%s.py' % ('0' * 40))
+      'master'
+      >>> template_name('kotti.util', 'util.py') is None
+      True
+    """
+    if module:
+        return None
+    match = _compiled_template.match(os.path.basename(filename))
+    if match is not None:
+        return match.group(1) or '<template>'
+
+
+def annotation_for(module, name, filename):
+    """Return the annotation of a frame, or ``None``::
+
+      >>> annotation_for('kotti.security', 'has_permission', 'security.py')
+      'authorization'
+      >>> annotation_for('pyramid.traversal', 'traverse', 'traversal.py')
+      'traversal'
+      >>> annotation_for('', 'render', 'master_%s.py' % ('0' * 40))
+      'template'
+      >>> annotation_for('kotti.util', 'title_to_name', 'util.py') is None
+      True
+    """
+    if (filename.endswith('.pt') or
+            template_name(module, filename) is not None):
+        return 'template'
+    for a_module, a_name, annotation in ANNOTATIONS:
+        if module == a_module and a_name in (None, name):
+            return annotation
+
+
+class Sampler(object):
+    """Samples the stacks of all threads but the ones in
+    ``ignore_threads`` (by ident) and the sampling thread itself every
+    ``interval`` seconds.
+    """
+
+    def __init__(self, interval=0.01, ignore_threads=()):
+        self.interval = interval
+        self.ignore_threads = set(ignore_threads)
+        #: Maps stacks (tuples of frame keys, outermost first) to the
+        #: number of times they were seen
+        self.stacks = {}
+        #: Maps frame keys to labels
+        self.labels = {}
+        self.samples = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _key(self, frame):
+        code = frame.f_code
+        key = (code.co_filename, code.co_firstlineno, code.co_name)
+        if key not in self.labels:
+            module = frame.f_globals.get('__name__') or ''
+            label = '%s.%s' % (
+                module or template_name(module, code.co_filename) or
+                os.path.basename(code.co_filename),
+                code.co_name)
+            annotation = annotation_for(module, code.co_name,
+                                        code.co_filename)
+            if annotation is not None:
+                label += ' [%s]' % annotation
+            self.labels[key] = label.replace(';', ':')
+        return key
+
+    def sample(self):
+        """Take one snapshot of all threads' stacks."""
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        ignore = self.ignore_threads | set([threading.current_thread().ident])
+        for ident, frame in sys._current_frames().items():
+            if ident in ignore:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._key(frame))
+                frame = frame.f_back
+            thread_key = ('<thread>', 0, names.get(ident, 'thread-%s' % ident))
+            self.labels.setdefault(thread_key, thread_key[2])
+            stack.append(thread_key)
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def run(self, seconds):
+        """Sample for ``seconds`` seconds or until :meth:`stop` is
+        called.
+        """
+        deadline = time.time() + seconds
+        while not self._stop.is_set() and time.time() < deadline:
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self, seconds):
+        """Sample for ``seconds`` in a background thread."""
+        self._thread = threading.Thread(
+            target=self.run, args=(seconds,), name='kotti-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self):
+        """Return the samples in the collapsed stack format: one line
+        per stack, with frames separated by ``;``, followed by the
+        number of samples.
+        """
+        lines = []
+        for stack, count in self.stacks.items():
+            lines.append('%s %d' % (
+                ';'.join(self.labels[key] for key in stack), count))
+        lines.sort()
+        return '\n'.join(lines) + '\n'
+
+    def pstats(self):
+        """Return the samples as a string that can be written to a
+        file and loaded with ``pstats.Stats(filename)``.  Call counts
+        are sample counts; times are samples multiplied by the
+        interval.
+        """
+        stats = {}
+        for stack, count in self.stacks.items():
+            stack = stack[1:]  # strip the thread
+            seen = set()
+            for index, key in enumerate(stack):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                if index == len(stack) - 1:
+                    entry[2] += count * self.interval
+                if key not in seen:
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += count * self.interval
+                if index > 0:
+                    caller = stack[index - 1]
+                    entry[4][caller] = entry[4].get(caller, 0) + count
+        return marshal.dumps(
+            dict((key, tuple(value)) for key, value in stats.items()))
+
+
+def profile(seconds, interval=0.01, ignore_threads=()):
+    """Sample all other threads for ``seconds`` and return the
+    :class:`Sampler`.
+    """
+    ignore = set(ignore_threads) | set([threading.current_thread().ident])
+    sampler = Sampler(interval, ignore_threads=ignore)
+    sampler.start(min(seconds, MAX_SECONDS))
+    sampler.join()
+    return sampler
+
+
+def _profile_to_file(seconds, directory):
+    sampler = profile(seconds)
+    fd, path = tempfile.mkstemp(
+        prefix='kotti-profile-%d-' % os.getpid(), suffix='.txt',
+        dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        f.write(sampler.collapsed())
+    logger.info("Wrote profile with %d samples to %s" % (
+        sampler.samples, path))
+    return path
+
+
+def install_signal_handler(signum, seconds=10, directory=None):
+    """Profile the process for ``seconds`` and write the collapsed
+    stacks to a file in ``directory`` whenever the process receives
+    the ``signum`` signal.
+    """
+    def handler(signum, frame):
+        thread = threading.Thread(
+            target=_profile_to_file, args=(seconds, directory))
+        thread.daemon = True
+        thread.start()
+    signal.signal(signum, handler)
+
+
+def includeme(config):
+    settings = config.get_settings()
+    signame = settings.get('kotti.profile_signal', '').strip()
+    if signame:
+        install_signal_handler(
+            getattr(signal, signame),
+            int(settings.get('kotti.profile_seconds') or 10))
+    config.include('kotti.views.profile')
@@ -13,6 +13,7 @@ from UserDict import DictMixin
 
 from pyramid.threadlocal import get_current_registry
 from pyramid.traversal import resource_path
+import sqlalchemy.event
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import DateTime
@@ -30,6 +31,7 @@ from sqlalchemy.orm import backref
 from sqlalchemy.orm import deferred
 from sqlalchemy.orm import object_mapper
 from sqlalchemy.orm import relation
+from sqlalchemy.orm import validates
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import and_
 from sqlalchemy.sql import select
@@ -56,6 +58,8 @@ from kotti.sqla import ACLType
 from kotti.sqla import JsonType
 from kotti.sqla import MutationList
 from kotti.sqla import NestedMutationDict
+from kotti.sqla import add_prefix_index
+from kotti.sqla import prefix_filter
 from kotti.util import ViewLink
 from kotti.util import _
 from kotti.util import camel_case_to_name
@@ -175,6 +179,44 @@ class LocalGroup(Base):
         return self.__class__(**kwargs)
 
 
+class AllowedPrincipal(Base):
+    """One row of the allowed principals index.  See
+    :mod:`kotti.security_index`.
+    """
+
+    __tablename__ = 'allowed_principals'
+
+    #: ID of the indexed node (Integer)
+    node_id = Column(Integer(), primary_key=True)
+    #: Name of the principal, e.g. ``role:editor`` or ``bob`` (Unicode)
+    principal_name = Column(Unicode(100), primary_key=True, index=True)
+    #: Position of the first ACE in the lineage matching the principal
+    position = Column(Integer(), nullable=False)
+    #: True if that ACE allows access, False if it denies it
+    allowed = Column(Boolean(), nullable=False)
+
+    def __repr__(self):  # pragma: no cover
+        return '<AllowedPrincipal %r on %r>' % (
+            self.principal_name, self.node_id)
+
+
+class SearchTerm(Base):
+    """One row of the full-text search index.  See :mod:`kotti.search`.
+    """
+
+    __tablename__ = 'search_terms'
+
+    #: A term that occurs in the node, lowercased (Unicode)
+    term = Column(Unicode(100), primary_key=True)
+    #: ID of the indexed node (Integer)
+    node_id = Column(Integer(), primary_key=True, index=True)
+    #: Sum of the weights of the term's occurrences in the node (Integer)
+    weight = Column(Integer(), nullable=False)
+
+    def __repr__(self):  # pragma: no cover
+        return '<SearchTerm %r in %r>' % (self.term, self.node_id)
+
+
 class Node(Base, ContainerMixin, PersistentACLMixin):
     """Basic node in the persistance hierarchy.
     """
@@ -350,19 +392,73 @@ class Tag(Base):
 
     id = Column(Integer, primary_key=True)
     title = Column(Unicode(100), unique=True, nullable=False)
+    #: Number of content objects that the tag is assigned to.  This is
+    #: updated at the end of each flush (see :mod:`kotti.events`).
+    usage_count = Column(Integer, nullable=False, default=0, index=True)
+    #: The title in lower case, for :meth:`search_prefix`.  This is set
+    #: automatically.
+    title_lower = Column(Unicode(100))
 
     def __repr__(self):
         return "<Tag ('%s')>" % self.title
 
+    @validates('title')
+    def _set_title_lower(self, key, title):
+        self.title_lower = title.lower() if title is not None else None
+        return title
+
+    @classmethod
+    def search_prefix(cls, term, limit=None):
+        """Return a query for the tags whose title starts with
+        ``term``, ignoring case, ordered by title.  This can use the
+        index on ``title_lower``.
+
+        :param term: Beginning of the titles to look for.
+        :type term: unicode
+        :param limit: Maximum number of tags to return.
+        :type limit: int
+        :result:
+        :rtype: :class:`sqlalchemy.orm.query.Query`
+        """
+        term = unicode(term).strip().lower()
+        query = DBSession.query(cls).filter(
+            prefix_filter(cls.title_lower, term)).order_by(cls.title_lower)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
     @property
     def items(self):
         """
+        The content objects that the tag is assigned to, loaded with a
+        single query.
 
         :result:
         :rtype: list
         """
 
-        return [rel.item for rel in self.content_tags]
+        return self.items_query().order_by(TagsToContents.content_id).all()
+
+    def items_query(self):
+        """
+        Return a query for the content objects that the tag is assigned
+        to.  Ordering it by ``TagsToContents.content_id`` uses the
+        primary key index of ``tags_to_contents``, so that fetching a
+        page doesn't need to sort all of the tag's items.
+
+        :result:
+        :rtype: :class:`sqlalchemy.orm.query.Query`
+        """
+
+        return DBSession.query(Content).join(TagsToContents).filter(
+            TagsToContents.tag_id == self.id)
+
+
+# This allows for prefix searches with Tag.search_prefix:
+add_prefix_index(Tag.__table__, 'title_lower')
+# SQLite compares by code points by default, so that the primary key
+# index works for prefix searches there:
+add_prefix_index(SearchTerm.__table__, 'term', dialects=('postgresql',))
 
 
 class TagsToContents(Base):
@@ -588,6 +684,11 @@ def initialize_sql(engine, drop_all=False):
     tables = settings['kotti.use_tables'].strip() or None
     if tables:
         tables = [metadata.tables[name] for name in tables.split()]
+        # Principals keep their groups in a table of their own, and
+        # changes to these are counted in another one:
+        if metadata.tables['principals'] in tables:
+            tables.append(metadata.tables['principal_groups'])
+            tables.append(metadata.tables['memberships_generation'])
 
     if engine.dialect.name == 'mysql':  # pragma: no cover
         from sqlalchemy.dialects.mysql.base import LONGBLOB
@@ -0,0 +1,369 @@
+"""A full-text search index that is maintained in the database.
+
+:func:`kotti.views.util.default_search_content` scans the ``name``,
+``title``, ``description`` and ``body`` of all content with ``LIKE
+'%term%'``, which can't use an index and gets slower the more content
+there is.  This module instead keeps an inverted index in the
+``search_terms`` table.  It has one row per term and node, which makes
+looking up the nodes that contain a term an index lookup.  It's
+portable, i.e. it doesn't depend on the full-text features of any
+particular database.
+
+Terms are the lowercased words of the indexed fields, with HTML markup
+removed.  A search matches the content that contains all words of the
+search string, where each word matches as a prefix of a term, so that
+``docu`` finds ``document``.  Results are ranked by the weights of the
+fields that the words occur in (see :data:`FIELDS`), and filtered by
+permission in the database.
+
+:func:`search_facets` counts the results by content type, tag,
+workflow state, owner and modification date with aggregate queries,
+so that users can narrow down their search.  To show the counts on the
+search results page, also set::
+
+  kotti.search_facets = kotti.search.search_facets
+
+To use the index, include ``kotti.search`` and make
+:func:`search_content` the search function::
+
+  pyramid.includes = kotti.search
+  kotti.search_content = kotti.search.search_content
+
+The index is updated whenever content is added, changed or deleted.
+The work is done once per flush.  Use the ``kotti-reindex-search``
+command to build the index for existing content, e.g. after turning
+it on or after adding content with ``kotti-generate-site``.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+import re
+from weakref import WeakKeyDictionary
+try:  # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # pyflakes
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
+
+import sqlalchemy.event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import and_
+from sqlalchemy.sql import case
+from sqlalchemy.sql import func
+from sqlalchemy.sql import or_
+from sqlalchemy.sql import select
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from kotti import DBSession
+from kotti.events import ObjectDelete
+from kotti.events import ObjectInsert
+from kotti.events import ObjectUpdate
+from kotti.events import objectevent_listeners
+from kotti.resources import Content
+from kotti.resources import Document
+from kotti.resources import SearchTerm
+from kotti.resources import Tag
+from kotti.resources import TagsToContents
+from kotti.security_index import filter_allowed
+from kotti.sqla import prefix_filter
+from kotti.util import command
+from kotti.util import search_result
+
+#: The indexed fields and the weight of a term's occurrence in each
+FIELDS = OrderedDict([
+    ('title', 8),
+    ('name', 4),
+    ('description', 2),
+    ('body', 1),
+    ])
+
+#: Longer terms are truncated to this many characters
+MAX_TERM_LENGTH = 100
+
+#: Number of rows inserted at once when rebuilding the index
+BATCH_SIZE = 1000
+
+#: The facets that search results can be narrowed down by
+FACETS = ('type', 'tag', 'state', 'owner', 'modified')
+
+#: The buckets of the ``modified`` facet: modified within the past day,
+#: week, month or year
+MODIFIED = OrderedDict([
+    ('day', timedelta(days=1)),
+    ('week', timedelta(days=7)),
+    ('month', timedelta(days=31)),
+    ('year', timedelta(days=365)),
+    ])
+
+#: Don't return more than this many values per facet
+FACET_LIMIT = 10
+
+_markup_re = re.compile(r'<[^>]*>|&#?\w+;')
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the list of terms in ``text``::
+
+      >>> tokenize(u'<p>Hello, <b>World</b>!&nbsp;Hello again</p>')
+      [u'hello', u'world', u'hello', u'again']
+    """
+    if not text:
+        return []
+    text = _markup_re.sub(u' ', text).lower()
+    return [word[:MAX_TERM_LENGTH] for word in _word_re.findall(text)]
+
+
+def index_terms(values):
+    """Return a dict that maps the terms in ``values``, a dict of
+    field names to text, to their weights.
+
+      >>> sorted(index_terms({'title': u'Hello', 'body': u'Hello World'})
+      ...        .items())
+      [(u'hello', 9), (u'world', 1)]
+    """
+    terms = {}
+    for field, weight in FIELDS.items():
+        for term in tokenize(values.get(field)):
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+def _values(node):
+    return dict((field, getattr(node, field, None)) for field in FIELDS)
+
+
+def _insert(session, rows):
+    if rows:
+        session.execute(SearchTerm.__table__.insert(), rows)
+
+
+def _rows(node_id, values):
+    return [dict(term=term, node_id=node_id, weight=weight)
+            for term, weight in index_terms(values).items()]
+
+
+def reindex_node(node):
+    """Recompute the index rows for ``node``."""
+    table = SearchTerm.__table__
+    DBSession.execute(table.delete().where(table.c.node_id == node.id))
+    _insert(DBSession, _rows(node.id, _values(node)))
+
+
+def reindex_all():
+    """Rebuild the whole index.  Content is read column by column, so
+    that no objects are loaded.
+    """
+    documents = Document.__table__
+    DBSession.execute(SearchTerm.__table__.delete())
+    query = DBSession.query(
+        Content.id, Content.name, Content.title, Content.description,
+        documents.c.body).outerjoin(
+        documents, documents.c.id == Content.id).order_by(Content.id)
+    rows = []
+    for row in query:
+        rows.extend(_rows(row.id, {
+            'name': row.name,
+            'title': row.title,
+            'description': row.description,
+            'body': row.body,
+            }))
+        if len(rows) >= BATCH_SIZE:
+            _insert(DBSession, rows)
+            rows = []
+    _insert(DBSession, rows)
+    mark_changed(DBSession())
+
+
+def search_query(search_term):
+    """Return a query for the content that matches all words in
+    ``search_term``, best matches first, or ``None`` if there are no
+    words in it.  The score of an item is the sum of the weights of
+    the terms that matched.
+    """
+    terms = sorted(set(tokenize(search_term)))
+    if not terms:
+        return None
+    table = SearchTerm.__table__
+    matches = [prefix_filter(table.c.term, term) for term in terms]
+    scores = select(
+        [table.c.node_id, func.sum(table.c.weight).label('score')],
+        or_(*matches)).group_by(table.c.node_id).having(
+        and_(*[func.max(case([(match, 1)], else_=0)) == 1
+               for match in matches])).alias('scores')
+    return DBSession.query(Content).join(
+        scores, scores.c.node_id == Content.id).order_by(
+        scores.c.score.desc(), Content.id)
+
+
+def _filtered(query, filters):
+    for name, value in sorted((filters or {}).items()):
+        if name == 'type':
+            query = query.filter(Content.type == value)
+        elif name == 'state':
+            query = query.filter(Content.state == value)
+        elif name == 'owner':
+            query = query.filter(Content.owner == value)
+        elif name == 'tag':
+            query = query.filter(Content.id.in_(
+                DBSession.query(TagsToContents.content_id).join(
+                    TagsToContents.tag).filter(Tag.title == value)))
+        elif name == 'modified' and value in MODIFIED:
+            query = query.filter(
+                Content.modification_date >= datetime.now() - MODIFIED[value])
+    return query
+
+
+def search_content(search_term, request=None, limit=None, offset=0,
+                   filters=None):
+    """A replacement for
+    :func:`kotti.views.util.default_search_content` that uses the
+    index.  Results are ranked by score, and only the ones that the
+    user may view are fetched (see
+    :func:`kotti.security_index.filter_allowed`).  ``filters`` is a
+    dict that maps names of :data:`FACETS` to the values that results
+    must have.
+    """
+    query = search_query(search_term)
+    if query is None:
+        return []
+    query = filter_allowed(_filtered(query, filters), request)
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return [search_result(result, request) for result in query]
+
+
+def _count_by(column, ids, limit):
+    count = func.count(Content.id)
+    return DBSession.query(column, count).filter(Content.id.in_(ids)).filter(
+        column != None).group_by(column).order_by(
+        count.desc(), column).limit(limit).all()
+
+
+def _count_tags(ids, limit):
+    count = func.count(TagsToContents.content_id)
+    return DBSession.query(Tag.title, count).join(Tag.content_tags).filter(
+        TagsToContents.content_id.in_(ids)).group_by(Tag.title).order_by(
+        count.desc(), Tag.title).limit(limit).all()
+
+
+def _count_modified(ids):
+    now = datetime.now()
+    counts = DBSession.query(*[
+        func.sum(case([(Content.modification_date >= now - delta, 1)],
+                      else_=0))
+        for delta in MODIFIED.values()]).filter(Content.id.in_(ids)).one()
+    return [(name, int(count)) for name, count in zip(MODIFIED, counts)
+            if count]
+
+
+def search_facets(search_term, request=None, filters=None, limit=FACET_LIMIT):
+    """Return an ordered dict that maps the names of :data:`FACETS` to
+    lists of up to ``limit`` ``(value, count)`` tuples, most frequent
+    first.  Only results that match ``filters`` (see
+    :func:`search_content`) and that the user may view are counted.
+    The counts are computed in the database.
+    """
+    facets = OrderedDict((name, []) for name in FACETS)
+    query = search_query(search_term)
+    if query is None:
+        return facets
+    ids = filter_allowed(_filtered(query, filters), request).with_entities(
+        Content.id).order_by(None).subquery()
+
+    facets['type'] = _count_by(Content.type, ids, limit)
+    facets['tag'] = _count_tags(ids, limit)
+    facets['state'] = _count_by(Content.state, ids, limit)
+    facets['owner'] = _count_by(Content.owner, ids, limit)
+    facets['modified'] = _count_modified(ids)
+    return facets
+
+
+class _PendingReindex(object):
+    def __init__(self):
+        self.nodes = []
+        self.deleted_ids = set()
+
+
+_pending = WeakKeyDictionary()
+
+
+def _pending_for(obj):
+    session = DBSession.object_session(obj) or DBSession()
+    pending = _pending.get(session)
+    if pending is None:
+        pending = _pending[session] = _PendingReindex()
+    return pending
+
+
+def _content_inserted(event):
+    _pending_for(event.object).nodes.append(event.object)
+
+
+def _content_updated(event):
+    node = event.object
+    for field in FIELDS:
+        if hasattr(node.__class__, field) and get_history(
+                node, field).has_changes():
+            _pending_for(node).nodes.append(node)
+            break
+
+
+def _content_deleted(event):
+    _pending_for(event.object).deleted_ids.add(event.object.id)
+
+
+def _after_flush(session, flush_context):
+    pending = _pending.pop(session, None)
+    if pending is None:
+        return
+
+    nodes = dict((node.id, node) for node in pending.nodes
+                 if node.id not in pending.deleted_ids)
+    node_ids = set(nodes) | pending.deleted_ids
+    if node_ids:
+        table = SearchTerm.__table__
+        session.execute(table.delete().where(table.c.node_id.in_(node_ids)))
+    rows = []
+    for node_id, node in sorted(nodes.items()):
+        rows.extend(_rows(node_id, _values(node)))
+    _insert(session, rows)
+
+
+def reindex_search_command():
+    __doc__ = """Rebuild the full-text search index of all content.
+
+    Usage:
+      kotti-reindex-search <config_uri>
+
+    Options:
+      -h --help          Show this screen.
+    """
+
+    def reindex(args):
+        reindex_all()
+        transaction.commit()
+    return command(reindex, __doc__)
+
+
+_WIRED_SQLALCHEMY = False
+
+
+def wire_sqlalchemy():  # pragma: no cover
+    global _WIRED_SQLALCHEMY
+    if _WIRED_SQLALCHEMY:
+        return
+    else:
+        _WIRED_SQLALCHEMY = True
+    sqlalchemy.event.listen(Session, 'after_flush', _after_flush)
+
+
+def includeme(config):
+    wire_sqlalchemy()
+    objectevent_listeners[(ObjectInsert, Content)].append(_content_inserted)
+    objectevent_listeners[(ObjectUpdate, Content)].append(_content_updated)
+    objectevent_listeners[(ObjectDelete, Content)].append(_content_deleted)
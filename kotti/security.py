@@ -1,28 +1,48 @@
 from __future__ import with_statement
+from binascii import hexlify
+from binascii import unhexlify
 from contextlib import contextmanager
 from datetime import datetime
 from UserDict import DictMixin
+from weakref import WeakKeyDictionary
+import time
 
 import bcrypt
+import sqlalchemy.event
 from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import DDL
 from sqlalchemy import DateTime
+from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import Unicode
 from sqlalchemy import func
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.sql.expression import or_
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import relation
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.orm.exc import NoResultFound
+from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.location import lineage
 from pyramid.security import authenticated_userid
 from pyramid.security import has_permission as base_has_permission
 from pyramid.security import view_execution_permitted
+from pyramid.threadlocal import get_current_request
+from repoze.lru import ExpiringLRUCache
 
 from kotti import get_settings
 from kotti import DBSession
 from kotti import Base
-from kotti.sqla import JsonType
+from kotti.password_hashing import hashpw
+from kotti.password_hashing import log_rounds_of
+from kotti.sqla import add_prefix_index
+from kotti.sqla import prefix_filter
 from kotti.util import _
 from kotti.util import request_cache
+from kotti.util import request_container
 from kotti.util import DontCache
 
 
@@ -41,6 +61,45 @@ def has_permission(permission, context, request):
         return base_has_permission(permission, context, request)
 
 
+class PrincipalGroup(Base):
+    """The membership of a principal in a global group or role.  The
+    ``group_name`` is indexed, so that finding the members of a group
+    doesn't need to look at every principal.
+    """
+    __tablename__ = 'principal_groups'
+
+    id = Column(Integer, primary_key=True)
+    principal_name = Column(
+        ForeignKey('principals.name', onupdate='CASCADE', ondelete='CASCADE'),
+        nullable=False, index=True)
+    group_name = Column(Unicode(100), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+
+    def __init__(self, group_name):
+        self.group_name = group_name
+
+    def __repr__(self):  # pragma: no cover
+        return '<PrincipalGroup %r in %r>' % (
+            self.principal_name, self.group_name)
+
+
+class MembershipsGeneration(Base):
+    """A single row with a number that's incremented in the same
+    transaction as changes to global group memberships, and renames
+    and deletions of principals.  It's shared by all processes.  See
+    :class:`GroupsAuthTktAuthenticationPolicy`.
+    """
+    __tablename__ = 'memberships_generation'
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+
+
+sqlalchemy.event.listen(
+    MembershipsGeneration.__table__, 'after_create', DDL(
+        'INSERT INTO memberships_generation (id, generation) VALUES (1, 0)'))
+
+
 class Principal(Base):
     """A minimal 'Principal' implementation.
 
@@ -72,9 +131,21 @@ class Principal(Base):
     confirm_token = Column(Unicode(100))
     title = Column(Unicode(100), nullable=False)
     email = Column(Unicode(100), unique=True)
-    groups = Column(JsonType(), nullable=False)
+    _groups = relation(
+        PrincipalGroup,
+        order_by=[PrincipalGroup.position],
+        collection_class=ordering_list('position'),
+        cascade='all, delete-orphan',
+        passive_updates=False,
+        )
+    #: Global groups and roles of the principal (list of str)
+    groups = association_proxy('_groups', 'group_name')
     creation_date = Column(DateTime(), nullable=False)
     last_login_date = Column(DateTime())
+    #: ``name`` and ``title`` in lower case, for
+    #: :meth:`Principals.search_prefix`.  These are set automatically.
+    name_lower = Column(Unicode(100))
+    title_lower = Column(Unicode(100))
 
     def __init__(self, name, password=None, active=True, confirm_token=None,
                  title=u"", email=None, groups=()):
@@ -90,6 +161,20 @@ class Principal(Base):
         self.creation_date = datetime.now()
         self.last_login_date = None
 
+    @validates('email')
+    def _normalize_email(self, key, email):
+        # Emails are stored in lower case, so that they can be looked
+        # up case-insensitively using the index on the column:
+        if email is not None:
+            email = email.strip().lower()
+        return email
+
+    @validates('name', 'title')
+    def _set_lower(self, key, value):
+        setattr(self, key + '_lower',
+                value.lower() if value is not None else None)
+        return value
+
     def __repr__(self):  # pragma: no cover
         return '<Principal %r>' % self.name
 
@@ -216,6 +301,7 @@ def reset():
     reset_roles()
     reset_sharing_roles()
     reset_user_management_roles()
+    clear_principal_cache()
 
 
 class PersistentACLMixin(object):
@@ -233,28 +319,226 @@ class PersistentACLMixin(object):
     __acl__ = property(_get_acl, _set_acl, _del_acl)
 
 
-def _cachekey_list_groups_raw(name, context):
-    context_id = context is not None and getattr(context, 'id', id(context))
-    return (name, context_id)
+_principal_caches = {}
+_marker = object()
+
+
+def _principal_cache(kind):
+    """Return the process wide cache of ``kind`` (``'groups'``,
+    ``'closure'`` or ``'generation'``), or ``None`` if caching is
+    disabled.
+
+    The cache is only used while handling a request; scripts and the
+    like always see the current state of the database.  Entries expire
+    after ``kotti.principal_cache_ttl`` seconds, which bounds how long
+    changes made by other processes can go unnoticed.  Changes made in
+    this process invalidate the affected entries right away.
+    """
+    if get_current_request() is None:
+        return None
+    cache = _principal_caches.get(kind)
+    if cache is None:
+        settings = get_settings()
+        ttl = float(settings.get('kotti.principal_cache_ttl') or 0)
+        if ttl <= 0:
+            return None
+        max_size = int(settings.get('kotti.principal_cache_size') or 1000)
+        cache = _principal_caches[kind] = ExpiringLRUCache(
+            max_size, default_timeout=ttl)
+    return cache
+
+
+def clear_principal_cache():
+    _principal_caches.clear()
+
+
+#: Sessions with membership changes that aren't committed yet.  The
+#: value is ``True`` if the generation is yet to be incremented.
+_membership_sessions = WeakKeyDictionary()
+
+
+def _memberships_changed(session):
+    if session is not None:
+        _membership_sessions[session] = True
+
+
+def _increment_memberships_generation(session):
+    table = MembershipsGeneration.__table__
+    session.execute(table.update().values(generation=table.c.generation + 1))
+    _membership_sessions[session] = False
+    generation = _principal_caches.get('generation')
+    if generation is not None:
+        generation.clear()
+
+
+def memberships_generation(cached=True):
+    """Return the number in :class:`MembershipsGeneration`, or ``None``
+    if there's no such row.  Unless ``cached`` is false, it's read
+    through the principal cache, which means that changes made by
+    other processes can go unnoticed for ``kotti.principal_cache_ttl``
+    seconds.
+    """
+    cache = _principal_cache('generation') if cached else None
+    if cache is not None:
+        generation = cache.get('generation', _marker)
+        if generation is not _marker:
+            return generation
+    generation = DBSession.query(MembershipsGeneration.generation).scalar()
+    if cache is not None:
+        cache.put('generation', generation)
+    return generation
+
+
+def invalidate_principal(*names):
+    """Remove the principals with the given ``names`` from the
+    principal cache.  Since any principal may be a group of others,
+    this also throws away all cached group closures.
+    """
+    groups = _principal_caches.get('groups')
+    if groups is not None:
+        for name in names:
+            groups.invalidate(unicode(name))
+    closure = _principal_caches.get('closure')
+    if closure is not None:
+        closure.clear()
+
+
+def _principal_groups(name, cached=True):
+    """Return a tuple with the global groups of the principal with
+    the given ``name``, or ``None`` if there's no such principal.
+    """
+    name = unicode(name)
+    cache = _principal_cache('groups') if cached else None
+    if cache is not None:
+        groups = cache.get(name, _marker)
+        if groups is not _marker:
+            return groups
+    principal = get_principals().get(name)
+    groups = tuple(principal.groups) if principal is not None else None
+    if cache is not None:
+        cache.put(name, groups)
+    return groups
+
+
+def prime_principal_groups(names):
+    """Load the global groups of the principals in ``names``, and
+    those of the groups they're members of, into the principal cache.
+
+    This needs one query per level of group nesting, instead of one
+    query per principal.  Use it before looking up the groups of many
+    principals, e.g. for a page of search results.  It does nothing if
+    the cache is disabled, or if the principals factory doesn't have a
+    ``groups_of`` method.
+    """
+    cache = _principal_cache('groups')
+    groups_of = getattr(get_principals(), 'groups_of', None)
+    if cache is None or groups_of is None:
+        return
+
+    seen = set()
+    todo = set(unicode(name) for name in names)
+    while todo:
+        seen.update(todo)
+        groups = {}
+        missing = []
+        for name in todo:
+            cached = cache.get(name, _marker)
+            if cached is _marker:
+                missing.append(name)
+            else:
+                groups[name] = cached
+        if missing:
+            found = groups_of(missing)
+            for name in missing:
+                value = found.get(name)
+                if value is not None:
+                    value = tuple(value)
+                cache.put(name, value)
+                groups[name] = value
+        todo = set()
+        for value in groups.values():
+            todo.update(value or ())
+        todo -= seen
+
+
+def global_groups(name, cached=True):
+    """Return a frozenset of all global groups of the principal with
+    the given ``name``, including those inherited through nested
+    groups.  Pass ``cached=False`` to bypass the principal cache.
+    """
+    name = unicode(name)
+    cache = _principal_cache('closure') if cached else None
+    if cache is not None:
+        groups = cache.get(name, _marker)
+        if groups is not _marker:
+            return groups
+    groups = set()
+    seen = set([name])
+    todo = [name]
+    while todo:
+        direct = _principal_groups(todo.pop(), cached) or ()
+        groups.update(direct)
+        for group_name in direct:
+            if group_name not in seen:
+                seen.add(group_name)
+                todo.append(group_name)
+    groups = frozenset(groups)
+    if cache is not None:
+        cache.put(name, groups)
+    return groups
+
+
+_LOCAL_GROUPS_CACHE_KEY = 'kotti.security:local_groups'
+
+
+def _local_groups_cache():
+    cache = request_container()
+    if cache is None:
+        return {}
+    return cache.setdefault(_LOCAL_GROUPS_CACHE_KEY, {})
+
+
+def load_local_groups(nodes):
+    """Return a dict that maps node ids to dicts of the form
+    ``{principal_name: set(group_names)}`` for all the given ``nodes``.
+
+    The local groups of all nodes are fetched with a single query, and
+    the result is cached for the rest of the request, so that asking
+    for the same nodes again (e.g. for the lineage of a sibling) won't
+    query again.
+    """
+    from kotti.resources import LocalGroup
+    from kotti.resources import Node
+
+    cache = _local_groups_cache()
+    missing = set(
+        node.id for node in nodes
+        if isinstance(node, Node) and node.id is not None and
+        node.id not in cache)
+    if missing:
+        for node_id in missing:
+            cache[node_id] = {}
+        for node_id, principal_name, group_name in DBSession.query(
+                LocalGroup.node_id,
+                LocalGroup.principal_name,
+                LocalGroup.group_name).filter(
+                LocalGroup.node_id.in_(missing)):
+            cache[node_id].setdefault(principal_name, set()).add(group_name)
+    return cache
+
+
+def _local_groups_of(name, context, local_groups):
+    return local_groups.get(getattr(context, 'id', None), {}).get(name, ())
 
 
-@request_cache(_cachekey_list_groups_raw)
 def list_groups_raw(name, context):
     """A set of group names in given ``context`` for ``name``.
 
     Only groups defined in context will be considered, therefore no
     global or inherited groups are returned.
     """
-    from kotti.resources import LocalGroup
-    from kotti.resources import Node
-
-    if isinstance(context, Node):
-        return set(
-            r[0] for r in DBSession.query(LocalGroup.group_name).filter(
-            LocalGroup.node_id == context.id).filter(
-            LocalGroup.principal_name == name).all()
-            )
-    return set()
+    local_groups = load_local_groups([context])
+    return set(_local_groups_of(name, context, local_groups))
 
 
 def list_groups(name, context=None):
@@ -266,7 +550,8 @@ def list_groups(name, context=None):
     return list_groups_ext(name, context)[0]
 
 
-def _cachekey_list_groups_ext(name, context=None, _seen=None, _inherited=None):
+def _cachekey_list_groups_ext(name, context=None, _seen=None, _inherited=None,
+                              _local_groups=None):
     if _seen is not None or _inherited is not None:
         raise DontCache
     else:
@@ -275,28 +560,39 @@ def _cachekey_list_groups_ext(name, context=None, _seen=None, _inherited=None):
 
 
 @request_cache(_cachekey_list_groups_ext)
-def list_groups_ext(name, context=None, _seen=None, _inherited=None):
+def list_groups_ext(name, context=None, _seen=None, _inherited=None,
+                    _local_groups=None):
     name = unicode(name)
+    if context is None and _seen is None:
+        # Only global groups are involved, and we have those cached:
+        groups = global_groups(name)
+        inherited = set()
+        for group_name in groups - set([name]):
+            inherited.update(_principal_groups(group_name) or ())
+        return list(groups), list(inherited)
+
     groups = set()
     recursing = _inherited is not None
     _inherited = _inherited or set()
 
     # Add groups from principal db:
-    principal = get_principals().get(name)
-    if principal is not None:
-        groups.update(principal.groups)
-        if context is not None or (context is None and _seen is not None):
-            _inherited.update(principal.groups)
+    principal_groups = _principal_groups(name) or ()
+    groups.update(principal_groups)
+    if context is not None or (context is None and _seen is not None):
+        _inherited.update(principal_groups)
 
     if _seen is None:
         _seen = set([name])
 
-    # Add local groups:
+    # Add local groups.  Those of the whole lineage are loaded at once
+    # and passed on when recursing:
     if context is not None:
-        items = lineage(context)
+        items = list(lineage(context))
+        if _local_groups is None:
+            _local_groups = load_local_groups(items)
         for idx, item in enumerate(items):
-            group_names = [i for i in list_groups_raw(name, item)
-                           if i not in _seen]
+            group_names = [i for i in _local_groups_of(
+                name, item, _local_groups) if i not in _seen]
             groups.update(group_names)
             if recursing or idx != 0:
                 _inherited.update(group_names)
@@ -305,7 +601,8 @@ def list_groups_ext(name, context=None, _seen=None, _inherited=None):
     _seen.update(new_groups)
     for group_name in new_groups:
         g, i = list_groups_ext(
-            group_name, context, _seen=_seen, _inherited=_inherited)
+            group_name, context, _seen=_seen, _inherited=_inherited,
+            _local_groups=_local_groups)
         groups.update(g)
         _inherited.update(i)
 
@@ -318,25 +615,165 @@ def set_groups(name, context, groups_to_set=()):
     """
     name = unicode(name)
     from kotti.resources import LocalGroup
-    DBSession.query(LocalGroup).filter(
+    groups_to_set = set(unicode(group_name) for group_name in groups_to_set)
+    _local_groups_cache().pop(context.id, None)
+
+    # We only delete and add the entries that actually change, and we
+    # do so through the session, so that object events are emitted:
+    existing = DBSession.query(LocalGroup).filter(
         LocalGroup.node_id == context.id).filter(
-        LocalGroup.principal_name == name).delete()
+        LocalGroup.principal_name == name).all()
+    for local_group in existing:
+        if local_group.group_name in groups_to_set:
+            groups_to_set.remove(local_group.group_name)
+        else:
+            DBSession.delete(local_group)
 
     for group_name in groups_to_set:
-        DBSession.add(LocalGroup(context, name, unicode(group_name)))
+        DBSession.add(LocalGroup(context, name, group_name))
+
+
+def _list_groups_with_global(name, context, global_groups):
+    """Like :func:`list_groups`, but for a principal whose global
+    groups, including nested ones, are known to be ``global_groups``.
+    """
+    name = unicode(name)
+    groups = set(global_groups)
+    items = list(lineage(context))
+    local_groups = load_local_groups(items)
+    seen = set([name]) | groups
+    todo = list(seen)
+    while todo:
+        current = todo.pop()
+        found = set()
+        for item in items:
+            found.update(_local_groups_of(current, item, local_groups))
+        if current != name and current not in global_groups:
+            found.update(_principal_groups(current) or ())
+        groups.update(found)
+        for group_name in found - seen:
+            seen.add(group_name)
+            todo.append(group_name)
+    return list(groups)
+
+
+def _authz_context_of(request):
+    context = request.environ.get(
+        'authz_context', getattr(request, 'context', None))
+    if context is None:
+        # SA events don't have request.context available
+        from kotti.resources import get_root
+        context = get_root(request)
+    return context
 
 
 def list_groups_callback(name, request):
     if not is_user(name):
         return None  # Disallow logging in with groups
-    if name in get_principals():
-        context = request.environ.get(
-            'authz_context', getattr(request, 'context', None))
-        if context is None:
-            # SA events don't have request.context available
-            from kotti.resources import get_root
-            context = get_root(request)
-        return list_groups(name, context)
+    if _principal_groups(name) is not None:
+        return list_groups(name, _authz_context_of(request))
+
+
+class GroupsAuthTktAuthenticationPolicy(AuthTktAuthenticationPolicy):
+    """An AuthTkt authentication policy that signs the global groups
+    of a user into the ticket when the user logs in.
+
+    As long as the groups in a ticket are valid, requests need not look
+    up the user and their global groups; only the local groups of the
+    context are resolved.  The groups in a ticket are valid for
+    ``groups_ttl`` seconds after they were issued, and only if no
+    memberships were changed since then.  Otherwise we fall back to
+    :func:`list_groups_callback`.  Either way, the user has to exist.
+
+    Changes are tracked with the generation number in
+    :class:`MembershipsGeneration`, which is signed into the ticket.
+    It is only incremented when memberships are added or removed, or
+    principals are renamed or deleted, so that logging in or changing
+    one's password or title doesn't invalidate tickets.  It's read
+    through the principal cache, so changes made in other processes
+    take up to ``kotti.principal_cache_ttl`` seconds to take effect.
+    Use this policy by setting ``kotti.authn_policy_factory`` to
+    ``kotti.groups_authtkt_factory``.
+    """
+    ISSUED_PREFIX = 'kottiissued'
+    GENERATION_PREFIX = 'kottigen'
+    GROUP_PREFIX = 'kottigroup'
+
+    #: Don't put more than this many groups into a ticket
+    max_groups = 50
+
+    def __init__(self, secret, groups_ttl=60, **kwargs):
+        kwargs.setdefault('callback', list_groups_callback)
+        super(GroupsAuthTktAuthenticationPolicy, self).__init__(
+            secret, **kwargs)
+        self.groups_ttl = groups_ttl
+        self.fallback_callback = self.callback
+        self.callback = self.groups_callback
+
+    def groups_tokens(self, userid):
+        # Read the generation first; the groups are then at least as
+        # current as the generation they're signed with.  Neither may
+        # come from the cache, where they may have been put at
+        # different times:
+        generation = memberships_generation(cached=False)
+        groups = global_groups(userid, cached=False)
+        if generation is None or len(groups) > self.max_groups:
+            return []
+        tokens = [
+            '{0}{1}'.format(self.ISSUED_PREFIX, int(time.time())),
+            '{0}{1}'.format(self.GENERATION_PREFIX, generation),
+            ]
+        for group_name in sorted(groups):
+            tokens.append(self.GROUP_PREFIX + hexlify(
+                group_name.encode('utf-8')))
+        return tokens
+
+    def groups_from_tokens(self, tokens):
+        """Return the set of groups in ``tokens``, or ``None`` if
+        there are none or if they're no longer valid.
+        """
+        issued = generation = None
+        groups = set()
+        for token in tokens:
+            if token.startswith(self.ISSUED_PREFIX):
+                try:
+                    issued = int(token[len(self.ISSUED_PREFIX):])
+                except ValueError:
+                    return None
+            elif token.startswith(self.GENERATION_PREFIX):
+                try:
+                    generation = int(token[len(self.GENERATION_PREFIX):])
+                except ValueError:
+                    return None
+            elif token.startswith(self.GROUP_PREFIX):
+                try:
+                    groups.add(unhexlify(
+                        token[len(self.GROUP_PREFIX):]).decode('utf-8'))
+                except (TypeError, UnicodeDecodeError):
+                    return None
+        if issued is None or generation is None:
+            return None
+        if issued + self.groups_ttl < time.time():
+            return None
+        if generation != memberships_generation():
+            return None
+        return groups
+
+    def groups_callback(self, userid, request):
+        if not is_user(userid) or _principal_groups(userid) is None:
+            return None
+        identity = self.cookie.identify(request) or {}
+        groups = self.groups_from_tokens(identity.get('tokens', ()))
+        if groups is None:
+            return self.fallback_callback(userid, request)
+        return _list_groups_with_global(
+            userid, _authz_context_of(request), groups)
+
+    def remember(self, request, principal, **kw):
+        if 'tokens' not in kw and is_user(principal):
+            kw['tokens'] = self.groups_tokens(principal)
+        return super(GroupsAuthTktAuthenticationPolicy, self).remember(
+            request, principal, **kw)
 
 
 @contextmanager
@@ -360,18 +797,15 @@ def principals_with_local_roles(context, inherit=True):
     """Return a list of principal names that have local roles in the
     context.
     """
-    from resources import LocalGroup
     principals = set()
     items = [context]
     if inherit:
-        items = lineage(context)
+        items = list(lineage(context))
+    local_groups = load_local_groups(items)
     for item in items:
         principals.update(
-            r[0] for r in
-            DBSession.query(LocalGroup.principal_name).filter(
-                LocalGroup.node_id == item.id).group_by(
-                LocalGroup.principal_name).all()
-            if not r[0].startswith('role:')
+            name for name in local_groups.get(item.id, ())
+            if not name.startswith('role:')
             )
     return list(principals)
 
@@ -454,13 +888,94 @@ class Principals(DictMixin):
         query = query.filter(or_(*filters))
         return query
 
+    def find_by_login(self, login):
+        """Return the principal with the name ``login`` or, failing
+        that, the one with the email address ``login``.  Return
+        ``None`` if there's no such principal.
+
+        Uses a single query that looks at the indexed ``name`` and
+        ``email`` columns only.
+        """
+        login = unicode(login).strip()
+        factory = self.factory
+        filters = [factory.name == login]
+        if u'@' in login:
+            filters.append(factory.email == login.lower())
+        found = DBSession.query(factory).filter(or_(*filters)).limit(2).all()
+        for principal in found:
+            if principal.name == login:
+                return principal
+        return found[0] if found else None
+
+    def search_prefix(self, term, limit=None, after=None):
+        """Return a query for the principals whose name, title or
+        email starts with ``term``, ignoring case, ordered by name.
+        Group names also match without their ``group:`` prefix.
+
+        Unlike :meth:`search`, this can use the indexes on
+        ``name_lower``, ``title_lower`` and ``email``, which hold the
+        values lower-cased by Python.  Pass the name of the last
+        principal of a page as ``after`` to get the next page of at most
+        ``limit`` principals.
+        """
+        term = unicode(term).strip().lower()
+        factory = self.factory
+        filters = []
+        for col, prefix in ((factory.name_lower, term),
+                            (factory.name_lower, u'group:' + term),
+                            (factory.title_lower, term),
+                            (factory.email, term)):
+            filters.append(prefix_filter(col, prefix))
+
+        query = DBSession.query(factory).filter(or_(*filters))
+        if after is not None:
+            query = query.filter(factory.name > unicode(after))
+        query = query.order_by(factory.name)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def groups_of(self, names):
+        """Return a dict that maps the names of those principals in
+        ``names`` that exist to lists of their global groups.  Uses a
+        single query.
+        """
+        result = {}
+        names = [unicode(name) for name in names]
+        if not names:
+            return result
+        query = DBSession.query(
+            self.factory.name, PrincipalGroup.group_name).outerjoin(
+            self.factory._groups).filter(
+            self.factory.name.in_(names)).order_by(PrincipalGroup.position)
+        for name, group_name in query:
+            groups = result.setdefault(name, [])
+            if group_name is not None:
+                groups.append(group_name)
+        return result
+
+    def members(self, group_name):
+        """Return a query for the principals that are direct members
+        of the global group (or role) ``group_name``.
+        """
+        return DBSession.query(self.factory).join(
+            self.factory._groups).filter(
+            PrincipalGroup.group_name == unicode(group_name))
+
     log_rounds = 10
 
     def hash_password(self, password, hashed=None):
         if hashed is None:
             hashed = bcrypt.gensalt(self.log_rounds)
         return unicode(
-            bcrypt.hashpw(password.encode('utf-8'), hashed.encode('utf-8')))
+            hashpw(password.encode('utf-8'), hashed.encode('utf-8')))
+
+    def needs_rehash(self, hashed):
+        """Return ``True`` if ``hashed`` was made with a lower cost
+        factor than the one we currently use for new hashes.
+        """
+        log_rounds = log_rounds_of(hashed)
+        return log_rounds is not None and log_rounds < self.log_rounds
 
     def validate_password(self, clear, hashed):
         try:
@@ -471,3 +986,104 @@ class Principals(DictMixin):
 
 def principals_factory():
     return Principals()
+
+
+_changed_principals = WeakKeyDictionary()
+
+
+def _principal_changed(target, memberships_changed=False):
+    names = set([target.name])
+    renamed_from = get_history(target, 'name').deleted
+    names.update(renamed_from or ())
+    names.discard(None)
+    invalidate_principal(*names)
+    session = DBSession.object_session(target)
+    if memberships_changed or renamed_from:
+        _memberships_changed(session)
+    if session is not None:
+        _changed_principals.setdefault(session, set()).update(names)
+
+
+def delete_memberships(group_name):
+    """Remove all members from the group ``group_name`` and return the
+    set of their names.  The memberships are deleted with one
+    ``DELETE`` on the indexed ``group_name``, without loading them.
+    Members that are already loaded get their groups from the database
+    the next time they're accessed.
+    """
+    session = DBSession()
+    memberships = session.query(PrincipalGroup).filter(
+        PrincipalGroup.group_name == group_name)
+    names = set(row[0] for row in memberships.with_entities(
+        PrincipalGroup.principal_name))
+    if not names:
+        return names
+    memberships.delete(synchronize_session='evaluate')
+    for obj in session.identity_map.values():
+        if isinstance(obj, Principal) and obj.name in names:
+            session.expire(obj, ['_groups'])
+    invalidate_principal(*names)
+    _increment_memberships_generation(session)
+    _changed_principals.setdefault(session, set()).update(names)
+    return names
+
+
+def _principal_flushed(mapper, connection, target):
+    _principal_changed(target)
+
+
+def _principal_deleted(mapper, connection, target):
+    _principal_changed(target, memberships_changed=True)
+
+
+def _principal_groups_changed(target, value, initiator):
+    _principal_changed(target, memberships_changed=True)
+    return value
+
+
+def _membership_flushed(mapper, connection, target):
+    invalidate_principal(target.principal_name)
+    session = DBSession.object_session(target)
+    _memberships_changed(session)
+    if session is not None:
+        _changed_principals.setdefault(session, set()).add(
+            target.principal_name)
+
+
+def _session_flushed(session, flush_context):
+    # Increment the generation once per flush, in the same transaction
+    # as the changes:
+    if _membership_sessions.get(session):
+        _increment_memberships_generation(session)
+
+
+def _session_ended(session):
+    # Another thread may have put what it read from the database into
+    # the cache while our changes were not committed yet.  And if we
+    # rolled back, this thread may have cached what was just flushed:
+    names = _changed_principals.pop(session, None)
+    if names:
+        invalidate_principal(*names)
+    if _membership_sessions.pop(session, None) is not None:
+        generation = _principal_caches.get('generation')
+        if generation is not None:
+            generation.clear()
+
+
+for _event_name in ('after_insert', 'after_update'):
+    sqlalchemy.event.listen(
+        Principal, _event_name, _principal_flushed, propagate=True)
+sqlalchemy.event.listen(
+    Principal, 'after_delete', _principal_deleted, propagate=True)
+for _column in ('name_lower', 'title_lower', 'email'):
+    # These allow for prefix searches with Principals.search_prefix:
+    add_prefix_index(Principal.__table__, _column)
+for _event_name in ('after_insert', 'after_delete'):
+    sqlalchemy.event.listen(PrincipalGroup, _event_name, _membership_flushed)
+for _event_name in ('append', 'remove'):
+    sqlalchemy.event.listen(
+        Principal._groups, _event_name, _principal_groups_changed,
+        propagate=True)
+sqlalchemy.event.listen(Session, 'after_flush', _session_flushed)
+sqlalchemy.event.listen(Session, 'after_commit', _session_ended)
+sqlalchemy.event.listen(Session, 'after_rollback', _session_ended)
@@ -0,0 +1,375 @@
+"""This module maintains a denormalized index of the principals that
+are allowed to *view* each node.
+
+Permission checks through :func:`kotti.security.has_permission` need
+the node object to be loaded, which means that listings of many items
+have to fetch every candidate row before they can throw away the ones
+the current user isn't allowed to see.  The ``allowed_principals``
+table allows us to do that filtering inside the database instead::
+
+  from kotti.security_index import filter_allowed
+
+  query = DBSession.query(Content).filter(Content.title.like(u'%foo%'))
+  query = filter_allowed(query, request).limit(10)
+
+For every node, the index has one row per principal that's mentioned
+in an ACE that concerns the ``view`` permission in the node's lineage,
+and one row per principal that has local groups in the lineage.  Each
+row records the ``position`` of the first ACE that matches the
+principal, and whether that ACE ``allowed`` access.  A node is visible
+if, among the rows that match the request's principals, the one with
+the lowest position allows access.  This is the same first-match rule
+that Pyramid's ``ACLAuthorizationPolicy`` uses.
+
+The index is updated whenever a node is added or moved, whenever its
+ACL changes (e.g. through a workflow transition), whenever local
+groups are set with :func:`kotti.security.set_groups`, and whenever a
+principal's global groups change.  The work is done once per flush.
+
+Include ``kotti.security_index`` (it's part of ``kotti.base_includes``
+by default) to have the index maintained.  Use the
+``kotti-reindex-security`` command to build the index for existing
+content, e.g. after the migration that adds it.
+"""
+
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+import sqlalchemy.event
+from pyramid.compat import is_nonstr_iter
+from pyramid.location import lineage
+from pyramid.security import Allow
+from pyramid.security import Authenticated
+from pyramid.security import Deny
+from pyramid.security import Everyone
+from pyramid.security import authenticated_userid
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import and_
+from sqlalchemy.sql import exists
+from sqlalchemy.sql import not_
+from sqlalchemy.sql import select
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from kotti import DBSession
+from kotti.events import MembershipsDeleted
+from kotti.events import ObjectAfterDelete
+from kotti.events import ObjectDelete
+from kotti.events import ObjectInsert
+from kotti.events import ObjectUpdate
+from kotti.events import objectevent_listeners
+from kotti.resources import AllowedPrincipal
+from kotti.resources import LocalGroup
+from kotti.resources import Node
+from kotti.security import Principal
+from kotti.security import PrincipalGroup
+from kotti.security import _principal_groups
+from kotti.security import list_groups
+from kotti.sqla import ACLType
+from kotti.util import command
+
+#: The permission that the index is maintained for
+INDEXED_PERMISSION = 'view'
+
+
+def _acl_entries(node, permission=INDEXED_PERMISSION):
+    """Return a list of ``(position, action, principal)`` tuples for
+    all ACEs in the lineage of ``node`` that concern ``permission``.
+
+    The entries are in the order that Pyramid's ACL authorization
+    policy would look at them.  We stop at the first ACE that denies
+    access to ``system.Everyone``, since no ACE after it can ever
+    match.
+    """
+    entries = []
+    position = 0
+    for location in lineage(node):
+        try:
+            acl = location.__acl__
+        except AttributeError:
+            continue
+        # ACLType puts the default ACE in front when it loads an ACL
+        # from the database, but an ACL that was just set won't have it
+        # yet:
+        acl = [tuple(ace) for ace in acl]
+        if ACLType.DEFAULT_ACE not in acl:
+            acl.insert(0, ACLType.DEFAULT_ACE)
+        for action, principal, permissions in acl:
+            if not is_nonstr_iter(permissions):
+                permissions = [permissions]
+            if permission in permissions:
+                entries.append((position, action, principal))
+                if action == Deny and principal == Everyone:
+                    return entries
+            position += 1
+    return entries
+
+
+def _effective_principals(name, local_groups):
+    """The principal ``name`` itself along with all groups it's a
+    member of, considering both global groups and the ``local_groups``
+    mapping of principal names to sets of group names.
+    """
+    seen = set([name])
+    todo = [name]
+    while todo:
+        current = todo.pop()
+        groups = set(local_groups.get(current, ()))
+        groups.update(_principal_groups(current) or ())
+        for group in groups - seen:
+            seen.add(group)
+            todo.append(group)
+    return seen
+
+
+def _decide(entries, local_groups):
+    """Return a dict that maps principal names to ``(position,
+    allowed)`` tuples, given the ACL ``entries`` of a node (see
+    :func:`_acl_entries`) and the ``local_groups`` of its lineage (a
+    mapping of principal names to sets of group names).
+    """
+    decided = {}
+    for position, action, principal in entries:
+        if principal not in decided:
+            decided[principal] = (position, action == Allow)
+
+    for name in local_groups:
+        effective = _effective_principals(name, local_groups)
+        for position, action, principal in entries:
+            if principal in effective:
+                decided[name] = (position, action == Allow)
+                break
+    return decided
+
+
+def compute_allowed_principals(node):
+    """Return a dict that maps principal names to ``(position,
+    allowed)`` tuples for ``node``.
+    """
+    node_ids = [item.id for item in lineage(node)
+                if getattr(item, 'id', None) is not None]
+    local_groups = defaultdict(set)
+    if node_ids:
+        for principal_name, group_name in DBSession.query(
+                LocalGroup.principal_name, LocalGroup.group_name).filter(
+                LocalGroup.node_id.in_(node_ids)):
+            local_groups[principal_name].add(group_name)
+    return _decide(_acl_entries(node), local_groups)
+
+
+def reindex_node(node):
+    """Recompute the index rows for ``node``.  Does not touch the
+    node's descendants.
+    """
+    table = AllowedPrincipal.__table__
+    DBSession.execute(table.delete().where(table.c.node_id == node.id))
+    rows = [
+        dict(node_id=node.id, principal_name=name,
+             position=position, allowed=allowed)
+        for name, (position, allowed) in
+        compute_allowed_principals(node).items()
+        ]
+    if rows:
+        DBSession.execute(table.insert(), rows)
+
+
+def reindex_all():
+    """Rebuild the whole index."""
+    DBSession.execute(AllowedPrincipal.__table__.delete())
+    for node in DBSession.query(Node):
+        reindex_node(node)
+    mark_changed(DBSession())
+
+
+def _with_descendants(node_ids):
+    result = set(node_ids)
+    level = set(node_ids)
+    while level:
+        level = set(
+            r[0] for r in DBSession.query(Node.id).filter(
+                Node.parent_id.in_(level))) - result
+        result.update(level)
+    return result
+
+
+def global_principals(request):
+    """Return the principals of the user making ``request`` that are
+    independent of any context, i.e. ``system.Everyone``, and for
+    authenticated users ``system.Authenticated``, the user id and the
+    user's global groups.
+
+    Local groups are not part of this list since they're already
+    folded into the index.
+    """
+    principals = [Everyone]
+    userid = authenticated_userid(request)
+    if userid is not None:
+        principals.extend([Authenticated, userid])
+        principals.extend(list_groups(userid))
+    return principals
+
+
+def filter_allowed(query, request, node_id_column=Node.id):
+    """Restrict ``query`` to nodes that the user making ``request`` is
+    allowed to view.
+
+    ``node_id_column`` is the column that holds the node id in
+    ``query``; it defaults to ``Node.id``, which works for queries
+    for ``Node`` and all its subclasses.
+    """
+    principals = global_principals(request)
+    allow = AllowedPrincipal.__table__.alias()
+    deny = AllowedPrincipal.__table__.alias()
+
+    denied_before = exists(
+        [deny.c.node_id],
+        and_(deny.c.node_id == allow.c.node_id,
+             deny.c.principal_name.in_(principals),
+             not_(deny.c.allowed),
+             deny.c.position < allow.c.position),
+        )
+    allowed = select(
+        [allow.c.node_id],
+        and_(allow.c.principal_name.in_(principals),
+             allow.c.allowed,
+             not_(denied_before)),
+        )
+    return query.filter(node_id_column.in_(allowed))
+
+
+class _PendingReindex(object):
+    def __init__(self):
+        self.nodes = []
+        self.node_ids = set()
+        self.principal_names = set()
+        self.deleted_ids = set()
+
+
+_pending = WeakKeyDictionary()
+
+
+def _pending_for(obj):
+    session = DBSession.object_session(obj) or DBSession()
+    pending = _pending.get(session)
+    if pending is None:
+        pending = _pending[session] = _PendingReindex()
+    return pending
+
+
+def _node_inserted(event):
+    _pending_for(event.object).nodes.append(event.object)
+
+
+def _node_updated(event):
+    node = event.object
+    for attr in ('_acl', 'parent'):
+        if get_history(node, attr).has_changes():
+            _pending_for(node).nodes.append(node)
+            break
+
+
+def _node_deleted(event):
+    _pending_for(event.object).deleted_ids.add(event.object.id)
+
+
+def _local_group_inserted(event):
+    local_group = event.object
+    pending = _pending_for(local_group)
+    if local_group.node is not None:
+        pending.nodes.append(local_group.node)
+    pending.node_ids.add(local_group.node_id)
+
+
+def _local_group_deleted(event):
+    _pending_for(event.object).node_ids.add(event.object.node_id)
+
+
+def _membership_changed(event):
+    membership = event.object
+    _pending_for(membership).principal_names.add(membership.principal_name)
+
+
+def _memberships_deleted(event):
+    _pending_for(event.object).principal_names.update(event.names)
+
+
+def _principal_deleted(event):
+    _pending_for(event.object).principal_names.add(event.object.name)
+
+
+def _after_flush(session, flush_context):
+    pending = _pending.pop(session, None)
+    if pending is None:
+        return
+
+    node_ids = set(pending.node_ids)
+    node_ids.update(node.id for node in pending.nodes)
+    names = pending.principal_names
+    if names:
+        node_ids.update(r[0] for r in session.query(LocalGroup.node_id).filter(
+            LocalGroup.principal_name.in_(names)))
+        node_ids.update(r[0] for r in session.query(
+            AllowedPrincipal.node_id).filter(
+            AllowedPrincipal.principal_name.in_(names)))
+    node_ids.discard(None)
+
+    deleted_ids = pending.deleted_ids
+    if deleted_ids:
+        table = AllowedPrincipal.__table__
+        session.execute(table.delete().where(
+            table.c.node_id.in_(deleted_ids)))
+
+    node_ids = _with_descendants(node_ids - deleted_ids) - deleted_ids
+    for node_id in sorted(node_ids):
+        node = session.query(Node).get(node_id)
+        if node is not None:
+            reindex_node(node)
+
+
+def reindex_security_command():
+    __doc__ = """Rebuild the index of the principals that may view each
+    node.
+
+    Usage:
+      kotti-reindex-security <config_uri>
+
+    Options:
+      -h --help          Show this screen.
+    """
+
+    def reindex(args):
+        reindex_all()
+        transaction.commit()
+    return command(reindex, __doc__)
+
+
+_WIRED_SQLALCHEMY = False
+
+
+def wire_sqlalchemy():  # pragma: no cover
+    global _WIRED_SQLALCHEMY
+    if _WIRED_SQLALCHEMY:
+        return
+    else:
+        _WIRED_SQLALCHEMY = True
+    sqlalchemy.event.listen(Session, 'after_flush', _after_flush)
+
+
+def includeme(config):
+    wire_sqlalchemy()
+    objectevent_listeners[(ObjectInsert, Node)].append(_node_inserted)
+    objectevent_listeners[(ObjectUpdate, Node)].append(_node_updated)
+    objectevent_listeners[(ObjectDelete, Node)].append(_node_deleted)
+    objectevent_listeners[
+        (ObjectInsert, LocalGroup)].append(_local_group_inserted)
+    objectevent_listeners[
+        (ObjectAfterDelete, LocalGroup)].append(_local_group_deleted)
+    objectevent_listeners[
+        (ObjectInsert, PrincipalGroup)].append(_membership_changed)
+    objectevent_listeners[
+        (ObjectAfterDelete, PrincipalGroup)].append(_membership_changed)
+    objectevent_listeners[
+        (ObjectDelete, Principal)].append(_principal_deleted)
+    objectevent_listeners[
+        (MembershipsDeleted, Principal)].append(_memberships_deleted)
@@ -7,12 +7,19 @@ Inheritance Diagram
 .. inheritance-diagram:: kotti.sqla
 """
 
+import sys
+
 from pyramid.compat import json
 from pyramid.security import ALL_PERMISSIONS
 from pyramid.security import Allow
+import sqlalchemy.event
+from sqlalchemy import DDL
 from sqlalchemy.types import TypeDecorator, TEXT
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.sql.expression import and_
 
 
 def dump_default(obj):
@@ -185,3 +192,66 @@ class Base(object):
     def __tablename__(cls):
         from kotti.util import camel_case_to_name  # prevent circ import
         return '{0}s'.format(camel_case_to_name(cls.__name__))
+
+
+class BinaryCollation(ColumnElement):
+    """Compares ``element`` by code points, which is what SQLite does
+    anyway, and what PostgreSQL does with the ``"C"`` collation.
+    """
+    def __init__(self, element):
+        if hasattr(element, '__clause_element__'):  # mapped attributes
+            element = element.__clause_element__()
+        self.element = element
+        self.type = element.type
+
+
+@compiles(BinaryCollation)
+def _compile_binary_collation(element, compiler, **kw):
+    return compiler.process(element.element, **kw)
+
+
+@compiles(BinaryCollation, 'postgresql')
+def _compile_binary_collation_postgresql(element, compiler, **kw):
+    return '%s COLLATE "C"' % compiler.process(element.element, **kw)
+
+
+def prefix_filter(column, prefix):
+    """Return a filter for the rows in which ``column`` starts with
+    ``prefix``.  This compares by code points, so that it works the
+    same with all collations, and it can use an index that was created
+    with :func:`add_prefix_index`.  Values that are to be found
+    case-insensitively have to be normalized (e.g. lower-cased) in
+    Python, as databases differ in how they change the case of
+    non-ASCII characters.
+    """
+    column = BinaryCollation(column)
+    if not prefix:
+        return column != None
+    if ord(prefix[-1]) == sys.maxunicode:
+        return column >= prefix
+    return and_(column >= prefix,
+                column < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+
+
+def prefix_index_sql(dialect_name, name, table_name, column_name):
+    """Return the statement that creates an index that
+    :func:`prefix_filter` can use, or ``None`` if we don't know how to
+    on the dialect.
+    """
+    if dialect_name == 'postgresql':
+        return 'CREATE INDEX {0} ON {1} ({2} COLLATE "C")'.format(
+            name, table_name, column_name)
+    if dialect_name == 'sqlite':
+        return 'CREATE INDEX {0} ON {1} ({2})'.format(
+            name, table_name, column_name)
+
+
+def add_prefix_index(table, column_name, dialects=('postgresql', 'sqlite')):
+    """Create an index named ``ix_<table>_<column_name>`` for
+    :func:`prefix_filter` along with ``table`` on ``dialects``.
+    """
+    name = 'ix_{0}_{1}'.format(table.name, column_name)
+    for dialect_name in dialects:
+        sqlalchemy.event.listen(table, 'after_create', DDL(prefix_index_sql(
+            dialect_name, name, table.name, column_name)).execute_if(
+            dialect=dialect_name))
@@ -7,8 +7,10 @@ Inheritance Diagram
 .. inheritance-diagram:: kotti.testing
 """
 
+from contextlib import contextmanager
 import os
 from os.path import join, dirname
+import sys
 from unittest import TestCase
 from pytest import mark
 
@@ -80,6 +82,29 @@ def dummy_search(search_term, request):
     return u"Not found. Sorry!"
 
 
+@contextmanager
+def assert_max_queries(n):
+    """Fail if more than ``n`` SQL statements are executed in the
+    ``with`` block::
+
+      with assert_max_queries(10):
+          app.get('/about')
+
+    The :class:`kotti.instrumentation.QueryStats` of the block are
+    available as the ``as`` target.
+    """
+    from kotti.instrumentation import collect
+
+    with collect(keep_slowest=sys.maxint) as stats:
+        yield stats
+    if stats.count > n:
+        raise AssertionError(
+            "%d statements executed, expected at most %d:\n%s" % (
+                stats.count, n, '\n'.join(
+                    '%.1f ms: %s' % (duration * 1000, statement)
+                    for duration, statement in stats.slowest)))
+
+
 def testing_db_url():
     return os.environ.get('KOTTI_TEST_DB_STRING', 'sqlite://')
 
@@ -35,6 +35,10 @@ def connection():
     from sqlalchemy import create_engine
     from kotti.testing import testing_db_url
     from kotti import metadata, DBSession
+    from kotti.instrumentation import wire_sqlalchemy
+    # statements on connections that are made before this can't be
+    # counted (see `kotti.testing.assert_max_queries`)
+    wire_sqlalchemy()
     engine = create_engine(testing_db_url())
     connection = engine.connect()
     DBSession.registry.clear()
@@ -0,0 +1,283 @@
+import json
+
+from docopt import docopt
+from mock import patch
+from pytest import fixture
+from zope.configuration import xmlconfig
+
+
+def _argv(*args):
+    # docopt binds the default for argv at import time, so patching
+    # 'sys.argv' is no use:
+    return patch('kotti.benchmarks.suite.docopt',
+                 lambda doc: docopt(doc, list(args)))
+
+
+class TestSuite:
+    def run(self, connection, *args, **kwargs):
+        from kotti import DBSession
+        from kotti import metadata
+        from kotti.benchmarks.suite import run
+
+        try:
+            return run(*args, **kwargs)
+        finally:
+            # Put back the database of the other tests:
+            DBSession.registry.clear()
+            DBSession.configure(bind=connection)
+            metadata.bind = connection.engine
+
+    def test_run(self, connection):
+        from kotti.benchmarks.site import SiteSpec
+        from kotti.benchmarks.suite import BENCHMARKS
+
+        spec = SiteSpec(depth=2, fanout=2, users=2, groups=1,
+                        local_roles=2, tags=2, files=1, images=1)
+        results = self.run(connection, spec, number=2)
+
+        assert results['spec']['fanout'] == 2
+        assert list(results['results']) == list(BENCHMARKS)
+        for result in results['results'].values():
+            assert result['number'] == 2
+            assert 0 <= result['min'] <= result['median'] <= result['max']
+        json.dumps(results)
+
+    def test_nothing_to_benchmark(self, connection):
+        from kotti.benchmarks.site import SiteSpec
+
+        results = self.run(connection, SiteSpec(depth=1, fanout=1, images=0),
+                           names=['image_scaling'], number=1)
+        assert results['results'] == {}
+
+
+class TestCommand:
+    def test_compare_fails_on_regression(self, tmpdir):
+        from kotti.benchmarks.suite import kotti_benchmarks_command
+
+        old = tmpdir.join('old.json')
+        old.write(json.dumps({'results': {'traversal': {'median': 0.001}}}))
+        new = {'results': {'traversal': {
+            'median': 0.002, 'min': 0.002, 'max': 0.002}}}
+        with _argv('--compare=%s' % old, 'traversal'):
+            with patch('kotti.benchmarks.suite.run', return_value=new):
+                assert kotti_benchmarks_command() == 1
+
+    def test_unknown_benchmark(self):
+        from kotti.benchmarks.suite import kotti_benchmarks_command
+
+        with _argv('no-such-benchmark'):
+            assert kotti_benchmarks_command() == 2
+
+
+@fixture
+def empty_db(db_session, connection, request):
+    # 'generate_site' commits, so it gets a database of its own:
+    from kotti import DBSession
+    from kotti import metadata
+    from kotti.benchmarks.suite import _configure
+    from kotti.benchmarks.suite import _teardown
+
+    def teardown():
+        _teardown()
+        DBSession.registry.clear()
+        DBSession.configure(bind=connection)
+        metadata.bind = connection.engine
+    request.addfinalizer(teardown)
+    return _configure('sqlite://')
+
+
+class TestGenerateSite:
+    def generate(self, **kwargs):
+        from kotti.benchmarks.generate import GeneratorSpec
+        from kotti.benchmarks.generate import generate_site
+        from kotti.resources import get_root
+
+        kwargs.setdefault('nodes', 200)
+        spec = GeneratorSpec(fanout=4, users=5, groups=2, tags=10,
+                             local_roles=10, batch_size=50, **kwargs)
+        return generate_site(get_root(), spec)
+
+    def assert_indexed(self):
+        from kotti import DBSession
+        from kotti.resources import AllowedPrincipal
+        from kotti.resources import Content
+        from kotti.security_index import compute_allowed_principals
+
+        for node in DBSession.query(Content).filter(
+                Content.name.like(u'%-%')):
+            rows = DBSession.query(AllowedPrincipal).filter_by(
+                node_id=node.id)
+            assert dict((row.principal_name, (row.position, row.allowed))
+                        for row in rows) == compute_allowed_principals(node)
+
+    def test_generate(self, empty_db):
+        from kotti import DBSession
+        from kotti.resources import Content
+        from kotti.resources import Image
+        from kotti.resources import LocalGroup
+        from kotti.resources import Node
+        from kotti.resources import Tag
+        from kotti.resources import TagsToContents
+        from kotti.resources import get_root
+        from kotti.security import get_principals
+        from kotti.security import list_groups
+        from kotti.security import list_groups_raw
+        from sqlalchemy import func
+
+        stats = self.generate()
+        assert stats['documents'] + stats['files'] + stats['images'] == 200
+        assert stats['users'] == 5
+        assert stats['groups'] == 2
+        assert stats['tags'] == 10
+        assert 0 < stats['local_roles'] <= 10
+
+        root = get_root()
+        assert DBSession.query(Node).count() == 202  # root and 'about'
+        assert DBSession.query(func.sum(Tag.usage_count)).scalar() == (
+            DBSession.query(TagsToContents).count())
+        assert DBSession.query(Image).count() == stats['images']
+        assert DBSession.query(LocalGroup).filter(
+            LocalGroup.principal_name.like(u'%generated-%'),
+            LocalGroup.group_name != u'role:owner').count() == (
+            stats['local_roles'])
+        for node in DBSession.query(Content).filter(
+                Content.name.like(u'%-%')):
+            assert node.parent is not None
+            assert node.owner.startswith(u'generated-')
+            # Owners get the owner role unless they inherit it:
+            assert u'role:owner' in list_groups(node.owner, node)
+            assert ((u'role:owner' in list_groups_raw(node.owner, node)) !=
+                    (u'role:owner' in list_groups(node.owner, node.parent)))
+        assert len(root.children) > 4
+        assert root.children[-1].position == len(root.children) - 1
+
+        principals = get_principals()
+        user = principals[u'generated-0']
+        assert principals.validate_password(u'secret', user.password)
+        assert user.groups[0].startswith(u'group:generated-')
+        self.assert_indexed()
+
+    def test_generate_with_workflow(self, empty_db):
+        import kotti
+        from kotti import DBSession
+        from kotti.resources import Content
+
+        xmlconfig.file('workflow.zcml', kotti, execute=True)
+        self.generate(nodes=100, public=50)
+        states = set(r[0] for r in DBSession.query(Content.state).filter(
+            Content.name.like(u'%-%')))
+        assert states == set([u'private', u'public'])
+        self.assert_indexed()
+
+    def test_generate_twice(self, empty_db):
+        from kotti import DBSession
+        from kotti.resources import Node
+
+        self.generate(nodes=50)
+        stats = self.generate(nodes=50)
+        assert stats['users'] == stats['groups'] == stats['tags'] == 0
+        assert DBSession.query(Node).count() == 102
+        self.assert_indexed()
+
+
+class TestReplay:
+    @fixture
+    def site(self, app, db_session):
+        # 'app' sets up the workflow
+        from kotti.benchmarks.site import SiteSpec
+        from kotti.benchmarks.site import build_site
+        from kotti.resources import Content
+        from kotti.resources import get_root
+        from kotti.security import set_groups
+        from kotti.workflow import get_workflow
+
+        root = get_root()
+        root.state = u'public'
+        site = build_site(root, SiteSpec(
+            depth=2, fanout=2, users=2, groups=1, local_roles=2, tags=2,
+            files=1, images=1))
+        # Like content that admin added and published:
+        for node in Content.query.filter(Content.id != root.id):
+            set_groups(u'admin', node, [u'role:owner'])
+            workflow = get_workflow(node)
+            if workflow is not None:
+                workflow.transition_to_state(node, None, u'public')
+        db_session.flush()
+        return site
+
+    def test_generate_mix(self, site):
+        from kotti.benchmarks.replay import MIX
+        from kotti.benchmarks.replay import generate_mix
+        from kotti.resources import get_root
+
+        mix = generate_mix(get_root(), 200)
+        assert len(mix) == 200
+        assert set(entry['route'] for entry in mix) == set(MIX)
+        assert mix == generate_mix(get_root(), 200)
+        assert mix != generate_mix(get_root(), 200, seed=1)
+
+        [save] = [entry for entry in mix if entry['route'] == 'edit-save'][:1]
+        assert save['method'] == 'POST'
+        assert save['path'].endswith('/@@edit')
+        assert save['user'] == u'admin'
+        assert save['params']['save'] == u'save'
+
+    def test_load_and_dump_mix(self, tmpdir):
+        from kotti.benchmarks.replay import dump_mix
+        from kotti.benchmarks.replay import load_mix
+
+        mix = [{'route': u'view', 'method': u'GET', 'path': u'/',
+                'params': {}, 'user': None}]
+        with tmpdir.join('mix.jsonl').open('w') as f:
+            dump_mix(mix, f)
+        with tmpdir.join('mix.jsonl').open() as f:
+            assert load_mix(f) == mix
+
+    def test_replay(self, app, site):
+        from kotti.benchmarks.replay import authenticate
+        from kotti.benchmarks.replay import generate_mix
+        from kotti.benchmarks.replay import replay
+        from kotti.resources import get_root
+
+        mix = generate_mix(get_root(), 50)
+        users = set(entry['user'] for entry in mix) - set([None])
+        credentials = authenticate(app.app.registry, users)
+        results, seconds = replay(app.app, mix, credentials)
+
+        assert len(results) == 50
+        assert seconds > 0
+        statuses = dict(((route, status), None)
+                        for route, status, timing in results)
+        assert ('edit', 200) in statuses
+        assert ('edit-save', 302) in statuses
+        assert ('view-authenticated', 200) in statuses
+        assert ('image-scale', 200) in statuses
+        assert ('search', 200) in statuses
+
+    def test_replay_concurrently(self):
+        from kotti.benchmarks.replay import replay
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO']]
+
+        mix = [{'route': u'view', 'method': u'GET', 'path': u'/%d' % index,
+                'params': {}, 'user': None} for index in range(20)]
+        results, seconds = replay(app, mix, {}, concurrency=4)
+        assert [status for route, status, timing in results] == [200] * 20
+
+    def test_summarize_replay(self):
+        from kotti.benchmarks.replay import summarize_replay
+
+        results = [('view', 200, 0.001 * index) for index in range(1, 101)]
+        results.append(('search', None, 1.0))
+        summary = summarize_replay(results, 2.0)
+
+        assert list(summary) == ['view', 'search', 'all']
+        assert summary['view']['requests'] == 100
+        assert summary['view']['errors'] == 0
+        assert summary['view']['throughput'] == 50.0
+        assert summary['view']['p95'] == 95.0
+        assert summary['view']['p99'] == 99.0
+        assert summary['search']['errors'] == 1
+        assert summary['all']['requests'] == 101
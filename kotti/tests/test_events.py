@@ -78,3 +78,358 @@ class TestEvents:
         assert lengths() == (1, 1, 1, 1)
         assert delete_events[0].object == child
         assert after_delete_events[0].object == child
+
+    def test_objects_events(self, db_session, events):
+        from kotti import events
+        from kotti import DBSession
+        from kotti.resources import get_root
+        from kotti.resources import Content
+        from kotti.resources import Document
+
+        inserted = []
+        updated = []
+        events.listeners[events.ObjectsInserted].append(inserted.append)
+        events.listeners[events.ObjectsUpdated].append(updated.append)
+
+        root = get_root()
+        folder = root[u'folder'] = Content()
+        doc1 = folder[u'doc1'] = Document()
+        doc2 = folder[u'doc2'] = Document()
+        DBSession.flush()
+        assert len(inserted) == 1
+        assert inserted[0].objects[Content] == [folder]
+        assert inserted[0].objects[Document] == [doc1, doc2]
+        assert inserted[0].of_type(Content) == [folder, doc1, doc2]
+        assert inserted[0].of_type(Document) == [doc1, doc2]
+        assert updated == []
+
+        doc1.title = doc2.title = u'Changed'
+        DBSession.flush()
+        assert len(inserted) == 1
+        assert len(updated) == 1
+        assert set(updated[0].objects[Document]) == set([doc1, doc2])
+
+        # Nothing is emitted for flushes without changes:
+        DBSession.flush()
+        assert (len(inserted), len(updated)) == (1, 1)
+
+    def test_owners_of_many_nodes(self, db_session, events, dummy_request):
+        from kotti import DBSession
+        from kotti.resources import get_root
+        from kotti.resources import Content
+        from kotti.security import list_groups
+        from kotti.security import list_groups_raw
+
+        root = get_root()
+        with patch('kotti.events.authenticated_userid', return_value='bob'):
+            with patch('kotti.events.list_groups',
+                       side_effect=list_groups) as lg:
+                child = root[u'child'] = Content()
+                grandchildren = [Content() for i in range(3)]
+                for i, grandchild in enumerate(grandchildren):
+                    child[u'gc%d' % i] = grandchild
+                DBSession.flush()
+        # The groups of the root are looked up once:
+        assert lg.call_count == 1
+        assert [node.owner for node in [child] + grandchildren] == [
+            u'bob'] * 4
+        assert list_groups_raw(u'bob', child) == set([u'role:owner'])
+        for grandchild in grandchildren:
+            assert list_groups(u'bob', grandchild) == [u'role:owner']
+            assert list_groups_raw(u'bob', grandchild) == set()
+
+    def test_owner_without_request(self, db_session, events):
+        from kotti import DBSession
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        child = get_root()[u'child'] = Content()
+        DBSession.flush()
+        assert child.owner is None
+
+    def test_set_owner(self, db_session, dummy_request):
+        from kotti.events import ObjectInsert
+        from kotti.events import set_owner
+        from kotti.resources import get_root
+        from kotti.resources import Content
+        from kotti.security import list_groups_raw
+
+        child = get_root()[u'child'] = Content()
+        with patch('kotti.events.authenticated_userid', return_value='bob'):
+            set_owner(ObjectInsert(child, dummy_request))
+        assert child.owner == u'bob'
+        assert list_groups_raw(u'bob', child) == set([u'role:owner'])
+
+    def test_dates(self, db_session, events):
+        from kotti import DBSession
+        from kotti.events import ObjectInsert
+        from kotti.events import ObjectUpdate
+        from kotti.events import set_creation_date
+        from kotti.events import set_modification_date
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        root = get_root()
+        child1 = root[u'child1'] = Content()
+        child2 = root[u'child2'] = Content()
+        DBSession.flush()
+        assert child1.creation_date is not None
+        assert child1.creation_date == child2.creation_date
+        assert child1.modification_date == child1.creation_date
+
+        child1.title = u'Changed'
+        DBSession.flush()
+        assert child1.modification_date > child1.creation_date
+        assert child2.modification_date == child2.creation_date
+
+        # The listeners for single objects are still available:
+        child3 = Content()
+        set_creation_date(ObjectInsert(child3))
+        assert child3.creation_date == child3.modification_date
+        set_modification_date(ObjectUpdate(child3))
+        assert child3.modification_date > child3.creation_date
+
+    def test_cleanup_user_groups(self, db_session, events, extra_principals):
+        from kotti import DBSession
+        from kotti.events import notify
+        from kotti.events import UserDeleted
+        from kotti.resources import get_root
+        from kotti.security import get_principals
+        from kotti.security import list_groups_raw
+        from kotti.security import set_groups
+
+        principals = get_principals()
+        principals[u'bob'].groups = [u'group:bobsgroup', u'role:editor']
+        principals[u'frank'].groups = [u'group:bobsgroup']
+        set_groups(u'group:bobsgroup', get_root(), [u'role:owner'])
+        DBSession.flush()
+
+        group = principals[u'group:bobsgroup']
+        notify(UserDeleted(group))
+        # Members that are already loaded are up to date:
+        assert principals[u'bob'].groups == [u'role:editor']
+        del principals[u'group:bobsgroup']
+        DBSession.flush()
+
+        assert principals[u'bob'].groups == [u'role:editor']
+        assert principals[u'frank'].groups == []
+        assert list_groups_raw(u'group:bobsgroup', get_root()) == set()
+
+
+class TestDispatcher:
+    def test_keys_added_later(self):
+        from kotti.events import Dispatcher
+
+        class Event(object):
+            pass
+
+        dispatcher = Dispatcher()
+        dispatcher[object].append(lambda event: 'object')
+        assert dispatcher(Event()) == ['object']
+        dispatcher[Event].append(lambda event: 'event')
+        assert dispatcher(Event()) == ['object', 'event']
+        dispatcher[object].append(lambda event: 'object again')
+        assert dispatcher(Event()) == ['object', 'object again', 'event']
+
+    def test_keys_removed(self):
+        from kotti.events import Dispatcher
+
+        class Event(object):
+            pass
+
+        dispatcher = Dispatcher()
+        dispatcher[object].append(lambda event: 'object')
+        dispatcher[Event].append(lambda event: 'event')
+        assert dispatcher(Event()) == ['object', 'event']
+        del dispatcher[object]
+        assert dispatcher(Event()) == ['event']
+        dispatcher.pop(Event)
+        assert dispatcher(Event()) == []
+        dispatcher[Event].append(lambda event: 'event')
+        dispatcher.clear()
+        assert dispatcher(Event()) == []
+        assert Event not in dispatcher
+
+    def test_matching_is_cached(self):
+        from kotti.events import ObjectEventDispatcher
+        from kotti.events import ObjectInsert
+
+        dispatcher = ObjectEventDispatcher()
+        dispatcher[(ObjectInsert, None)].append(lambda event: 'insert')
+        with patch.object(ObjectEventDispatcher, '_matches') as matches:
+            matches.return_value = True
+            dispatcher(ObjectInsert(object()))
+            dispatcher(ObjectInsert(object()))
+            assert matches.call_count == 1
+            dispatcher(ObjectInsert(1))
+            assert matches.call_count == 2
+
+    def test_handles(self):
+        from kotti.events import Dispatcher
+        from kotti.events import ObjectEvent
+        from kotti.events import ObjectEventDispatcher
+        from kotti.events import ObjectInsert
+        from kotti.events import ObjectUpdate
+        from kotti.resources import Content
+        from kotti.resources import Document
+
+        dispatcher = Dispatcher()
+        objectevent_dispatcher = ObjectEventDispatcher()
+        dispatcher[ObjectEvent].append(objectevent_dispatcher)
+        assert not dispatcher.handles(ObjectInsert(Document()))
+        objectevent_dispatcher[(ObjectInsert, Document)].append(
+            lambda event: None)
+        assert dispatcher.handles(ObjectInsert(Document()))
+        assert not dispatcher.handles(ObjectInsert(Content()))
+        assert not dispatcher.handles(ObjectUpdate(Document()))
+        dispatcher[ObjectUpdate].append(lambda event: None)
+        assert dispatcher.handles(ObjectUpdate(Content()))
+
+
+class TestAfterCommit:
+    def after_commit_hooks(self):
+        import transaction
+        return list(transaction.get().getAfterCommitHooks())
+
+    def test_deferred_until_commit(self, db_session, events):
+        from kotti import DBSession
+        from kotti.events import after_commit_objectevent_listeners
+        from kotti.events import ObjectInsert
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        events.registry.settings['kotti.after_commit_threads'] = '0'
+        after_commit_objectevent_listeners[(ObjectInsert, Content)].append(
+            lambda event: None)
+
+        with patch('kotti.events.run_after_commit_listeners') as run:
+            child1 = get_root()[u'child1'] = Content()
+            child2 = get_root()[u'child2'] = Content()
+            DBSession.flush()
+            child1.title = u'Changed'
+            DBSession.flush()
+            assert not run.called
+
+            # Events of one transaction are collected with one hook:
+            [(hook, args, kws)] = self.after_commit_hooks()
+            hook(False, *args, **kws)
+            assert not run.called
+            hook(True, *args, **kws)
+            assert run.call_count == 1
+
+        # Only the events that there are listeners for are kept:
+        deferred = run.call_args[0][0]
+        assert [event.__class__ for event in deferred] == [ObjectInsert] * 2
+        assert set(event.object for event in deferred) == set(
+            [child1, child2])
+
+    def test_no_listeners(self, db_session, events):
+        from kotti import DBSession
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        get_root()[u'child'] = Content()
+        DBSession.flush()
+        assert self.after_commit_hooks() == []
+
+    def test_run_after_commit_listeners(self, db_session, events):
+        from kotti import DBSession
+        from kotti.events import after_commit_objectevent_listeners
+        from kotti.events import run_after_commit_listeners
+        from kotti.events import ObjectDelete
+        from kotti.events import ObjectEvent
+        from kotti.events import ObjectInsert
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        called = []
+        after_commit_objectevent_listeners[(ObjectEvent, Content)].append(
+            lambda event: called.append(event.object))
+
+        root = get_root()
+        child = root[u'child'] = Content()
+        DBSession.flush()
+        # Objects are detached after the commit:
+        DBSession.expunge(child)
+        with patch('kotti.events.transaction') as transaction:
+            run_after_commit_listeners([ObjectInsert(child)])
+        assert transaction.manager.__enter__.call_count == 1
+        [obj] = called
+        assert obj is not child
+        assert obj.id == child.id
+
+        # Deleted objects can't be loaded again:
+        del called[:]
+        DBSession.delete(obj)
+        DBSession.flush()
+        with patch('kotti.events.transaction'):
+            run_after_commit_listeners([ObjectDelete(obj)])
+        assert called == [obj]
+
+    def test_errors_are_logged(self, db_session, events):
+        from kotti.events import after_commit_listeners
+        from kotti.events import run_after_commit_listeners
+
+        class Event(object):
+            pass
+
+        def fail(event):
+            raise ValueError()
+
+        after_commit_listeners[Event].append(fail)
+        with patch('kotti.events.transaction') as transaction:
+            transaction.manager.__exit__.return_value = False
+            with patch('kotti.events.logger') as logger:
+                run_after_commit_listeners([Event()])
+        assert logger.exception.call_count == 1
+
+    def test_worker_threads(self, db_session, events):
+        from threading import current_thread
+        from kotti.events import after_commit_listeners
+        from kotti.events import notify
+        from kotti.events import shutdown
+
+        class Event(object):
+            pass
+
+        events.registry.settings['kotti.after_commit_threads'] = '1'
+        threads = []
+        after_commit_listeners[Event].append(
+            lambda event: threads.append(current_thread().name))
+        notify(Event())
+        notify(Event())
+        [(hook, args, kws)] = self.after_commit_hooks()
+        try:
+            hook(True, *args, **kws)
+        finally:
+            shutdown()
+        assert threads == ['kotti-after-commit-0'] * 2
+
+    def test_shutdown_at_exit(self):
+        import atexit
+        from kotti.events import shutdown
+
+        assert shutdown in [hook for hook, args, kws in atexit._exithandlers]
+
+    def test_worker_threads_see_settings(self, db_session, events):
+        from pyramid.threadlocal import get_current_request
+        from kotti import get_settings
+        from kotti.events import after_commit_listeners
+        from kotti.events import notify
+        from kotti.events import shutdown
+
+        class Event(object):
+            pass
+
+        events.registry.settings['kotti.after_commit_threads'] = '1'
+        seen = []
+        after_commit_listeners[Event].append(lambda event: seen.append(
+            (get_settings()['kotti.after_commit_threads'],
+             get_current_request())))
+        notify(Event())
+        [(hook, args, kws)] = self.after_commit_hooks()
+        try:
+            hook(True, *args, **kws)
+        finally:
+            shutdown()
+        assert seen == [('1', None)]
@@ -0,0 +1,174 @@
+from mock import Mock
+from mock import patch
+from pyramid.response import Response
+from sqlalchemy import create_engine
+
+from kotti.testing import DummyRequest
+
+
+class TestCollect:
+    def test_counts_statements(self):
+        from kotti.instrumentation import collect
+        from kotti.instrumentation import current_stats
+
+        engine = create_engine('sqlite://')
+        engine.execute('select 1')  # not recorded
+        with collect() as stats:
+            assert current_stats() is stats
+            engine.execute('select 1')
+            engine.execute('select 2')
+        assert current_stats() is None
+        engine.execute('select 3')
+
+        assert stats.count == 2
+        assert stats.duration >= 0
+        assert sorted(s for d, s in stats.slowest) == ['select 1', 'select 2']
+
+    def test_keeps_slowest(self):
+        from kotti.instrumentation import QueryStats
+
+        stats = QueryStats(keep_slowest=2)
+        stats.add('a', 0.3)
+        stats.add('b', 0.1)
+        stats.add('c', 0.5)
+        stats.add('d', 0.2)
+        assert stats.count == 4
+        assert round(stats.duration, 6) == 1.1
+        assert stats.slowest == [(0.5, 'c'), (0.3, 'a')]
+
+        stats = QueryStats(keep_slowest=0)
+        stats.add('a', 0.3)
+        assert stats.slowest == []
+
+
+class TestTween:
+    def make_tween(self, config, **settings):
+        from kotti.instrumentation import sql_stats_tween_factory
+
+        engine = create_engine('sqlite://')
+
+        def handler(request):
+            engine.execute('select 1')
+            return Response()
+
+        config.registry.settings.update(settings)
+        return sql_stats_tween_factory(handler, config.registry)
+
+    def test_environ_and_log(self, config):
+        from kotti.instrumentation import ENVIRON_KEY
+
+        tween = self.make_tween(config)
+        request = DummyRequest()
+        with patch('kotti.instrumentation.logger') as logger:
+            response = tween(request)
+
+        assert request.environ[ENVIRON_KEY].count == 1
+        assert 'X-Kotti-Queries' not in response.headers
+        args = logger.info.call_args[0]
+        assert args[0].startswith('sql_stats ')
+        assert args[3] == 1
+        assert logger.debug.call_count == 1
+
+    def test_headers(self, config):
+        tween = self.make_tween(config, **{
+            'kotti.sql_stats_headers': u'true',
+            'kotti.sql_stats_slowest': u'0',
+            })
+        response = tween(DummyRequest())
+        assert response.headers['X-Kotti-Queries'] == '1'
+        assert float(response.headers['X-Kotti-Query-Time']) >= 0
+
+    def test_includeme(self):
+        from kotti.instrumentation import includeme
+
+        config = Mock()
+        includeme(config)
+        config.add_tween.assert_called_with(
+            'kotti.instrumentation.sql_stats_tween_factory')
+
+
+class TestPhaseTimer:
+    def test_nested_phases_are_exclusive(self):
+        from kotti.instrumentation import PhaseTimer
+
+        request = DummyRequest()
+        with patch('kotti.instrumentation.time.time',
+                   side_effect=[0.0, 1.0, 3.0, 6.0, 10.0, 15.0]):
+            timer = PhaseTimer(request)  # 0.0
+            timer.switch('view')  # 1.0
+            timer.enter('authorization')  # 3.0
+            timer.exit()  # 6.0
+            timer.switch('render')  # 10.0
+            timer.finish()  # 15.0
+            timer.switch('ignored')
+        assert timer.phases == [
+            ('traversal', 1.0), ('view', 6.0), ('authorization', 3.0),
+            ('render', 5.0)]
+        assert timer.total == 15.0
+
+    def test_phase_without_timer(self):
+        from kotti.instrumentation import phase
+
+        with phase('anything'):
+            pass
+
+    def test_ring_buffer(self):
+        from kotti.instrumentation import RingBuffer
+
+        sink = RingBuffer(size=2)
+        for path in ('/a', '/b', '/c'):
+            sink(DummyRequest(path=path), [('view', 0.1)], 0.2)
+        assert [e['path'] for e in sink.entries] == ['/b', '/c']
+        sink.clear()
+        assert len(sink.entries) == 0
+
+
+class TestPhaseTimingTween:
+    def test_tween(self, config):
+        from pyramid.events import BeforeRender
+        from pyramid.events import ContextFound
+        from pyramid.events import NewResponse
+        from pyramid.interfaces import IAuthorizationPolicy
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from kotti.instrumentation import PHASES_ENVIRON_KEY
+        from kotti.instrumentation import TimedPolicy
+        from kotti.instrumentation import includeme_phase_timing
+        from kotti.instrumentation import phase
+        from kotti.instrumentation import phase_timing_tween_factory
+
+        config.set_authorization_policy(ACLAuthorizationPolicy())
+        includeme_phase_timing(config)
+        config.commit()
+        sink = Mock()
+        config.registry.settings['kotti.phase_timing_sinks'] = [sink]
+
+        def handler(request):
+            config.registry.notify(ContextFound(request))
+            policy = config.registry.getUtility(IAuthorizationPolicy)
+            policy.permits(None, [], 'view')
+            config.registry.notify(BeforeRender({'request': request}))
+            with phase('slots'):
+                pass
+            response = Response()
+            config.registry.notify(NewResponse(request, response))
+            return response
+
+        tween = phase_timing_tween_factory(handler, config.registry)
+        assert isinstance(
+            config.registry.getUtility(IAuthorizationPolicy), TimedPolicy)
+        request = DummyRequest()
+        tween(request)
+
+        timer = request.environ[PHASES_ENVIRON_KEY]
+        assert [name for name, duration in timer.phases] == [
+            'traversal', 'view', 'authorization', 'render', 'slots']
+        sink.assert_called_once_with(request, timer.phases, timer.total)
+
+    def test_log_phases(self):
+        from kotti.instrumentation import log_phases
+
+        with patch('kotti.instrumentation.timing_logger') as logger:
+            log_phases(DummyRequest(), [('view', 0.002)], 0.003)
+        line = logger.info.call_args[0][0] % logger.info.call_args[0][1:]
+        assert line == (
+            'phase_timing method=GET path=/ total_ms=3.0 view_ms=2.0')
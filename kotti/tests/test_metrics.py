@@ -0,0 +1,177 @@
+from mock import Mock
+from pyramid.response import Response
+import pytest
+
+from kotti.testing import DummyRequest
+
+
+class TestRegistry:
+    def test_get_or_create(self):
+        from kotti.metrics import Counter
+        from kotti.metrics import Registry
+
+        registry = Registry()
+        hits = registry.get_or_create(Counter, 'hits_total', 'Hits')
+        assert registry.get_or_create(Counter, 'hits_total', 'Hits') is hits
+
+    def test_type_mismatch(self):
+        from kotti.metrics import Counter
+        from kotti.metrics import Histogram
+        from kotti.metrics import Registry
+
+        registry = Registry()
+        registry.get_or_create(Counter, 'hits_total', 'Hits')
+        with pytest.raises(ValueError):
+            registry.get_or_create(Histogram, 'hits_total', 'Hits')
+
+    def test_labels_required(self):
+        from kotti.metrics import Counter
+
+        hits = Counter('hits_total', 'Hits', ['page'])
+        with pytest.raises(ValueError):
+            hits.inc()
+
+    def test_render_escapes_labels(self):
+        from kotti.metrics import Counter
+        from kotti.metrics import Registry
+
+        registry = Registry()
+        hits = registry.get_or_create(Counter, 'hits_total', 'Hits', ['page'])
+        hits.inc(page=u'say "\xe4"\n')
+        assert registry.render().splitlines()[-1] == (
+            'hits_total{page="say \\"\xc3\xa4\\"\\n"} 1.0')
+
+
+class TestInstrumentation:
+    def setup_method(self, method):
+        from kotti.metrics import registry
+        registry.clear()
+        registry.enable()
+
+    def teardown_method(self, method):
+        from kotti.metrics import registry
+        registry.enable(False)
+
+    def test_disabled(self, dummy_request):
+        from kotti.events import ObjectEvent
+        from kotti.events import ObjectEventDispatcher
+        from kotti.metrics import cache_requests
+        from kotti.metrics import event_dispatch
+        from kotti.metrics import registry
+        from kotti.util import request_cache
+
+        @request_cache(lambda x: x)
+        def double(x):
+            return x * 2
+
+        registry.enable(False)
+        double(1)
+        double(1)
+        ObjectEventDispatcher()(ObjectEvent(object()))
+        assert cache_requests.get(cache='request_cache', result='hit') == 0
+        assert event_dispatch.get(event='ObjectEvent')[0] == 0
+
+    def test_cache_requests(self, dummy_request):
+        from kotti.metrics import cache_requests
+        from kotti.util import request_cache
+
+        @request_cache(lambda x: x)
+        def double(x):
+            return x * 2
+
+        double(1)
+        double(1)
+        double(2)
+        assert cache_requests.get(cache='request_cache', result='hit') == 1
+        assert cache_requests.get(cache='request_cache', result='miss') == 2
+
+    def test_blob_bytes_served(self):
+        from kotti.metrics import blob_bytes_served
+        from kotti.resources import File
+        from kotti.views.file import inline_view
+
+        inline_view(File('12345', u'file.txt', u'text/plain'), DummyRequest())
+        assert blob_bytes_served.get(type='file') == 5
+
+    def test_event_dispatch(self):
+        from kotti.events import ObjectEvent
+        from kotti.events import ObjectEventDispatcher
+        from kotti.metrics import event_dispatch
+
+        ObjectEventDispatcher()(ObjectEvent(object()))
+        assert event_dispatch.get(event='ObjectEvent')[0] == 1
+
+    def test_tween(self, config):
+        from sqlalchemy import create_engine
+        from kotti.metrics import db_queries
+        from kotti.metrics import metrics_tween_factory
+        from kotti.metrics import request_duration
+
+        engine = create_engine('sqlite://')
+
+        def handler(request):
+            engine.execute('select 1')
+            return Response(status=request.status)
+
+        tween = metrics_tween_factory(handler, config.registry)
+        request = DummyRequest(status='200 OK')
+        request.view_name = u'edit'
+        tween(request)
+        request = DummyRequest(status='404 Not Found')
+        request.view_name = u'no-such-thing'
+        tween(request)
+
+        assert request_duration.get(view=u'edit')[0] == 1
+        assert request_duration.get(view=u'notfound')[0] == 1
+        assert db_queries.get() == 2
+
+    def test_tween_error(self, config):
+        from kotti.metrics import metrics_tween_factory
+        from kotti.metrics import request_duration
+
+        def handler(request):
+            raise ValueError()
+
+        tween = metrics_tween_factory(handler, config.registry)
+        with pytest.raises(ValueError):
+            tween(DummyRequest())
+        assert request_duration.get(view='error')[0] == 1
+
+
+class TestView:
+    def setup_method(self, method):
+        from kotti.metrics import registry
+        registry.enable()
+
+    def teardown_method(self, method):
+        from kotti.metrics import registry
+        registry.enable(False)
+
+    def test_metrics_view(self):
+        from kotti.metrics import counter
+        from kotti.metrics import metrics_view
+
+        counter('kotti_test_total', 'Test').inc()
+        response = metrics_view(None, DummyRequest())
+        assert response.content_type == 'text/plain'
+        assert 'kotti_test_total 1.0' in response.body.splitlines()
+
+    def test_includeme(self):
+        from kotti.metrics import includeme
+        from kotti.metrics import metrics_view
+        from kotti.metrics import registry
+
+        config = Mock()
+        config.get_settings.return_value = {}
+        registry.enable(False)
+        includeme(config)
+        config.add_view.assert_called_with(
+            metrics_view, name='metrics', permission='admin')
+        assert registry.enabled
+        assert registry.metrics['kotti_cache_requests_total'].enabled
+
+        config.get_settings.return_value = {'kotti.metrics_port': u'9100'}
+        includeme(config)
+        predicate = config.add_view.call_args[1]['custom_predicates'][0]
+        assert predicate(None, Mock(server_port=9100))
+        assert not predicate(None, Mock(server_port=80))
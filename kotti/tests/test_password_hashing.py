@@ -0,0 +1,87 @@
+import bcrypt
+from mock import patch
+
+from kotti.testing import DummyRequest
+
+
+class TestHashing:
+    def test_hashpw_inline(self, config):
+        from kotti.password_hashing import _get_pool
+        from kotti.password_hashing import hashpw
+
+        salt = bcrypt.gensalt(4)
+        assert _get_pool() is None
+        assert hashpw('secret', salt) == bcrypt.hashpw('secret', salt)
+
+    def test_hashpw_pool(self, config):
+        from kotti.password_hashing import _get_pool
+        from kotti.password_hashing import hashpw
+        from kotti.password_hashing import shutdown
+
+        config.registry.settings['kotti.bcrypt_threads'] = '1'
+        salt = bcrypt.gensalt(4)
+        try:
+            assert _get_pool() is not None
+            assert hashpw('secret', salt) == bcrypt.hashpw('secret', salt)
+        finally:
+            shutdown()
+
+    def test_calibrate_log_rounds(self):
+        from kotti.password_hashing import calibrate_log_rounds
+
+        # Hashing with 8 rounds takes 10ms, so 80ms buys us 3 more:
+        with patch('kotti.password_hashing.time.time',
+                   side_effect=[0.0, 0.01]):
+            assert calibrate_log_rounds(80.0, minimum=4) == 11
+        with patch('kotti.password_hashing.time.time',
+                   side_effect=[0.0, 0.01]):
+            assert calibrate_log_rounds(1.0) == 10
+        with patch('kotti.password_hashing.time.time',
+                   side_effect=[0.0, 0.01]):
+            assert calibrate_log_rounds(10000000.0) == 16
+
+    def test_includeme(self, config):
+        from kotti.password_hashing import includeme
+        from kotti.security import Principals
+
+        with patch.object(Principals, 'log_rounds', 10):
+            includeme(config)
+            assert Principals.log_rounds == 10
+
+            config.registry.settings['kotti.bcrypt_target_ms'] = u'250'
+            with patch('kotti.password_hashing.calibrate_log_rounds',
+                       return_value=12) as calibrate:
+                includeme(config)
+            calibrate.assert_called_with(250.0)
+            assert Principals.log_rounds == 12
+
+
+class TestRehash:
+    def test_needs_rehash(self, db_session):
+        from kotti.security import get_principals
+
+        principals = get_principals()
+        with patch.object(principals, 'log_rounds', 5):
+            assert principals.needs_rehash(u'$2a$04$' + u'x' * 53)
+            assert not principals.needs_rehash(u'$2a$05$' + u'x' * 53)
+            assert not principals.needs_rehash(u'not a hash')
+
+    def test_login_upgrades_hash(self, db_session):
+        from kotti.password_hashing import log_rounds_of
+        from kotti.security import Principals
+        from kotti.security import get_principals
+        from kotti.views.login import login
+
+        with patch.object(Principals, 'log_rounds', 4):
+            get_principals()[u'bob'] = dict(name=u'bob', password=u'secret')
+        bob = get_principals()[u'bob']
+        assert log_rounds_of(bob.password) == 4
+
+        request = DummyRequest()
+        request.params['submit'] = u'on'
+        request.params['login'] = u'bob'
+        request.params['password'] = u'secret'
+        with patch.object(Principals, 'log_rounds', 5):
+            assert login(None, request).status == '302 Found'
+        assert log_rounds_of(bob.password) == 5
+        assert get_principals().validate_password(u'secret', bob.password)
@@ -0,0 +1,113 @@
+import marshal
+import threading
+
+from mock import patch
+import pytest
+
+from kotti.testing import DummyRequest
+
+
+def _busy(started, stop):
+    started.set()
+    while not stop.is_set():
+        stop.wait(0.001)
+
+
+class TestSampler:
+    def test_samples_other_threads(self):
+        from kotti.profiler import Sampler
+
+        started, stop = threading.Event(), threading.Event()
+        thread = threading.Thread(
+            target=_busy, args=(started, stop), name='busy')
+        thread.start()
+        started.wait()
+        try:
+            sampler = Sampler()
+            sampler.sample()
+            sampler.sample()
+        finally:
+            stop.set()
+            thread.join()
+
+        assert sampler.samples == 2
+        lines = [line for line in sampler.collapsed().splitlines()
+                 if line.startswith('busy;')]
+        assert len(lines) >= 1
+        assert 'kotti.tests.test_profiler._busy' in lines[0]
+        assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == 2
+
+    def test_annotations(self):
+        from kotti.profiler import Sampler
+        from kotti.security import has_permission
+
+        sampler = Sampler()
+        frame = type('Frame', (), {
+            'f_code': has_permission.func_code,
+            'f_globals': has_permission.func_globals})
+        key = sampler._key(frame)
+        assert sampler.labels[key] == (
+            'kotti.security.has_permission [authorization]')
+
+    def test_templates(self, tmpdir):
+        from chameleon.zpt.template import PageTemplateFile
+        from kotti.profiler import Sampler
+
+        started, stop = threading.Event(), threading.Event()
+        tmpdir.join('busy.pt').write(
+            '<p tal:content="busy(started, stop)" />')
+        template = PageTemplateFile(str(tmpdir.join('busy.pt')))
+        thread = threading.Thread(
+            target=template, name='render',
+            kwargs=dict(busy=_busy, started=started, stop=stop))
+        thread.start()
+        started.wait()
+        try:
+            sampler = Sampler()
+            sampler.sample()
+        finally:
+            stop.set()
+            thread.join()
+
+        [line] = [line for line in sampler.collapsed().splitlines()
+                  if line.startswith('render;')]
+        assert ';busy.render [template];' in line
+
+    def test_pstats(self):
+        from kotti.profiler import Sampler
+
+        sampler = Sampler(interval=0.5)
+        thread, a, b = ('<thread>', 0, 'main'), ('m', 1, 'a'), ('m', 2, 'b')
+        sampler.stacks = {(thread, a, b): 3, (thread, a): 1}
+        stats = marshal.loads(sampler.pstats())
+        assert stats[a] == (4, 4, 0.5, 2.0, {})
+        assert stats[b] == (3, 3, 1.5, 1.5, {a: 3})
+
+
+class TestProfileView:
+    def test_collapsed(self):
+        from kotti.views.profile import profile_view
+
+        request = DummyRequest(params={'seconds': '100'})
+        with patch('kotti.views.profile.profile') as profile:
+            profile.return_value.collapsed.return_value = 'a;b 1\n'
+            response = profile_view(None, request)
+        profile.assert_called_with(60)
+        assert response.body == 'a;b 1\n'
+
+    def test_pstats(self):
+        from kotti.views.profile import profile_view
+
+        request = DummyRequest(params={'seconds': '0.1', 'format': 'pstats'})
+        response = profile_view(None, request)
+        assert response.content_type == 'application/octet-stream'
+        assert isinstance(marshal.loads(response.body), dict)
+
+    def test_bad_params(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from kotti.views.profile import profile_view
+
+        with pytest.raises(HTTPBadRequest):
+            profile_view(None, DummyRequest(params={'seconds': 'x'}))
+        with pytest.raises(HTTPBadRequest):
+            profile_view(None, DummyRequest(params={'format': 'x'}))
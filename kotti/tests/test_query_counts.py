@@ -0,0 +1,97 @@
+import json
+
+from pyramid.traversal import find_resource
+from pytest import fixture
+from pytest import mark
+
+from kotti.testing import asset
+from kotti.testing import assert_max_queries
+
+#: Maps the names of the views in 'query_counts.json' to the requests
+#: that are counted
+REQUESTS = [
+    ('view', 'GET', '/doc-1-0/', None),
+    ('folder_view', 'GET', '/doc-1-0/@@folder_view', None),
+    ('contents', 'GET', '/doc-1-0/@@contents', None),
+    ('share', 'GET', '/doc-1-0/@@share', None),
+    ('setup-users', 'GET', '/@@setup-users', None),
+    ('navigate', 'GET', '/doc-1-0/@@navigate', None),
+    ('search-results', 'POST', '/@@search-results',
+     {'search-term': 'Document'}),
+    ('tag', 'GET', '/@@tag?tag=tag-0', None),
+    ('tag-cloud', 'GET', '/@@tag-cloud', None),
+    ]
+
+
+def query_counts():
+    return json.load(asset('query_counts.json'))
+
+
+@fixture
+def site(db_session):
+    from kotti.benchmarks.site import SiteSpec
+    from kotti.benchmarks.site import build_site
+    from kotti.resources import get_root
+    from kotti.security import set_groups
+    from kotti.workflow import get_workflow
+
+    root = get_root()
+    # The root was populated without the workflow.  Give it a state,
+    # so that it's not initialized (and its ACL replaced) on the
+    # first request:
+    root.state = u'public'
+    site = build_site(root, SiteSpec(
+        depth=2, fanout=3, users=5, groups=2, local_roles=5, tags=3,
+        files=2, images=0))
+    # Like documents that admin added and published:
+    for path in site.documents:
+        node = find_resource(root, path.encode('utf-8'))
+        node.owner = u'admin'
+        set_groups(u'admin', node, [u'role:owner'])
+        get_workflow(node).transition_to_state(node, None, u'public')
+    db_session.flush()
+    return site
+
+
+class TestAssertMaxQueries:
+    def test_passes(self, db_session):
+        from kotti.resources import get_root
+
+        with assert_max_queries(1) as stats:
+            get_root()
+        assert stats.count == 1
+
+    def test_fails(self, db_session):
+        from kotti.resources import Node
+
+        try:
+            with assert_max_queries(1):
+                db_session.query(Node).all()
+                db_session.query(Node).all()
+        except AssertionError as e:
+            assert '2 statements executed, expected at most 1' in str(e)
+            assert 'FROM nodes' in str(e)
+        else:  # pragma: no cover
+            assert False, "No AssertionError raised"
+
+
+class TestQueryCounts:
+    def test_all_views_counted(self):
+        assert sorted(query_counts()) == sorted(r[0] for r in REQUESTS)
+
+    @mark.parametrize(('view', 'method', 'path', 'params'), REQUESTS)
+    def test_view(self, app, site, view, method, path, params):
+        app.post('/@@login', dict(
+            login='admin', password='secret', submit='submit'))
+
+        def request_view():
+            if method == 'POST':
+                res = app.post(path, params)
+            else:
+                res = app.get(path)
+            assert res.status_int == 200, (res.status, res.location)
+
+        # Count the second request only; the first one fills caches:
+        request_view()
+        with assert_max_queries(query_counts()[view]):
+            request_view()
@@ -1,3 +1,6 @@
+from mock import patch
+from pytest import fixture
+
 from kotti.testing import DummyRequest
 
 
@@ -48,6 +51,48 @@ class TestSearch:
         assert results[0]['title'] == 'First File'
         assert results[0]['path'] == '/doc1/file1/'
 
+    def test_search_content_ranked(self, db_session):
+        from kotti.resources import Document
+        from kotti.resources import get_root
+        from kotti.views.util import search_content
+
+        root = get_root()
+        root[u'body'] = Document(title=u'One', body=u'apple')
+        root[u'apple'] = Document(title=u'Two')
+        root[u'title'] = Document(title=u'Apple')
+        root[u'description'] = Document(title=u'Three', description=u'apple')
+        results = search_content(u'apple', DummyRequest())
+        assert [r['name'] for r in results] == [
+            u'title', u'apple', u'description', u'body']
+
+    def test_search_content_paged(self, config, db_session):
+        from kotti.views.util import default_search_content
+        from kotti.views.util import search_content
+
+        create_contents()
+        request = DummyRequest()
+        results = search_content(u'Document', request, limit=2, offset=1)
+        assert [r['name'] for r in results] == [u'doc11', u'doc12']
+
+        # Items the user may not view don't count:
+        with patch('kotti.views.util.has_permission',
+                   lambda permission, context, request:
+                   context.name != u'doc11'):
+            results = default_search_content(
+                u'Document', request, limit=2, offset=1, batch_size=1)
+        assert [r['name'] for r in results] == [u'doc12', u'']
+
+    def test_search_function_without_paging(self, db_session):
+        from kotti import get_settings
+        from kotti.views.util import search_content
+
+        def search(search_term, request):
+            return range(10)
+        get_settings()['kotti.search_content'] = [search]
+        assert search_content(u'foo') == range(10)
+        assert search_content(u'foo', limit=3, offset=2) == [2, 3, 4]
+        assert search_content(u'foo', offset=8) == [8, 9]
+
     def test_search_content_without_permission(self, config, db_session):
         from kotti.views.util import search_content
         request = DummyRequest()
@@ -55,3 +100,261 @@ class TestSearch:
         config.testing_securitypolicy(permissive=False)
         results = search_content(u'Document', request)
         assert len(results) == 0
+
+
+class TestSearchIndex:
+    def terms(self, node):
+        from kotti import DBSession
+        from kotti.resources import SearchTerm
+
+        return dict(DBSession.query(SearchTerm.term, SearchTerm.weight)
+                    .filter(SearchTerm.node_id == node.id))
+
+    def search(self, search_term):
+        from kotti.search import search_content
+
+        return [result['name'] for result in
+                search_content(search_term, DummyRequest())]
+
+    def test_tokenize(self):
+        from kotti.search import tokenize
+
+        assert tokenize(None) == []
+        assert tokenize(u'My-Document_2') == [u'my', u'document_2']
+        assert tokenize(u'K\xf6nig &amp; <em>Queen</em>') == [
+            u'k\xf6nig', u'queen']
+
+    def test_index_maintained(self, db_session, events):
+        from kotti.resources import Document
+        from kotti.resources import get_root
+
+        events.include('kotti.search')
+        root = get_root()
+        doc = root[u'doc'] = Document(
+            title=u'Hello World', description=u'Hello',
+            body=u'<p>Some body</p>')
+        db_session.flush()
+        assert self.terms(doc) == {
+            u'hello': 10, u'world': 8, u'doc': 4, u'some': 1, u'body': 1}
+
+        doc.body = u'Another body'
+        db_session.flush()
+        assert u'another' in self.terms(doc)
+        assert u'some' not in self.terms(doc)
+
+        del root[u'doc']
+        db_session.flush()
+        assert self.terms(doc) == {}
+
+    def test_unchanged_fields_not_reindexed(self, db_session, events):
+        from kotti.resources import Document
+        from kotti.resources import get_root
+
+        events.include('kotti.search')
+        doc = get_root()[u'doc'] = Document(title=u'Hello')
+        db_session.flush()
+        with patch('kotti.search._rows') as rows:
+            doc.mime_type = 'text/plain'
+            db_session.flush()
+        assert not rows.called
+
+    @fixture
+    def search_index(self, events):
+        events.include('kotti.security_index')
+        events.include('kotti.search')
+        return events
+
+    def test_search_content(self, db_session, search_index):
+        create_contents()
+        db_session.flush()
+
+        assert self.search(u'First Document') == [u'doc1']
+        assert self.search(u'docu') == [u'doc1', u'doc11', u'doc12']
+        assert self.search(u'this is a file') == [u'file1']
+        assert self.search(u'nothing') == []
+        assert self.search(u'  ') == []
+
+    def test_search_content_ranked(self, db_session, search_index):
+        from kotti.resources import Document
+        from kotti.resources import get_root
+
+        root = get_root()
+        root[u'body'] = Document(title=u'One', body=u'apple')
+        root[u'title'] = Document(title=u'Apple')
+        root[u'description'] = Document(title=u'Two', description=u'apple')
+        db_session.flush()
+
+        assert self.search(u'apple') == [u'title', u'description', u'body']
+
+    def test_search_content_non_ascii(self, db_session, search_index):
+        from kotti.resources import Document
+        from kotti.resources import get_root
+
+        root = get_root()
+        root[u'koenig'] = Document(title=u'K\xf6nigin')
+        root[u'konig'] = Document(title=u'Konig')
+        db_session.flush()
+
+        assert self.search(u'K\xd6N') == [u'koenig']
+        assert self.search(u'kon') == [u'konig']
+
+    def test_search_content_paged(self, db_session, search_index):
+        from kotti.search import search_content
+
+        create_contents()
+        db_session.flush()
+        request = DummyRequest()
+
+        results = search_content(u'document', request, limit=2)
+        assert [r['name'] for r in results] == [u'doc1', u'doc11']
+        results = search_content(u'document', request, limit=2, offset=2)
+        assert [r['name'] for r in results] == [u'doc12']
+
+    def test_search_content_filters_allowed(self, db_session, search_index):
+        from pyramid.security import DENY_ALL
+
+        doc1, doc11, doc12, file1 = create_contents()
+        doc1.__acl__ = [DENY_ALL]
+        db_session.flush()
+        assert self.search(u'Document') == []
+
+    def make_facets(self, db_session):
+        from datetime import datetime
+        from datetime import timedelta
+        from kotti.resources import Content
+
+        doc1, doc11, doc12, file1 = create_contents()
+        doc1.tags = [u'red', u'blue']
+        db_session.flush()
+        doc11.tags = [u'red']
+        doc1.owner = doc11.owner = u'bob'
+        doc1.state = u'public'
+        db_session.flush()
+        # Not through the ORM, which would set the date to now:
+        contents = Content.__table__
+        for node, days in ((doc1, 3), (doc11, 3), (doc12, 100), (file1, 3)):
+            db_session.execute(contents.update().where(
+                contents.c.id == node.id).values(
+                modification_date=datetime.now() - timedelta(days=days)))
+
+    def test_search_facets(self, db_session, search_index):
+        from kotti.search import search_facets
+
+        self.make_facets(db_session)
+        facets = search_facets(u'first', DummyRequest())
+        assert facets == {
+            'type': [(u'content', 1), (u'file', 1)],
+            'tag': [(u'blue', 1), (u'red', 1)],
+            'state': [(u'public', 1)],
+            'owner': [(u'bob', 1)],
+            'modified': [('week', 2), ('month', 2), ('year', 2)],
+            }
+
+        facets = search_facets(u'document', DummyRequest())
+        assert facets['type'] == [(u'content', 3)]
+        assert facets['tag'] == [(u'red', 2), (u'blue', 1)]
+        assert facets['modified'] == [
+            ('week', 2), ('month', 2), ('year', 3)]
+        assert search_facets(u'document', DummyRequest(), limit=1)[
+            'tag'] == [(u'red', 2)]
+        assert search_facets(u'', DummyRequest())['tag'] == []
+
+    def test_search_filters(self, db_session, search_index):
+        from kotti.search import search_content
+        from kotti.search import search_facets
+
+        self.make_facets(db_session)
+
+        def search(**filters):
+            return [result['name'] for result in search_content(
+                u'document', DummyRequest(), filters=filters)]
+        assert search(tag=u'red') == [u'doc1', u'doc11']
+        assert search(tag=u'blue', owner=u'bob') == [u'doc1']
+        assert search(state=u'public') == [u'doc1']
+        assert search(type=u'file') == []
+        assert search(modified='week') == [u'doc1', u'doc11']
+        assert search(modified='unknown') == [u'doc1', u'doc11', u'doc12']
+
+        facets = search_facets(
+            u'document', DummyRequest(), filters={'tag': u'blue'})
+        assert facets['tag'] == [(u'blue', 1), (u'red', 1)]
+        assert facets['owner'] == [(u'bob', 1)]
+
+    def test_reindex_all(self, db_session, events):
+        from kotti.search import reindex_all
+        from kotti.security_index import reindex_all as reindex_allowed
+
+        doc1, doc11, doc12, file1 = create_contents()
+        db_session.flush()
+        reindex_allowed()
+        assert self.search(u'document') == []
+
+        reindex_all()
+        assert self.terms(file1) == {
+            u'first': 8, u'file': 10, u'file1': 4, u'this': 2, u'is': 2,
+            u'a': 2}
+        # The front page has 'Documentation' in its body:
+        assert self.search(u'document') == [
+            u'doc1', u'doc11', u'doc12', u'']
+
+
+class TestSearchResultsView:
+    def search_results(self, **params):
+        from kotti.resources import get_root
+        from kotti.views.view import search_results
+
+        with patch('kotti.views.view.SEARCH_RESULTS_PER_PAGE', 2):
+            return search_results(get_root(), DummyRequest(params=params))
+
+    def test_no_search_term(self, db_session):
+        assert self.search_results() == {
+            'results': [], 'facets': [], 'previous_url': None,
+            'next_url': None}
+
+    def test_paged(self, db_session):
+        create_contents()
+
+        page = self.search_results(**{'search-term': u'Document'})
+        assert [r['name'] for r in page['results']] == [u'doc1', u'doc11']
+        assert page['previous_url'] is None
+        assert page['next_url'] == (
+            'http://example.com/@@search-results?search-term=Document&page=2')
+
+        page = self.search_results(**{'search-term': u'Document', 'page': 2})
+        assert [r['name'] for r in page['results']] == [u'doc12', u'']
+        assert page['previous_url'].endswith('page=1')
+        assert page['next_url'] is None
+
+    def test_facets(self, db_session, events):
+        from kotti import get_settings
+        from kotti.search import search_content
+        from kotti.search import search_facets
+
+        events.include('kotti.security_index')
+        events.include('kotti.search')
+        get_settings()['kotti.search_content'] = [search_content]
+        get_settings()['kotti.search_facets'] = [search_facets]
+        doc1, doc11, doc12, file1 = create_contents()
+        doc1.tags = [u'red']
+        db_session.flush()
+
+        page = self.search_results(**{'search-term': u'first'})
+        assert [facet['name'] for facet in page['facets']] == [
+            'type', 'tag', 'modified']
+        types = page['facets'][0]['values']
+        assert [(t['label'], t['count'], t['active']) for t in types] == [
+            (u'content', 1, False), (u'File', 1, False)]
+        assert 'type=file' in types[1]['url']
+
+        page = self.search_results(**{'search-term': u'first',
+                                      'type': u'file'})
+        assert [r['name'] for r in page['results']] == [u'file1']
+        [file_type] = page['facets'][0]['values']
+        assert file_type['active']
+        assert 'type=' not in file_type['url']
+
+    def test_invalid_page(self, db_session):
+        create_contents()
+        page = self.search_results(**{'search-term': u'Document',
+                                      'page': u'x'})
+        assert [r['name'] for r in page['results']] == [u'doc1', u'doc11']
@@ -1,6 +1,11 @@
+from datetime import datetime
+import time
+
 from mock import patch
 from pytest import raises
 from pyramid.authentication import CallbackAuthenticationPolicy
+from pyramid.security import Authenticated
+from pyramid.security import Everyone
 
 from kotti.testing import DummyRequest
 
@@ -169,6 +174,25 @@ class TestGroups:
             set(['group:bobsgroup', 'role:owner', 'role:editor']))
         assert inherited == ['role:editor']
 
+    def test_local_groups_loaded_once_per_request(self, db_session,
+                                                  dummy_request):
+        from kotti.resources import get_root
+        from kotti.security import list_groups
+        from kotti.security import list_groups_raw
+
+        self.add_some_groups()
+        grandchild = get_root()[u'child'][u'grandchild']
+        assert 'role:owner' in list_groups('bob', grandchild)
+
+        # The local groups of the whole lineage are now loaded and
+        # asking again for any of the nodes won't query:
+        with patch('kotti.security.DBSession') as session:
+            assert (list_groups_raw(u'group:franksgroup', grandchild) ==
+                    set(['role:owner', 'group:bobsgroup']))
+            assert (list_groups_raw(u'bob', get_root()) ==
+                    set(['group:bobsgroup']))
+        assert session.query.call_count == 0
+
     def test_works_with_auth(self, db_session):
         from kotti import DBSession
         from kotti.resources import get_root
@@ -448,6 +472,142 @@ class TestPrincipals:
         assert (set(list_groups('bob', child)) ==
             set(['group:bobsgroup', 'role:editor', 'group:foogroup']))
 
+    def test_groups_stored_in_table(self, db_session):
+        from kotti import DBSession
+        from kotti.security import PrincipalGroup
+
+        bob = self.make_bob()
+        bob.groups = [u'role:editor', u'group:bobsgroup']
+        bob.groups.append(u'group:franksgroup')
+        DBSession.flush()
+        DBSession.expire_all()
+
+        assert bob.groups == [
+            u'role:editor', u'group:bobsgroup', u'group:franksgroup']
+        rows = DBSession.query(
+            PrincipalGroup.group_name, PrincipalGroup.position).filter(
+            PrincipalGroup.principal_name == u'bob').order_by(
+            PrincipalGroup.position).all()
+        assert rows == [
+            (u'role:editor', 0), (u'group:bobsgroup', 1),
+            (u'group:franksgroup', 2)]
+
+        del self.get_principals()[u'bob']
+        DBSession.flush()
+        assert DBSession.query(PrincipalGroup).filter(
+            PrincipalGroup.principal_name == u'bob').count() == 0
+
+    def test_email_normalized(self, db_session):
+        users = self.get_principals()
+        users[u'frank'] = dict(name=u'frank', email=u' Frank@Example.COM')
+        assert users[u'frank'].email == u'frank@example.com'
+
+    def test_find_by_login(self, db_session):
+        users = self.get_principals()
+        self.make_bob()
+        # A principal whose name looks like Bob's email:
+        users[u'bob@dabolina.com'] = dict(name=u'bob@dabolina.com')
+        users[u'frank'] = dict(name=u'frank', email=u'frank@example.com')
+
+        assert users.find_by_login(u'bob').name == u'bob'
+        assert users.find_by_login(u'Frank@Example.com').name == u'frank'
+        assert (users.find_by_login(u'bob@dabolina.com').name ==
+                u'bob@dabolina.com')
+        assert users.find_by_login(u'joe') is None
+        assert users.find_by_login(u'joe@example.com') is None
+
+    def test_search_prefix(self, db_session):
+        users = self.get_principals()
+        self.make_bob()
+        users[u'group:bobsgroup'] = dict(
+            name=u'group:bobsgroup', title=u"Bob's Group")
+        users[u'frank'] = dict(
+            name=u'frank', title=u'Frank Bobbins', email=u'frank@bob.org')
+
+        def names(term, **kwargs):
+            return [p.name for p in users.search_prefix(term, **kwargs)]
+
+        assert names(u'BOB') == [u'bob', u'group:bobsgroup']
+        assert names(u'bobsgr') == [u'group:bobsgroup']
+        assert names(u'frank bob') == [u'frank']
+        assert names(u'frank@') == [u'frank']
+        assert names(u'dabolina') == []
+        assert names(u'', limit=2) == [u'admin', u'bob']
+        assert names(u'', limit=2, after=u'bob') == [
+            u'frank', u'group:bobsgroup']
+
+        users[u'joerg'] = dict(name=u'joerg', title=u'\xc4rger J\xf6rg')
+        assert names(u'\xe4r') == [u'joerg']
+        assert names(u'\xc4R') == [u'joerg']
+        assert names(u'\xe4rger j\xf6') == [u'joerg']
+        assert names(u'\xe4rger-') == []
+
+    def test_groups_of(self, db_session):
+        users = self.get_principals()
+        self.make_bob()
+        users[u'frank'] = dict(name=u'frank')
+
+        assert users.groups_of([u'bob', u'frank', u'group:bobsgroup']) == {
+            u'bob': [u'group:bobsgroup'],
+            u'frank': [],
+            }
+        assert users.groups_of([]) == {}
+
+    def test_prime_principal_groups(self, db_session, dummy_request):
+        from kotti.security import global_groups
+        from kotti.security import prime_principal_groups
+
+        users = self.get_principals()
+        self.make_bob()
+        users[u'group:bobsgroup'] = dict(
+            name=u'group:bobsgroup', groups=[u'role:editor'])
+
+        prime_principal_groups([u'bob', u'admin'])
+        with patch('kotti.security.get_principals') as get_principals:
+            assert (global_groups(u'bob') ==
+                    set([u'group:bobsgroup', u'role:editor']))
+            assert global_groups(u'admin') == set([u'role:admin'])
+        assert get_principals.call_count == 0
+
+    def test_members(self, db_session):
+        users = self.get_principals()
+        self.make_bob()
+        users[u'frank'] = dict(name=u'frank', groups=[u'group:bobsgroup'])
+
+        assert ([p.name for p in users.members(u'group:bobsgroup')] ==
+                [u'bob', u'frank'])
+        assert [p.name for p in users.members(u'role:admin')] == [u'admin']
+        assert list(users.members(u'group:nobody')) == []
+
+    def test_principal_cache(self, db_session, dummy_request):
+        from kotti.security import global_groups
+
+        users = self.get_principals()
+        self.make_bob()
+        users[u'group:bobsgroup'] = dict(
+            name=u'group:bobsgroup', groups=[u'role:editor'])
+        assert (global_groups(u'bob') ==
+                set([u'group:bobsgroup', u'role:editor']))
+
+        with patch('kotti.security.get_principals') as get_principals:
+            assert (global_groups(u'bob') ==
+                    set([u'group:bobsgroup', u'role:editor']))
+        assert get_principals.call_count == 0
+
+        # Changing a principal's groups invalidates the cache:
+        users[u'group:bobsgroup'].groups = [u'role:owner']
+        assert (global_groups(u'bob') ==
+                set([u'group:bobsgroup', u'role:owner']))
+
+    def test_principal_cache_needs_request(self, db_session):
+        from kotti.security import global_groups
+
+        self.make_bob()
+        assert global_groups(u'bob') == set([u'group:bobsgroup'])
+        with patch('kotti.security.get_principals') as get_principals:
+            global_groups(u'bob')
+        assert get_principals.call_count == 1
+
     def test_is_user(self, db_session):
         from kotti.security import is_user
 
@@ -580,6 +740,204 @@ class TestPrincipals:
             remember.assert_called_with(request, u'bob')
 
 
+class TestGroupsAuthTkt:
+    def make_policy(self):
+        from kotti.security import GroupsAuthTktAuthenticationPolicy
+        return GroupsAuthTktAuthenticationPolicy('secret', groups_ttl=300)
+
+    def request_with_ticket(self, policy, userid):
+        from kotti.resources import get_root
+
+        headers = policy.remember(
+            DummyRequest(environ={'HTTP_HOST': 'example.com'}), userid)
+        cookie = headers[0][1].split(';', 1)[0]
+        name, value = cookie.split('=', 1)
+        request = DummyRequest(cookies={name: value.strip('"')})
+        request.context = get_root()
+        return request
+
+    def setup_bob(self):
+        from kotti.resources import get_root
+        from kotti.security import get_principals
+        from kotti.security import set_groups
+
+        principals = get_principals()
+        principals[u'bob'].groups = [u'group:bobsgroup']
+        principals[u'group:bobsgroup'].groups = [u'role:editor']
+        set_groups(u'bob', get_root(), [u'role:owner'])
+
+    def test_groups_from_ticket(self, db_session, extra_principals):
+        self.setup_bob()
+        policy = self.make_policy()
+        later = time.time() + 10
+        with patch('time.time', return_value=later):
+            request = self.request_with_ticket(policy, u'bob')
+            with patch.object(policy, 'fallback_callback') as fallback:
+                principals = policy.effective_principals(request)
+            assert fallback.call_count == 0
+        assert set(principals) == set([
+            Everyone, Authenticated, u'bob', u'group:bobsgroup',
+            u'role:editor', u'role:owner'])
+
+    def test_groups_changed(self, db_session, extra_principals):
+        from kotti.security import get_principals
+
+        self.setup_bob()
+        policy = self.make_policy()
+        later = time.time() + 10
+        with patch('time.time', return_value=later):
+            request = self.request_with_ticket(policy, u'bob')
+        with patch('time.time', return_value=later + 10):
+            get_principals()[u'bob'].groups = []
+        with patch('time.time', return_value=later + 20):
+            principals = policy.effective_principals(request)
+        assert u'group:bobsgroup' not in principals
+        assert u'role:owner' in principals
+
+    def test_groups_from_ticket_after_login(self, config, db_session,
+                                            extra_principals):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from kotti.resources import get_root
+        from kotti.security import get_principals
+        from kotti.views.login import login
+
+        self.setup_bob()
+        bob = get_principals()[u'bob']
+        bob.password = get_principals().hash_password(u'secret')
+        db_session.flush()
+        policy = self.make_policy()
+        config.set_authorization_policy(ACLAuthorizationPolicy())
+        config.set_authentication_policy(policy)
+
+        request = DummyRequest(environ={'HTTP_HOST': 'example.com'})
+        request.params['submit'] = u'on'
+        request.params['login'] = u'bob'
+        request.params['password'] = u'secret'
+        response = login(get_root(), request)
+        assert response.status == '302 Found'
+        # The login view sets ``last_login_date`` after remembering:
+        db_session.flush()
+
+        name, value = response.headers['Set-Cookie'].split(';', 1)[0].split(
+            '=', 1)
+        request = DummyRequest(cookies={name: value.strip('"')})
+        request.context = get_root()
+        with patch.object(policy, 'fallback_callback') as fallback:
+            principals = policy.effective_principals(request)
+        assert fallback.call_count == 0
+        assert set(principals) == set([
+            Everyone, Authenticated, u'bob', u'group:bobsgroup',
+            u'role:editor', u'role:owner'])
+
+    def test_groups_survive_other_changes(self, db_session,
+                                          extra_principals):
+        from kotti.security import get_principals
+
+        self.setup_bob()
+        policy = self.make_policy()
+        request = self.request_with_ticket(policy, u'bob')
+        bob = get_principals()[u'bob']
+        bob.title = u'Bobby'
+        bob.password = get_principals().hash_password(u'secret')
+        bob.last_login_date = datetime.now()
+        db_session.flush()
+        with patch.object(policy, 'fallback_callback') as fallback:
+            policy.effective_principals(request)
+        assert fallback.call_count == 0
+
+    def increment_generation(self, db_session):
+        # What another process does when it changes memberships:
+        from kotti.security import MembershipsGeneration
+
+        table = MembershipsGeneration.__table__
+        db_session.execute(
+            table.update().values(generation=table.c.generation + 1))
+
+    def test_groups_changed_by_other_process(self, db_session,
+                                             extra_principals):
+        self.setup_bob()
+        policy = self.make_policy()
+        request = self.request_with_ticket(policy, u'bob')
+        self.increment_generation(db_session)
+        with patch.object(policy, 'fallback_callback',
+                          return_value=[]) as fallback:
+            policy.effective_principals(request)
+        fallback.assert_called_with(u'bob', request)
+
+    def test_generation_cached(self, db_session, dummy_request,
+                               extra_principals):
+        from kotti.security import clear_principal_cache
+        from kotti.security import get_principals
+        from kotti.security import memberships_generation
+
+        generation = memberships_generation()
+        self.increment_generation(db_session)
+        assert memberships_generation() == generation
+        assert memberships_generation(cached=False) == generation + 1
+
+        # Changes made in this process are noticed right away:
+        clear_principal_cache()
+        generation = memberships_generation()
+        get_principals()[u'bob'].groups = [u'group:bobsgroup']
+        db_session.flush()
+        assert memberships_generation() == generation + 1
+
+    def test_generation_incremented(self, db_session, extra_principals):
+        from kotti.resources import get_root
+        from kotti.security import delete_memberships
+        from kotti.security import get_principals
+        from kotti.security import memberships_generation
+        from kotti.security import set_groups
+
+        generation = memberships_generation()
+        principals = get_principals()
+        principals[u'bob'].groups = [u'group:bobsgroup', u'role:editor']
+        db_session.flush()
+        # Once per flush, not once per membership:
+        assert memberships_generation() == generation + 1
+
+        # Local groups and other attributes are not signed into tickets:
+        set_groups(u'bob', get_root(), [u'role:owner'])
+        principals[u'bob'].title = u'Bobby'
+        db_session.flush()
+        assert memberships_generation() == generation + 1
+
+        delete_memberships(u'group:bobsgroup')
+        assert memberships_generation() == generation + 2
+
+        principals[u'frank'].name = u'frankie'
+        db_session.flush()
+        assert memberships_generation() == generation + 3
+
+    def test_deleted_user(self, db_session, extra_principals):
+        from kotti.security import Principal
+
+        self.setup_bob()
+        policy = self.make_policy()
+        request = self.request_with_ticket(policy, u'bob')
+        db_session.execute(Principal.__table__.delete().where(
+            Principal.name == u'bob'))
+        assert policy.effective_principals(request) == [Everyone]
+
+    def test_groups_expire(self, db_session, extra_principals):
+        self.setup_bob()
+        policy = self.make_policy()
+        later = time.time() + 10
+        with patch('time.time', return_value=later):
+            request = self.request_with_ticket(policy, u'bob')
+        with patch('time.time', return_value=later + 301):
+            with patch.object(policy, 'fallback_callback',
+                              return_value=[]) as fallback:
+                policy.effective_principals(request)
+        fallback.assert_called_with(u'bob', request)
+
+    def test_no_groups_for_groups(self, db_session, extra_principals):
+        policy = self.make_policy()
+        assert policy.groups_tokens(u'bob')[0].startswith('kottiissued')
+        request = self.request_with_ticket(policy, u'group:bobsgroup')
+        assert policy.effective_principals(request) == [Everyone]
+
+
 class TestAuthzContextManager:
     def test_basic(self):
         from kotti.security import authz_context
@@ -0,0 +1,135 @@
+from mock import patch
+from pyramid.security import Allow
+from pyramid.security import DENY_ALL
+from pyramid.security import Everyone
+
+from kotti.testing import DummyRequest
+
+
+class TestAllowedPrincipals:
+    def make_tree(self, config):
+        from kotti import DBSession
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        config.include('kotti.security_index')
+        root = get_root()
+        root[u'public'] = Content()
+        private = root[u'private'] = Content()
+        private.__acl__ = [
+            (Allow, u'role:owner', u'view'),
+            (Allow, u'bob', u'view'),
+            DENY_ALL,
+            ]
+        private[u'sub'] = Content()
+        DBSession.flush()
+        return root
+
+    def rows(self, node):
+        from kotti import DBSession
+        from kotti.resources import AllowedPrincipal
+
+        return dict(
+            (r.principal_name, (r.position, r.allowed)) for r in
+            DBSession.query(AllowedPrincipal).filter_by(node_id=node.id))
+
+    def visible(self, userid=None):
+        from kotti import DBSession
+        from kotti.resources import Content
+        from kotti.security_index import filter_allowed
+
+        query = DBSession.query(Content.name).filter(
+            Content.name.in_([u'public', u'private', u'sub']))
+        with patch('kotti.security_index.authenticated_userid',
+                   return_value=userid):
+            query = filter_allowed(query, DummyRequest())
+            return set(r[0] for r in query)
+
+    def test_rows(self, db_session, events):
+        root = self.make_tree(events)
+
+        public_rows = self.rows(root[u'public'])
+        assert public_rows[u'role:admin'] == (0, True)
+        assert public_rows[Everyone] == (1, True)
+
+        private_rows = self.rows(root[u'private'])
+        assert private_rows == {
+            u'role:admin': (0, True),
+            u'role:owner': (1, True),
+            u'bob': (2, True),
+            Everyone: (3, False),
+            }
+        assert self.rows(root[u'private'][u'sub']) == private_rows
+
+    def test_filter_allowed(self, db_session, events):
+        self.make_tree(events)
+
+        assert self.visible() == set([u'public'])
+        assert self.visible(u'bob') == set([u'public', u'private', u'sub'])
+        assert self.visible(u'frank') == set([u'public'])
+
+    def test_local_groups(self, db_session, events):
+        from kotti import DBSession
+        from kotti.security import set_groups
+
+        root = self.make_tree(events)
+        set_groups(u'frank', root[u'private'], [u'role:owner'])
+        DBSession.flush()
+        assert self.rows(root[u'private'][u'sub'])[u'frank'] == (1, True)
+        assert self.visible(u'frank') == set([u'public', u'private', u'sub'])
+
+        set_groups(u'frank', root[u'private'], [])
+        DBSession.flush()
+        assert u'frank' not in self.rows(root[u'private'][u'sub'])
+        assert self.visible(u'frank') == set([u'public'])
+
+    def test_deny_before_allow(self, db_session, events):
+        from kotti import DBSession
+
+        root = self.make_tree(events)
+        root[u'private'].__acl__ = [
+            (Allow, u'role:owner', u'view'),
+            ('Deny', u'system.Authenticated', u'view'),
+            (Allow, u'bob', u'view'),
+            ]
+        DBSession.flush()
+        assert self.visible(u'bob') == set([u'public'])
+        assert self.visible() == set([u'public', u'private', u'sub'])
+
+    def test_acl_change_and_delete(self, db_session, events):
+        from kotti import DBSession
+
+        root = self.make_tree(events)
+        root[u'private'].__acl__ = [(Allow, Everyone, u'view')]
+        DBSession.flush()
+        assert self.visible() == set([u'public', u'private', u'sub'])
+
+        private, sub = root[u'private'], root[u'private'][u'sub']
+        del root[u'private']
+        DBSession.flush()
+        assert self.rows(private) == {}
+        assert self.rows(sub) == {}
+
+    def test_group_deleted(self, db_session, events, extra_principals):
+        from kotti import DBSession
+        from kotti.events import notify
+        from kotti.events import UserDeleted
+        from kotti.security import get_principals
+        from kotti.security import set_groups
+
+        root = self.make_tree(events)
+        principals = get_principals()
+        principals[u'frank'].groups = [u'group:franksgroup']
+        principals[u'group:franksgroup'].groups = [u'group:bobsgroup']
+        root[u'private'].__acl__ = [(Allow, u'group:bobsgroup', u'view')]
+        set_groups(u'frank', root[u'private'], [u'role:nothing'])
+        DBSession.flush()
+        assert self.rows(root[u'private'])[u'frank'] == (1, True)
+
+        # Frank's group isn't mentioned anywhere, but it made Frank a
+        # member of Bob's group:
+        group = principals[u'group:franksgroup']
+        notify(UserDeleted(group))
+        del principals[u'group:franksgroup']
+        DBSession.flush()
+        assert u'frank' not in self.rows(root[u'private'])
@@ -47,6 +47,24 @@ class TestUserManagement:
             (['group:bobsgroup', 'role:admin'], ['role:admin']))
         assert entries[1][1] == (['role:admin'], [])
 
+    def test_search_pages(self, extra_principals):
+        from kotti.views.users import search_after
+        from kotti.views.users import search_principals
+
+        request = DummyRequest()
+        request.params['search'] = u''
+        request.params['query'] = u'Bob'
+        entries = search_principals(request, limit=1)
+        assert [e[0].name for e in entries] == [u'bob']
+        assert search_after(request) == u'bob'
+
+        request = DummyRequest()
+        request.params['search'] = u'bob'
+        request.params['query'] = u'Bob'
+        entries = search_principals(request, limit=1)
+        assert [e[0].name for e in entries] == [u'group:bobsgroup']
+        assert search_after(request) is None
+
     def test_apply(self, extra_principals):
         from kotti.resources import get_root
         from kotti.security import get_principals
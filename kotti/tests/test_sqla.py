@@ -176,3 +176,43 @@ class TestMutationList:
         from kotti.sqla import MutationList
         mlist = MutationList(['foo'])
         assert ['bar'] + mlist == ['bar', 'foo']
+
+
+class TestPrefixFilter:
+    def make_table(self):
+        from sqlalchemy import Column
+        from sqlalchemy import MetaData
+        from sqlalchemy import Table
+        from sqlalchemy import Unicode
+        return Table('t', MetaData(), Column('value', Unicode(10)))
+
+    def test_matches(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy import select
+        from kotti.sqla import prefix_filter
+
+        table = self.make_table()
+        engine = create_engine('sqlite://')
+        table.create(engine)
+        engine.execute(table.insert(), [dict(value=value) for value in (
+            u'ab', u'ab-c', u'ab\xe4', u'ac', u'a', u'\xe4b', None)])
+
+        def values(prefix):
+            return sorted(row[0] for row in engine.execute(select(
+                [table.c.value], prefix_filter(table.c.value, prefix))))
+        assert values(u'ab') == [u'ab', u'ab-c', u'ab\xe4']
+        assert values(u'ab-') == [u'ab-c']
+        assert values(u'\xe4') == [u'\xe4b']
+        assert len(values(u'')) == 6
+
+    def test_postgresql_compares_code_points(self):
+        from sqlalchemy.dialects import postgresql
+        from kotti.sqla import prefix_filter
+
+        table = self.make_table()
+        clause = prefix_filter(table.c.value, u'ab').compile(
+            dialect=postgresql.dialect())
+        assert str(clause) == (
+            't.value COLLATE "C" >= %(param_1)s AND '
+            't.value COLLATE "C" < %(param_2)s')
+        assert clause.params == {'param_1': u'ab', 'param_2': u'ac'}
@@ -1,5 +1,7 @@
 import colander
 from mock import Mock
+from mock import patch
+from pytest import fixture
 
 from kotti.testing import DummyRequest
 
@@ -94,6 +96,61 @@ class TestTags:
         del root[u'content_1']
         assert DBSession.query(Tag).one().title == u'tag 2'
 
+    def test_delete_orphaned_tags_once_per_flush(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Tag, Content
+        from kotti.testing import assert_max_queries
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag %d' % i for i in range(20)]
+        db_session.flush()
+        del root[u'content_1']
+        with assert_max_queries(100) as stats:
+            db_session.flush()
+        assert len([statement for duration, statement in stats.slowest
+                    if statement.startswith('DELETE FROM tags ')]) == 1
+        assert db_session.query(Tag).count() == 0
+
+    def test_delete_orphaned_tags_only_touched(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Tag, Content
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag 1']
+        # Orphaned behind the ORM's back, e.g. by an SQL bulk delete:
+        db_session.add(Tag(title=u'stale'))
+        db_session.flush()
+        del root[u'content_1']
+        assert [tag.title for tag in db_session.query(Tag)] == [u'stale']
+
+    def test_delete_orphaned_tags_batches(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Tag, Content
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag %d' % i for i in range(5)]
+        root[u'content_2'] = Content()
+        root[u'content_2'].tags = [u'tag 1']
+        db_session.flush()
+        with patch('kotti.events.TAGS_BATCH_SIZE', 2):
+            del root[u'content_1']
+            assert [tag.title for tag in db_session.query(Tag)] == [u'tag 1']
+
+    def test_delete_all_orphaned_tags(self, db_session, events):
+        from kotti.events import delete_all_orphaned_tags
+        from kotti.resources import get_root
+        from kotti.resources import Tag
+
+        get_root().tags = [u'tag 1']
+        db_session.add(Tag(title=u'stale 1'))
+        db_session.add(Tag(title=u'stale 2'))
+        db_session.flush()
+        assert delete_all_orphaned_tags() == 2
+        assert [tag.title for tag in db_session.query(Tag)] == [u'tag 1']
+
     def test_delete_tag_assignment_doesnt_touch_content(self, db_session, events):
         from kotti import DBSession
         from kotti.resources import get_root
@@ -257,6 +314,178 @@ class TestTags:
         assert [res.name for res in result] == [u'content_1', u'content_2']
 
 
+class TestTagUsageCount:
+    def usage_counts(self, db_session):
+        from kotti.resources import Tag
+        return dict(db_session.query(Tag.title, Tag.usage_count))
+
+    def test_insert(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag 1', u'tag 2']
+        db_session.flush()
+        root[u'content_2'] = Content()
+        root[u'content_2'].tags = [u'tag 1']
+        assert self.usage_counts(db_session) == {u'tag 1': 2, u'tag 2': 1}
+
+    def test_loaded_tags_are_refreshed(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag 1']
+        db_session.flush()
+        tag = root[u'content_1']._tags[0].tag
+        assert tag.usage_count == 1
+        root[u'content_2'] = Content()
+        root[u'content_2'].tags = [u'tag 1']
+        db_session.flush()
+        assert tag.usage_count == 2
+
+    def test_delete(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag 1', u'tag 2']
+        root[u'content_2'] = Content()
+        root[u'content_2'].tags = [u'tag 1']
+        db_session.flush()
+        root[u'content_1'].tags = [u'tag 2']
+        db_session.flush()
+        assert self.usage_counts(db_session) == {u'tag 1': 1, u'tag 2': 1}
+        del root[u'content_2']
+        assert self.usage_counts(db_session) == {u'tag 2': 1}
+
+    def test_copy(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Content
+
+        root = get_root()
+        root[u'content_1'] = Content()
+        root[u'content_1'].tags = [u'tag 1']
+        root[u'content_2'] = root[u'content_1'].copy()
+        assert self.usage_counts(db_session) == {u'tag 1': 2}
+
+    def test_recount_tags(self, db_session, events):
+        from kotti.events import recount_tags
+        from kotti.resources import get_root
+        from kotti.resources import Tag
+
+        get_root().tags = [u'tag 1']
+        db_session.flush()
+        db_session.execute(Tag.__table__.update().values(usage_count=7))
+        recount_tags()
+        assert self.usage_counts(db_session) == {u'tag 1': 1}
+
+
+class TestTagViews:
+    @fixture
+    def root(self, app, db_session):
+        from kotti.resources import get_root
+        return get_root()
+
+    def make_content(self, root, number, tags):
+        from kotti import DBSession
+        from kotti.resources import Document
+        from kotti.workflow import get_workflow
+
+        for index in range(number):
+            doc = root[u'doc-%d' % index] = Document(title=u'Doc %d' % index)
+            doc.tags = tags
+            DBSession.flush()
+            get_workflow(doc).transition_to_state(doc, None, u'public')
+
+    def test_tag_view(self, root, db_session):
+        from kotti.views.view import tag_view
+
+        self.make_content(root, 3, [u'tag 1'])
+        root[u'doc-1'].tags = []
+        root[u'doc-2'].tags = [u'other', u'tag 1']
+        page = tag_view(root, DummyRequest(params={'tag': u'tag 1'}))
+        assert page['tag'].title == u'tag 1'
+        assert [item['name'] for item in page['items']] == [
+            u'doc-2', u'doc-0']
+        assert page['previous_url'] is None
+        assert page['next_url'] is None
+
+    def test_tag_view_not_found(self, root, db_session):
+        from pyramid.exceptions import NotFound
+        from pytest import raises
+        from kotti.views.view import tag_view
+
+        with raises(NotFound):
+            tag_view(root, DummyRequest(params={'tag': u'missing'}))
+        with raises(NotFound):
+            tag_view(root, DummyRequest())
+
+    def test_tag_view_pages(self, root, db_session):
+        from kotti.views.view import tag_view
+
+        self.make_content(root, 5, [u'tag 1'])
+        with patch('kotti.views.view.TAG_ITEMS_PER_PAGE', 2):
+            page = tag_view(root, DummyRequest(params={'tag': u'tag 1'}))
+            assert [item['name'] for item in page['items']] == [
+                u'doc-4', u'doc-3']
+            assert page['previous_url'] is None
+            assert 'page=2' in page['next_url']
+
+            page = tag_view(root, DummyRequest(
+                params={'tag': u'tag 1', 'page': '3'}))
+            assert [item['name'] for item in page['items']] == [u'doc-0']
+            assert 'page=2' in page['previous_url']
+            assert page['next_url'] is None
+
+    def test_tag_view_permissions(self, root, db_session):
+        from kotti.views.view import tag_view
+        from kotti.workflow import get_workflow
+
+        self.make_content(root, 2, [u'tag 1'])
+        doc = root[u'doc-1']
+        get_workflow(doc).transition_to_state(doc, None, u'private')
+        page = tag_view(root, DummyRequest(params={'tag': u'tag 1'}))
+        assert [item['name'] for item in page['items']] == [u'doc-0']
+
+    def test_tag_cloud(self, root, db_session):
+        from kotti.views.view import tag_cloud
+
+        self.make_content(root, 3, [u'Common'])
+        root[u'doc-0'].tags = [u'Common', u'rare']
+        root[u'doc-1'].tags = [u'Common', u'medium']
+        root[u'doc-2'].tags = [u'Common', u'medium']
+        db_session.flush()
+        tags = tag_cloud(root, DummyRequest())['tags']
+        assert [(tag['title'], tag['count'], tag['size']) for tag in tags] == [
+            (u'Common', 3, 5), (u'medium', 2, 3), (u'rare', 1, 1)]
+        assert tags[0]['url'] == 'http://example.com/@@tag?tag=Common'
+
+    def test_tag_cloud_permissions(self, root, db_session):
+        from kotti.views.view import tag_cloud
+        from kotti.workflow import get_workflow
+
+        self.make_content(root, 2, [u'public'])
+        doc = root[u'doc-1']
+        doc.tags = [u'public', u'secret']
+        get_workflow(doc).transition_to_state(doc, None, u'private')
+        db_session.flush()
+        tags = tag_cloud(root, DummyRequest())['tags']
+        assert [(tag['title'], tag['count']) for tag in tags] == [
+            (u'public', 2)]
+
+    def test_tag_cloud_size(self, root, db_session):
+        from kotti.views.view import tag_cloud
+
+        self.make_content(root, 1, [u'tag 1', u'tag 2', u'tag 3'])
+        with patch('kotti.views.view.TAG_CLOUD_SIZE', 2):
+            tags = tag_cloud(root, DummyRequest())['tags']
+        assert len(tags) == 2
+
+
 class TestCommaSeparatedListWidget:
     def make_one(self):
         from kotti.views.form import CommaSeparatedListWidget
@@ -289,3 +518,59 @@ class TestCommaSeparatedListWidget:
 
     def test_widget_deserialize(self):
         assert self.make_one().deserialize(None, 'foo,bar') == ['foo', 'bar']
+
+
+class TestTagsAutocomplete:
+    def test_search_prefix(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.resources import Tag
+
+        get_root().tags = [u'Python', u'pyramid', u'Plone', u'spy']
+        db_session.flush()
+        titles = lambda term, **kw: [
+            tag.title for tag in Tag.search_prefix(term, **kw)]
+        assert titles(u'py') == [u'pyramid', u'Python']
+        assert titles(u'PY ') == [u'pyramid', u'Python']
+        assert titles(u'py', limit=1) == [u'pyramid']
+        assert titles(u'x') == []
+
+        get_root().tags = [u'\xc4rger', u'\xe4rgerlich', u'arg']
+        db_session.flush()
+        assert titles(u'\xe4r') == [u'\xc4rger', u'\xe4rgerlich']
+        assert titles(u'\xc4R') == [u'\xc4rger', u'\xe4rgerlich']
+        assert titles(u'\xe4rger-') == []
+
+    def test_view(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.views.edit.content import tags_autocomplete
+
+        root = get_root()
+        root.tags = [u'tag 1', u'tag 2', u'other']
+        request = DummyRequest(params={'term': u'ta'})
+        assert tags_autocomplete(root, request) == [u'tag 1', u'tag 2']
+        request = DummyRequest(params={'term': u' '})
+        assert tags_autocomplete(root, request) == []
+
+    def test_view_limit(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.views.edit.content import tags_autocomplete
+
+        root = get_root()
+        root.tags = [u'tag %02d' % i for i in range(30)]
+        request = DummyRequest(params={'term': u'tag'})
+        with patch('kotti.views.edit.content.TAGS_AUTOCOMPLETE_LIMIT', 5):
+            assert tags_autocomplete(root, request) == [
+                u'tag 00', u'tag 01', u'tag 02', u'tag 03', u'tag 04']
+
+    def test_widget_doesnt_list_tags(self, db_session, events):
+        from kotti.resources import get_root
+        from kotti.views.form import deferred_tag_it_widget
+
+        root = get_root()
+        root.tags = [u'tag 1']
+        request = DummyRequest()
+        request.context = root
+        widget = deferred_tag_it_widget(None, {'request': request})
+        assert widget.autocomplete_url == (
+            'http://example.com/@@tags-autocomplete')
+        assert not hasattr(widget, 'available_tags')
@@ -19,6 +19,8 @@ from pyramid.url import resource_url
 from repoze.lru import LRUCache
 from zope.deprecation import deprecated
 
+from kotti.metrics import cache_requests
+
 _ = TranslationStringFactory('Kotti')
 
 
@@ -71,7 +73,7 @@ def request_container():
     return cache
 
 
-def cache(compute_key, container_factory):
+def cache(compute_key, container_factory, name=None):
     marker = object()
 
     def decorator(func):
@@ -87,10 +89,13 @@ def cache(compute_key, container_factory):
             cached_value = cache.get(key, marker)
             if cached_value is marker:
                 #print "\n*** MISS %r ***" % key
+                if name is not None and cache_requests.enabled:
+                    cache_requests.inc(cache=name, result='miss')
                 cached_value = cache[key] = func(*args, **kwargs)
             else:
                 #print "\n*** HIT %r ***" % key
-                pass
+                if name is not None and cache_requests.enabled:
+                    cache_requests.inc(cache=name, result='hit')
             return cached_value
         replacement.__doc__ = func.__doc__
         return replacement
@@ -98,7 +103,7 @@ def cache(compute_key, container_factory):
 
 
 def request_cache(compute_key):
-    return cache(compute_key, request_container)
+    return cache(compute_key, request_container, 'request_cache')
 
 
 class LRUCacheSetItem(LRUCache):
@@ -108,7 +113,7 @@ _lru_cache = LRUCacheSetItem(1000)
 
 
 def lru_cache(compute_key):
-    return cache(compute_key, lambda: _lru_cache)
+    return cache(compute_key, lambda: _lru_cache, 'lru_cache')
 
 
 def clear_cache():  # only useful for tests really
@@ -179,6 +184,18 @@ def camel_case_to_name(text):
         r'((?<=[a-z])[A-Z]|(?<!\A)[A-Z](?=[a-z]))', r'_\1', text).lower()
 
 
+def search_result(result, request):
+    """Return the dict that represents the content ``result`` in lists
+    of search results.
+    """
+    return dict(
+        name=result.name,
+        title=result.title,
+        description=result.description,
+        path=request.resource_path(result),
+        )
+
+
 def command(func, doc):
     args = docopt(doc)
     pyramid_env = bootstrap(args['<config_uri>'])
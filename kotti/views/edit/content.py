@@ -13,6 +13,7 @@ from deform.widget import TextAreaWidget
 from kotti.resources import Document
 from kotti.resources import File
 from kotti.resources import Image
+from kotti.resources import Tag
 from kotti.util import _
 from kotti.views.form import AddFormView
 from kotti.views.form import EditFormView
@@ -21,6 +22,9 @@ from kotti.views.form import ObjectType
 from kotti.views.form import deferred_tag_it_widget
 from kotti.views.form import validate_file_size_limit
 
+#: Maximum number of tags that :func:`tags_autocomplete` returns
+TAGS_AUTOCOMPLETE_LIMIT = 20
+
 
 class ContentSchema(colander.MappingSchema):
     title = colander.SchemaNode(
@@ -130,7 +134,26 @@ class ImageAddForm(FileAddForm):
     item_class = Image
 
 
+def tags_autocomplete(context, request):
+    """Return the titles of up to :data:`TAGS_AUTOCOMPLETE_LIMIT` tags
+    that start with the ``term`` request parameter, for the tag widget
+    in forms.
+    """
+    term = request.params.get('term', u'')
+    if not term.strip():
+        return []
+    return [tag.title for tag in
+            Tag.search_prefix(term, limit=TAGS_AUTOCOMPLETE_LIMIT)]
+
+
 def includeme(config):
+    config.add_view(
+        tags_autocomplete,
+        name='tags-autocomplete',
+        permission='edit',
+        renderer='json',
+        )
+
     config.add_view(
         DocumentEditForm,
         context=Document,
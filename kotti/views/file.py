@@ -1,3 +1,4 @@
+from kotti.metrics import blob_bytes_served
 from kotti.resources import File
 
 from pyramid.response import Response
@@ -22,6 +23,7 @@ def inline_view(context, request, disposition='inline'):
             ]
         )
     res.body = context.data
+    blob_bytes_served.inc(len(res.body), type='file')
     return res
 
 
@@ -19,7 +19,6 @@ from pyramid_deform import CSRFSchema
 from pyramid_deform import FormView
 
 from kotti import get_settings
-from kotti.resources import Tag
 from kotti.util import _
 from kotti.util import title_to_name
 
@@ -44,12 +43,17 @@ class ObjectType(colander.SchemaType):
 
 @colander.deferred
 def deferred_tag_it_widget(node, kw):
+    """A widget that suggests existing tags while typing.  The
+    suggestions are fetched from the ``tags-autocomplete`` view (see
+    :func:`kotti.views.edit.content.tags_autocomplete`), so that the
+    form doesn't grow with the number of tags.
+    """
     tagit.need()
-    all_tags = Tag.query.all()
-    available_tags = [tag.title.encode('utf-8') for tag in all_tags]
+    request = kw['request']
     widget = CommaSeparatedListWidget(
         template='tag_it',
-        available_tags=available_tags,
+        autocomplete_url=request.resource_url(
+            request.context, '@@tags-autocomplete'),
         )
     return widget
 
@@ -9,6 +9,8 @@ from pyramid.view import view_config
 from pyramid.view import view_defaults
 
 from kotti.interfaces import IImage
+from kotti.metrics import blob_bytes_served
+from kotti.metrics import image_scales as image_scales_metric
 from kotti.util import extract_from_settings
 
 PIL.ImageFile.MAXBLOCK = 33554432
@@ -90,6 +92,7 @@ class ImageView(object):
                                              width=width,
                                              height=height,
                                              direction="thumb")
+            image_scales_metric.inc(scale=scale)
         else:
             image = self.context.data
 
@@ -102,6 +105,7 @@ class ImageView(object):
             ],
             body=image,
             )
+        blob_bytes_served.inc(len(image), type='image')
 
         return res
 
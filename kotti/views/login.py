@@ -37,6 +37,11 @@ from kotti.views.users import UserAddFormView
 
 def _find_user(login):
     principals = get_principals()
+    find_by_login = getattr(principals, 'find_by_login', None)
+    if find_by_login is not None:
+        return find_by_login(login)
+
+    # BBB principals factories without 'find_by_login':
     principal = principals.get(login)
     if principal is not None:
         return principal
@@ -142,6 +147,9 @@ def login(context, request):
 
         if (user is not None and user.active and
                 principals.validate_password(password, user.password)):
+            needs_rehash = getattr(principals, 'needs_rehash', None)
+            if needs_rehash is not None and needs_rehash(user.password):
+                user.password = principals.hash_password(password)
             headers = remember(request, user.name)
             request.session.flash(
                 _(u"Welcome, ${user}!",
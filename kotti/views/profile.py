@@ -0,0 +1,41 @@
+"""
+The ``@@profile`` view samples all threads of the process that
+handles the request and returns the result.  See
+:mod:`kotti.profiler`.
+
+Parameters are ``seconds`` (default: ``10``, at most
+:data:`kotti.profiler.MAX_SECONDS`) and ``format``, which is either
+``collapsed`` (the default) or ``pstats``.
+"""
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from kotti.profiler import MAX_SECONDS
+from kotti.profiler import profile
+
+
+@view_config(name='profile', permission='admin')
+def profile_view(context, request):
+    try:
+        seconds = float(request.params.get('seconds', 10))
+    except ValueError:
+        raise HTTPBadRequest("'seconds' must be a number")
+    seconds = max(0.0, min(seconds, MAX_SECONDS))
+    format = request.params.get('format', 'collapsed')
+    if format not in ('collapsed', 'pstats'):
+        raise HTTPBadRequest("'format' must be 'collapsed' or 'pstats'")
+
+    sampler = profile(seconds)
+    if format == 'pstats':
+        return Response(
+            sampler.pstats(),
+            content_type='application/octet-stream',
+            content_disposition='attachment;filename="kotti.prof"')
+    return Response(sampler.collapsed(), content_type='text/plain',
+                    charset='utf-8')
+
+
+def includeme(config):
+    config.scan(__name__)
@@ -26,6 +26,7 @@ from kotti.security import get_principals
 from kotti.security import list_groups_ext
 from kotti.security import list_groups_raw
 from kotti.security import map_principals_with_local_roles
+from kotti.security import prime_principal_groups
 from kotti.security import set_groups
 from kotti.util import _
 from kotti.views.form import AddFormView
@@ -74,13 +75,48 @@ def roles_form_handler(context, request, available_role_names, groups_lister):
     return changed
 
 
-def search_principals(request, context=None, ignore=None, extra=()):
+#: Max number of principals listed per page of search results
+SEARCH_LIMIT = 50
+
+_SEARCH_AFTER_KEY = 'kotti.principal_search.after'
+
+
+def _find_principals(principals, term, limit, after):
+    search_prefix = getattr(principals, 'search_prefix', None)
+    if search_prefix is None:  # BBB principals factories without it
+        query = '*%s*' % term
+        return list(principals.search(name=query, title=query, email=query))
+    return search_prefix(term, limit=limit, after=after).all()
+
+
+def search_after(request):
+    """Return the name of the last principal of the search results of
+    ``request`` if there are more results, ``None`` otherwise.  Submit
+    it as the value of ``search`` to get the next page.
+    """
+    return request.environ.get(_SEARCH_AFTER_KEY)
+
+
+def search_principals(request, context=None, ignore=None, extra=(),
+                      limit=SEARCH_LIMIT):
     flash = request.session.flash
     principals = get_principals()
 
     if ignore is None:
         ignore = set()
 
+    found = []
+    if 'search' in request.POST:
+        after = request.POST.get('search') or None
+        found = _find_principals(
+            principals, request.params['query'], limit + 1, after)
+        if len(found) > limit:
+            found = found[:limit]
+            request.environ[_SEARCH_AFTER_KEY] = found[-1].name
+
+    # Load the groups for the whole page at once:
+    prime_principal_groups(list(extra) + [p.name for p in found])
+
     entries = []
     for principal_name in extra:
         if principal_name not in ignore:
@@ -89,10 +125,7 @@ def search_principals(request, context=None, ignore=None, extra=()):
             ignore.add(principal_name)
 
     if 'search' in request.POST:
-        query = '*%s*' % request.params['query']
-        found = False
-        for p in principals.search(name=query, title=query, email=query):
-            found = True
+        for p in found:
             if p.name not in ignore:
                 entries.append((p, list_groups_ext(p.name, context)))
         if not found:
@@ -128,6 +161,7 @@ def share_node(context, request):
     return {
         'entries': entries,
         'available_roles': available_roles,
+        'search_after': search_after(request),
         }
 
 
@@ -165,7 +199,7 @@ def deferred_email_validator(node, kw):
             name = request.user.name
         if email and name:
             principals = get_principals()
-            if any(p for p in principals.search(email=email)
+            if any(p for p in principals.search(email=email.strip().lower())
                    if p.name.lower() != name.lower()):
                 # verify duplicated email except myself when update info
                 return raise_invalid_email
@@ -405,6 +439,7 @@ def users_manage(context, request):
         'api': api,
         'entries': search_entries,
         'available_roles': available_roles,
+        'search_after': search_after(request),
         'user_addform': user_addform['form'],
         'group_addform': group_addform['form'],
         }
@@ -432,7 +467,9 @@ class UserManageFormView(UserEditFormView):
         return schema
 
     def before(self, form):
-        form.appstruct = _massage_groups_out(self.context.__dict__.copy())
+        appstruct = self.context.__dict__.copy()
+        appstruct['groups'] = list(self.context.groups)
+        form.appstruct = _massage_groups_out(appstruct)
 
     def save_success(self, appstruct):
         _massage_groups_in(appstruct)
@@ -445,9 +482,8 @@ class UserManageFormView(UserEditFormView):
     cancel_failure = cancel_success
 
     def delete_success(self, appstruct):
-        principals = get_principals()
-        user = principals.search(email=appstruct['email']).first()
-        location = "%s/@@delete-user?name=%s" % (self.request.application_url, user.name)
+        location = "%s/@@delete-user?name=%s" % (
+            self.request.application_url, self.context.name)
         return HTTPFound(location=location)
 
 
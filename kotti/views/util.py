@@ -2,6 +2,7 @@ import hashlib
 import urllib
 from collections import defaultdict
 from datetime import datetime
+from inspect import getargspec
 
 from babel.dates import format_date
 from babel.dates import format_datetime
@@ -18,8 +19,7 @@ from pyramid.renderers import render
 from pyramid.threadlocal import get_current_registry
 from pyramid.threadlocal import get_current_request
 from pyramid.view import render_view_to_response
-from sqlalchemy import and_
-from sqlalchemy import not_
+from sqlalchemy import case
 from sqlalchemy import or_
 from zope.deprecation import deprecated
 from zope.deprecation.deprecation import deprecate
@@ -27,12 +27,14 @@ from zope.deprecation.deprecation import deprecate
 from kotti import DBSession
 from kotti import get_settings
 from kotti.events import objectevent_listeners
+from kotti.instrumentation import phase
 from kotti.resources import Content
 from kotti.resources import Document
 from kotti.security import get_user
 from kotti.security import has_permission
 from kotti.security import view_permitted
 from kotti.util import disambiguate_name
+from kotti.util import search_result
 disambiguate_name  # BBB
 from kotti.views.form import AddFormView
 from kotti.views.form import BaseFormView
@@ -106,12 +108,13 @@ class Slots(object):
             raise AttributeError(name)
         value = []
         event = event_type(self.context, self.request)
-        for snippet in objectevent_listeners(event):
-            if snippet is not None:
-                if isinstance(snippet, list):
-                    value.extend(snippet)
-                else:
-                    value.append(snippet)
+        with phase('slots'):
+            for snippet in objectevent_listeners(event):
+                if snippet is not None:
+                    if isinstance(snippet, list):
+                        value.extend(snippet)
+                    else:
+                        value.append(snippet)
         setattr(self, name, value)
         return value
 
@@ -155,6 +158,13 @@ class TemplateAPI(object):
         if 'kotti.fanstatic.view_needed' in self.S:
             return [r.need() for r in self.S['kotti.fanstatic.view_needed']]
 
+    def timing(self, name):
+        """Return a context manager that counts the time spent in it
+        towards the ``name`` phase of the request.  See
+        :mod:`kotti.instrumentation`.
+        """
+        return phase(name)
+
     def macro(self, asset_spec, macro_name='main'):
         if self.bare and asset_spec in (
                 self.VIEW_MASTER, self.EDIT_MASTER, self.SITE_SETUP_MASTER):
@@ -367,40 +377,91 @@ def nodes_tree(request, context=None, permission='view'):
         )
 
 
-def search_content(search_term, request=None):
-    return get_settings()['kotti.search_content'][0](search_term, request)
+def _accepts(func, name):
+    try:
+        argspec = getargspec(func)
+    except TypeError:
+        return False
+    return argspec.keywords is not None or name in argspec.args
 
 
-def default_search_content(search_term, request=None):
+def search_content(search_term, request=None, limit=None, offset=0,
+                   filters=None):
+    """Return at most ``limit`` search results for ``search_term``,
+    skipping the first ``offset``, using the function configured as
+    ``kotti.search_content``.  ``filters`` are passed on if the
+    function accepts them.
+    """
+    func = get_settings()['kotti.search_content'][0]
+    kwargs = {}
+    if filters and _accepts(func, 'filters'):
+        kwargs['filters'] = filters
+    if limit is None and not offset:
+        return func(search_term, request, **kwargs)
+    if _accepts(func, 'limit'):
+        return func(search_term, request, limit=limit, offset=offset,
+                    **kwargs)
+    # BBB search functions without 'limit' and 'offset'
+    results = func(search_term, request, **kwargs)
+    if limit is None:
+        return results[offset:]
+    return results[offset:offset + limit]
+
+
+def search_facets(search_term, request=None, filters=None):
+    """Return the facets of the search results for ``search_term``
+    computed by the function configured as ``kotti.search_facets``
+    (see :func:`kotti.search.search_facets`), or ``None`` if there is
+    none.
+    """
+    funcs = get_settings()['kotti.search_facets']
+    if not funcs:
+        return None
+    return funcs[0](search_term, request, filters=filters)
 
-    searchstring = u'%%%s%%' % search_term
 
-    # generic_filter can be applied to all Node (and subclassed) objects
-    generic_filter = or_(Content.name.like(searchstring),
-                         Content.title.like(searchstring),
-                         Content.description.like(searchstring))
+def default_search_content(search_term, request=None, limit=None, offset=0,
+                           batch_size=50):
+    """Search the name, title, description and body of all content
+    for ``search_term``.  Matches in the title rank highest, followed
+    by the name, the description and the body.
 
-    generic_results = DBSession.query(Content).filter(generic_filter)
+    Items are loaded and checked for the ``view`` permission in
+    batches of ``batch_size``, only until ``offset`` plus ``limit``
+    items that the user may view were found.
+    """
+    searchstring = u'%%%s%%' % search_term
+    documents = Document.__table__
 
-    # specific result contain objects matching additional criteria
-    # but must not match the generic criteria (because these objects
-    # are already in the generic_results)
-    document_results = DBSession.query(Document).filter(
-        and_(Document.body.like(searchstring),
-             not_(generic_filter)))
+    title_match = Content.title.like(searchstring)
+    name_match = Content.name.like(searchstring)
+    description_match = Content.description.like(searchstring)
+    body_match = documents.c.body.like(searchstring)
+    rank = case([(title_match, 0), (name_match, 1), (description_match, 2)],
+                else_=3)
 
-    all_results = [c for c in generic_results.all()] \
-        + [c for c in document_results.all()]
+    query = DBSession.query(Content).outerjoin(
+        documents, documents.c.id == Content.id).filter(
+        or_(title_match, name_match, description_match, body_match)).order_by(
+        rank, Content.id)
 
     result_dicts = []
-
-    for result in all_results:
-        if has_permission('view', result, request):
-            result_dicts.append(dict(
-                name=result.name,
-                title=result.title,
-                description=result.description,
-                path=request.resource_path(result)))
+    skip = offset
+    start = 0
+    while limit is None or len(result_dicts) < limit:
+        batch = query.slice(start, start + batch_size).all()
+        for result in batch:
+            if not has_permission('view', result, request):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            result_dicts.append(search_result(result, request))
+            if len(result_dicts) == limit:
+                break
+        if len(batch) < batch_size:
+            break
+        start += batch_size
     return result_dicts
 
 
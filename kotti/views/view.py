@@ -1,13 +1,27 @@
 import warnings
+try:  # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # pyflakes
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
 
 from pyramid.exceptions import NotFound
+from sqlalchemy.sql.expression import exists
 from pyramid.view import render_view_to_response
 from pyramid.view import view_config
 
+from kotti import DBSession
+from kotti import get_settings
 from kotti.interfaces import IContent
 from kotti.resources import Document
+from kotti.resources import Tag
+from kotti.resources import TagsToContents
+from kotti.security_index import filter_allowed
+from kotti.util import _
+from kotti.util import search_result
 
 from kotti.views.util import search_content
+from kotti.views.util import search_facets
 
 
 @view_config(context=IContent)
@@ -33,14 +47,186 @@ def view_node(context, request):  # pragma: no coverage
     return {}  # BBB
 
 
+#: Number of search results per page
+SEARCH_RESULTS_PER_PAGE = 20
+
+#: Number of items per page of the tag view
+TAG_ITEMS_PER_PAGE = 20
+
+#: Maximum number of tags in the tag cloud
+TAG_CLOUD_SIZE = 50
+
+#: Number of different sizes of tags in the tag cloud
+TAG_CLOUD_STEPS = 5
+
+#: Titles of the facets that search results can be narrowed down by
+FACET_TITLES = OrderedDict([
+    ('type', _(u'Type')),
+    ('tag', _(u'Tag')),
+    ('state', _(u'State')),
+    ('owner', _(u'Owner')),
+    ('modified', _(u'Modified')),
+    ])
+
+#: Labels of the values of the ``modified`` facet
+MODIFIED_LABELS = {
+    'day': _(u'Past day'),
+    'week': _(u'Past week'),
+    'month': _(u'Past month'),
+    'year': _(u'Past year'),
+    }
+
+
+def _facet_label(name, value):
+    if name == 'type':
+        for cls in get_settings()['kotti.available_types']:
+            if cls.__mapper__.polymorphic_identity == value:
+                return cls.type_info.title
+    elif name == 'modified':
+        return MODIFIED_LABELS.get(value, value)
+    return value
+
+
+def _page_number(request):
+    try:
+        return max(int(request.params.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
+
 @view_config(name='search-results', permission='view',
              renderer='kotti:templates/view/search-results.pt')
 def search_results(context, request):
     results = []
-    if u'search-term' in request.POST:
-        search_term = request.POST[u'search-term']
-        results = search_content(search_term, request)
-    return {'results': results}
+    facets = []
+    previous_url = next_url = None
+    search_term = request.params.get(u'search-term')
+    if search_term is not None:
+        page = _page_number(request)
+        filters = dict((name, request.params[name]) for name in FACET_TITLES
+                       if request.params.get(name))
+        per_page = SEARCH_RESULTS_PER_PAGE
+        results = search_content(search_term, request, limit=per_page + 1,
+                                 offset=(page - 1) * per_page,
+                                 filters=filters)
+
+        def search_url(filters, page=1):
+            query = dict(filters)
+            query.update({'search-term': search_term, 'page': page})
+            return request.resource_url(
+                context, '@@search-results', query=query)
+        if page > 1:
+            previous_url = search_url(filters, page - 1)
+        if len(results) > per_page:
+            results = results[:per_page]
+            next_url = search_url(filters, page + 1)
+
+        counts = search_facets(search_term, request, filters) or {}
+        for name, values in counts.items():
+            if not values or name not in FACET_TITLES:
+                continue
+            facet = {'name': name, 'title': FACET_TITLES[name], 'values': []}
+            for value, count in values:
+                active = filters.get(name) == value
+                # Clicking a value narrows down the results to it, or
+                # removes the filter again if it's active:
+                narrowed = dict(filters)
+                if active:
+                    del narrowed[name]
+                else:
+                    narrowed[name] = value
+                facet['values'].append({
+                    'label': _facet_label(name, value),
+                    'count': count,
+                    'active': active,
+                    'url': search_url(narrowed),
+                    })
+            facets.append(facet)
+    return {
+        'results': results,
+        'facets': facets,
+        'previous_url': previous_url,
+        'next_url': next_url,
+        }
+
+
+@view_config(name='tag', permission='view',
+             renderer='kotti:templates/view/tag.pt')
+def tag_view(context, request):
+    """List the content that has the tag in the ``tag`` request
+    parameter and that the user may view.  Items are ordered by
+    descending id, so that the content that was added last comes first,
+    without having to sort all of the tag's items.
+    """
+    title = request.params.get('tag')
+    tag = title and DBSession.query(Tag).filter(Tag.title == title).first()
+    if tag is None:
+        raise NotFound()
+
+    page = _page_number(request)
+    per_page = TAG_ITEMS_PER_PAGE
+    items = filter_allowed(tag.items_query(), request).order_by(
+        TagsToContents.content_id.desc()).offset(
+        (page - 1) * per_page).limit(per_page + 1).all()
+
+    def tag_url(page):
+        return request.resource_url(
+            context, '@@tag', query={'tag': title, 'page': page})
+    previous_url = next_url = None
+    if page > 1:
+        previous_url = tag_url(page - 1)
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_url = tag_url(page + 1)
+    return {
+        'tag': tag,
+        'items': [search_result(item, request) for item in items],
+        'previous_url': previous_url,
+        'next_url': next_url,
+        }
+
+
+def tag_cloud_sizes(counts, steps=TAG_CLOUD_STEPS):
+    """Return the sizes, from 1 to ``steps``, of tags that are used
+    ``counts`` times.
+
+      >>> tag_cloud_sizes([1, 3, 5, 2], steps=3)
+      [1, 2, 3, 1]
+    """
+    if not counts:
+        return []
+    least, most = min(counts), max(counts)
+    if least == most:
+        return [1] * len(counts)
+    return [1 + (count - least) * (steps - 1) // (most - least)
+            for count in counts]
+
+
+@view_config(name='tag-cloud', permission='view',
+             renderer='kotti:templates/view/tag-cloud.pt')
+def tag_cloud(context, request):
+    """Show the :data:`TAG_CLOUD_SIZE` most used of the tags that are
+    assigned to at least one item that the user may view.  Their counts
+    are read from :attr:`kotti.resources.Tag.usage_count` and include
+    content that the user may not view.
+    """
+    visible = filter_allowed(
+        DBSession.query(TagsToContents.tag_id).filter(
+            TagsToContents.tag_id == Tag.id),
+        request, TagsToContents.content_id)
+    rows = DBSession.query(Tag.title, Tag.usage_count).filter(
+        Tag.usage_count > 0).filter(
+        exists(visible.statement.correlate(Tag.__table__))).order_by(
+        Tag.usage_count.desc(), Tag.title).limit(TAG_CLOUD_SIZE).all()
+    sizes = tag_cloud_sizes([count for title, count in rows])
+    tags = [{
+        'title': title,
+        'count': count,
+        'size': size,
+        'url': request.resource_url(context, '@@tag', query={'tag': title}),
+        } for (title, count), size in zip(rows, sizes)]
+    tags.sort(key=lambda tag: tag['title'].lower())
+    return {'tags': tags}
 
 
 @view_config(name='search', permission='view',
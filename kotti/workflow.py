@@ -36,17 +36,21 @@ def initialize_workflow(event):
         wf.initialize(event.object)
 
 
-def workflow_callback(context, info):
-    wf = info.workflow
-    to_state = info.transition.get('to_state')
+def initialize_workflows(event):
+    """Like :func:`initialize_workflow`, but for all content that's
+    inserted with one flush.
+    """
+    for obj in event.of_type(Content):
+        wf = get_workflow(obj)
+        if wf is not None:
+            wf.initialize(obj)
 
-    if to_state is None:
-        if context.state:
-            to_state = context.state
-        else:
-            to_state = wf.initial_state
 
-    state_data = wf._state_data[to_state].copy()
+def state_acl(wf, state):
+    """Return the ACL that objects in ``state`` of the workflow ``wf``
+    get.
+    """
+    state_data = wf._state_data[state].copy()
     acl = []
 
     # This could definitely be cached...
@@ -57,8 +61,20 @@ def workflow_callback(context, info):
 
     if state_data.get('inherit', '0').lower() not in TRUE_VALUES:
         acl.append(DENY_ALL)
+    return acl
+
+
+def workflow_callback(context, info):
+    wf = info.workflow
+    to_state = info.transition.get('to_state')
+
+    if to_state is None:
+        if context.state:
+            to_state = context.state
+        else:
+            to_state = wf.initial_state
 
-    context.__acl__ = acl
+    context.__acl__ = state_acl(wf, to_state)
 
     if info.transition:
         notify(WorkflowTransition(context, info))
@@ -42,7 +42,7 @@ install_requires = [
     'pyramid_mailer',
     'pyramid_tm',
     'pyramid_zcml',
-    'repoze.lru',
+    'repoze.lru>=0.5',  # ExpiringLRUCache
     'repoze.workflow',
     'sqlalchemy>=0.7.6',
     'transaction>=1.1.0',
@@ -111,6 +111,12 @@ setup(name='Kotti',
       [console_scripts]
       kotti-migrate = kotti.migrate:kotti_migrate_command
       kotti-reset-workflow = kotti.workflow:reset_workflow_command
+      kotti-reindex-security = kotti.security_index:reindex_security_command
+      kotti-benchmarks = kotti.benchmarks.suite:kotti_benchmarks_command
+      kotti-generate-site = kotti.benchmarks.generate:generate_site_command
+      kotti-bench = kotti.benchmarks.replay:kotti_bench_command
+      kotti-reindex-search = kotti.search:reindex_search_command
+      kotti-delete-orphaned-tags = kotti.events:delete_orphaned_tags_command
 
       [pytest11]
       kotti = kotti.tests.configure